@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+CPU cost of payload compression, in CPU seconds per MB of payload.
+
+Compares the double zlib used by the old protocol (socket._compress and
+socket._decompress) with every registered codec, going through the same
+socket._encode path (and its size threshold) that send uses.
+
+    python benchmarks/compression.py [--mb 8]
+
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pysocket
+from pysocket import compression
+
+
+def payloads(size):
+    """Yields (name, list of messages) for the different kinds of traffic"""
+    text = (b'The quick brown fox jumps over the lazy dog. ' * (size // 45 + 1))[:size]
+    yield 'text', [text]
+    yield 'random', [os.urandom(size)]  # Stands in for already-compressed data
+    yield 'small', [b'ping %d' % i for i in range(size // 8)]  # Tiny control-style messages
+
+
+def cpu(func, messages):
+    start = time.process_time()
+    for message in messages:
+        func(message)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mb', type=float, default=8, help='megabytes of payload per run')
+    args = parser.parse_args()
+
+    size = int(args.mb * 1024 * 1024)
+    sock = pysocket.socket()
+
+    print('%-8s %-12s %14s %14s' % ('payload', 'codec', 'send s/MB', 'recv s/MB'))
+    for name, messages in payloads(size):
+        total = sum(len(message) for message in messages) / (1024.0 * 1024.0)
+
+        # Before: double zlib on everything
+        latin = [message.decode('latin-1') for message in messages]
+        compressed = [sock._compress(message) for message in latin]
+        print('%-8s %-12s %14.4f %14.4f' % (name, 'double-zlib', cpu(sock._compress, latin) / total,
+                                            cpu(sock._decompress, compressed) / total))
+
+        # After: one pass of the chosen codec, skipped for small or incompressible data
+        for codec_id in compression.available():
+            sock.set_codec(codec_id)
+            codec = compression.get(codec_id)
+            encoded = [sock._encode(message) for message in messages]
+
+            def decode(encoded):
+                payload, flags, used = encoded
+                if flags:
+                    compression.get(used).decompress(payload)
+
+            print('%-8s %-12s %14.4f %14.4f' % (name, codec.name, cpu(sock._encode, messages) / total,
+                                                cpu(decode, encoded) / total))
+
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
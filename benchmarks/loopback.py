@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of pysocket Server and Client over loopback.
+
+Every case starts an echo server and some clients, then measures:
+
+    * messages/sec and MB/sec, with each client keeping a window of messages in flight
+    * p50/p99 round trip latency, with one message in flight per client
+
+for every combination of payload size, transport (udp/tcp), threaded or
+non-threaded server and number of clients. Results are written as JSON, and
+can be compared against an earlier run:
+
+    python benchmarks/loopback.py --output new.json --baseline old.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pysocket
+
+SIZES = [16, 256, 4096, 65536, 1024 * 1024]
+TRANSPORTS = {'udp': socket.SOCK_DGRAM, 'tcp': socket.SOCK_STREAM}
+RCVBUF = 4 * 1024 * 1024
+
+
+class EchoServer(pysocket.Server):
+
+    """Sends everything it recives back to the sender only, so round trips can be timed"""
+
+    def sendtoall(self, data, _ip=None):
+        if _ip:
+            self.sendto(data, _ip)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def transport_args(transport):
+    # UDP is the default, so only pass type when it isn't
+    if transport == 'udp':
+        return {}
+    return {'type': TRANSPORTS[transport]}
+
+
+def start_server(transport, threaded):
+    server = EchoServer(('127.0.0.1', 0), thread=threaded, **transport_args(transport))
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    stop = threading.Event()
+
+    if threaded:
+        server.serve()  # Served by the reactor
+    else:
+        def serve():
+            while not stop.is_set():
+                server.serve()
+        threading.Thread(target=serve, daemon=True).start()
+
+    return server, stop
+
+
+def start_client(server, transport):
+    client = pysocket.Client(('127.0.0.1', 0), server._socket.getsockname(), **transport_args(transport))
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    return client
+
+
+def run_client(client, payload, messages, window, rtts, counts):
+    """Sends messages in rounds of window, waiting for the echoes of each round"""
+    sent = recived = 0
+    while sent < messages:
+        batch = min(window, messages - sent)
+        start = time.perf_counter()
+        for i in range(batch):
+            client.send_bytes(payload)
+        sent += batch
+        for i in range(batch):
+            if client.recv_bytes():
+                recived += 1
+            else:
+                break  # Timed out, so count the rest of the round as lost
+        if batch == 1:
+            rtts.append(time.perf_counter() - start)
+    counts.append((sent, recived))
+
+
+def run_case(size, transport, threaded, clients, messages, window):
+    server, stop = start_server(transport, threaded)
+    try:
+        socks = [start_client(server, transport) for i in range(clients)]
+        payload = os.urandom(size)
+        time.sleep(0.05)  # Let the server handle the connects
+
+        result = {'size': size, 'transport': transport, 'threaded': threaded, 'clients': clients}
+
+        # Throughput
+        counts = []
+        threads = [threading.Thread(target=run_client, args=(sock, payload, messages, window, [], counts))
+                   for sock in socks]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        recived = sum(count[1] for count in counts)
+        result['messages'] = sum(count[0] for count in counts)
+        result['lost'] = result['messages'] - recived
+        result['messages_per_sec'] = recived / elapsed
+        result['mb_per_sec'] = recived * size / elapsed / (1024.0 * 1024.0)
+
+        # Latency
+        rtts = []
+        threads = [threading.Thread(target=run_client, args=(sock, payload, max(messages // 4, 10), 1, rtts, []))
+                   for sock in socks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result['rtt_p50_us'] = percentile(rtts, 50) and percentile(rtts, 50) * 1e6
+        result['rtt_p99_us'] = percentile(rtts, 99) and percentile(rtts, 99) * 1e6
+
+        for sock in socks:
+            sock.quit()
+        return result
+    finally:
+        stop.set()
+        server.quit()
+
+
+def case_key(result):
+    return '%(transport)s/%(size)d/%(threaded)s/%(clients)d' % result
+
+
+def compare(results, baseline):
+    """Prints the change in each metric against a baseline run"""
+    old = dict((case_key(result), result) for result in baseline['results'] if not 'error' in result)
+    print('\n%-28s %12s %12s %12s' % ('case', 'msgs/s', 'p50', 'p99'))
+    for result in results:
+        before = old.get(case_key(result))
+        if before is None or 'error' in result:
+            continue
+        ratios = []
+        for metric in ('messages_per_sec', 'rtt_p50_us', 'rtt_p99_us'):
+            if before.get(metric) and result.get(metric):
+                ratios.append('%+11.1f%%' % ((result[metric] / before[metric] - 1) * 100))
+            else:
+                ratios.append('%12s' % '-')
+        print('%-28s %s' % (case_key(result), ' '.join(ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--transports', nargs='+', default=sorted(TRANSPORTS), choices=sorted(TRANSPORTS))
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--messages', type=int, default=1000, help='messages sent by each client')
+    parser.add_argument('--window', type=int, default=8, help='messages each client keeps in flight')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='earlier output to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for transport in args.transports:
+        for size in args.sizes:
+            for threaded in (False, True):
+                for clients in args.clients:
+                    # Keep about the same amount of data in flight whatever the size
+                    window = max(1, min(args.window, (256 * 1024) // size))
+                    messages = max(10, min(args.messages, (64 * 1024 * 1024) // (size * clients)))
+                    try:
+                        result = run_case(size, transport, threaded, clients, messages, window)
+                    except Exception as error:
+                        result = {'size': size, 'transport': transport, 'threaded': threaded,
+                                  'clients': clients, 'error': '%s: %s' % (error.__class__.__name__, error)}
+                    results.append(result)
+
+                    if 'error' in result:
+                        print('%-28s error: %s' % (case_key(result), result['error']))
+                    else:
+                        print('%-28s %10.0f msgs/s %9.2f MB/s  p50 %8.0f us  p99 %8.0f us  lost %d' % (
+                            case_key(result), result['messages_per_sec'], result['mb_per_sec'],
+                            result['rtt_p50_us'] or 0, result['rtt_p99_us'] or 0, result['lost']))
+
+    output = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pysocket': pysocket.__version__},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('\nWrote %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+"""
+pysocket.aio
+~~~~~~~~~~~~
+
+asyncio counterparts of socket, Server and Client. They speak the same wire
+protocol as the threaded classes for messages (DATA and BATCH frames, however
+they're fragmented, compressed or reliably sent, which is ACKed), so both kinds
+can talk to each other, but every socket lives on the running event loop
+instead of a thread. Objects, topics and file transfers aren't supported, and
+their frames are dropped, like any other opcode they don't know:
+
+>>> server = AsyncServer(('127.0.0.1', 8000))
+>>> await server.start()
+>>> async for data in server:
+...     print(data)
+
+"""
+
+import asyncio as _asyncio
+import random as _random
+import socket as _socket
+
+from . import compression as _compression
+from . import frame as _frame
+from . import registry as _registry
+from . import reliable as _reliable
+from .pysocket import SocketError
+
+_END = object()  # Put on the recive queue when the socket is closed
+
+
+def _address(addr, port=None):
+    """Accepts (ip, port) or ip, port like pysocket.socket does"""
+    if port is not None:
+        addr = (addr, port)
+    if not addr[0]:
+        # '' means "this machine", which is where replies come from
+        addr = ('127.0.0.1', addr[1])
+    return tuple(addr[:2])
+
+
+class _DatagramProtocol(_asyncio.DatagramProtocol):
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def connection_lost(self, error):
+        self._sock._queue.put_nowait(_END)
+
+    def datagram_received(self, data, addr):
+        self._sock._datagram_received(data, addr[:2])
+
+    def error_received(self, error):
+        pass  # Like pysocket.socket, "connection refused" and friends aren't real errors
+
+
+class AsyncSocket(object):
+
+    """Base class which is the asyncio version of pysocket.socket"""
+
+    def __init__(self, family=2, type=2, codec=_compression.ZLIB):
+        """Makes a new socket. It isn't usable until bind() or connect() has been awaited"""
+        self._family = family
+        self._type = type
+        self._transport = None
+        self._server = None
+        self._writers = {}  # Stream sockets: peer address -> StreamWriter
+        self._tasks = set()
+        self._queue = _asyncio.Queue()
+        self._blocked = _registry.Blocklist()
+        self._clients = _registry.ClientRegistry()
+        self._peer = None
+        self._peer_codecs = {}
+        self._reassembler = _frame.Reassembler()
+        self._recv_channels = {}  # (ip, sender id) -> reliable.RecvChannel, for reliable frames
+        self._codec = _compression.get(codec)
+        self._compress_threshold = 128
+        self._max_send = 65507
+        self._sender_id = _random.getrandbits(32)
+        self._seq = 0
+        self._ip = '0.0.0.0'
+        self._port = 0
+        self._binded = False
+        self._connected = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.recv()
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+    async def _accept(self, reader, writer):
+        ip = writer.get_extra_info('peername')[:2]
+        if ip[0] in self._blocked:
+            writer.close()
+            return
+        await self.onAccept(ip)
+        await self._read_stream(reader, writer, ip)
+
+    def _conn_client(self, ip):
+        """Adds a client to the self._clients registry and awaits onConnect"""
+        self._clients.add(ip)
+        self._spawn(self.onConnect(ip))
+
+    def _datagram_received(self, data, ip):
+        try:
+            frame = _frame.unpack(data)
+        except _frame.FrameError:
+            return  # Corrupt frame, so just drop it
+
+        if frame is None:
+            # Probably normal socket sent data
+            self._queue.put_nowait((ip, bytes(data), False))
+        elif frame.flags & _frame.FLAG_RELIABLE:
+            self._reliable_received(frame, ip)
+        else:
+            self._frame_received(frame, ip)
+
+    async def _drain(self, ip):
+        writer = self._writers.get(ip)
+        if writer is not None:
+            await writer.drain()
+
+    def _frame_received(self, frame, ip):
+        """Handles a frame from ip, the same way pysocket.socket does"""
+        if frame.opcode == _frame.CODECS:
+            self._peer_codecs[ip] = set(bytearray(frame.payload))
+        elif frame.opcode == _frame.CONNECT:
+            self._peer_codecs[ip] = set(bytearray(frame.payload))
+            self._send_frame(_frame.CODECS, bytes(bytearray(_compression.available())), ip)
+            if not ip[0] in self._blocked:
+                self._conn_client(ip)
+        elif frame.opcode == _frame.LEAVE:
+            self._rem_client(ip)
+        elif frame.opcode == _frame.DISCONNECT:
+            self._connected = False
+            self._peer = None
+        elif frame.opcode in (_frame.DATA, _frame.BATCH):
+            payload = frame.payload
+            if frame.flags & _frame.FLAG_FRAGMENT:
+                payload = self._reassembler.add((ip, frame.sender), frame, ip)
+                if payload is None:
+                    return  # Wait for the rest of the message
+            if frame.flags & _frame.FLAG_COMPRESSED:
+                try:
+                    payload = _compression.decode(payload, frame.codec)
+                except _compression.CodecError:
+                    return  # Compressed with a codec we don't have
+            if frame.opcode == _frame.BATCH:
+                for message in _frame.unpack_batch(payload):
+                    self._queue.put_nowait((ip, message, True))
+                return
+            self._queue.put_nowait((ip, bytes(payload), True))
+        # Anything else (ACKs, HEARTBEATs, objects, topics, files...) isn't for us, so it's dropped
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xffffffff
+        return self._seq
+
+    async def _read_stream(self, reader, writer, ip):
+        """Reads frames from a stream connection until it's closed"""
+        self._writers[ip] = writer
+        try:
+            while True:
+                header = await reader.readexactly(_frame.HEADER.size)
+                payload = await reader.readexactly(_frame.HEADER.unpack(header)[-1])
+                frame = _frame.unpack(header + payload)
+                if frame is None:
+                    break  # Not a pysocket stream, so there's no telling where a frame starts
+                self._frame_received(frame, ip)
+        except (_asyncio.IncompleteReadError, ConnectionError, _frame.FrameError):
+            pass
+        finally:
+            self._writers.pop(ip, None)
+            self._rem_client(ip)
+            writer.close()
+
+    def _reliable_received(self, frame, ip):
+        """ACKs a FLAG_RELIABLE frame, and handles whatever is now in order"""
+        key = (ip, frame.sender)  # A new socket on the same address starts a new sequence
+        channel = self._recv_channels.get(key)
+        if channel is None:
+            channel = self._recv_channels[key] = _reliable.RecvChannel()
+        ready, ack = channel.receive(frame._replace(payload=bytes(frame.payload)))
+        self._send_frame(_frame.ACK, ack, ip)
+        for frame in ready:
+            self._frame_received(frame, ip)
+
+    def _rem_client(self, ip):
+        """Removes a client from the self._clients registry"""
+        self._clients.remove(ip)
+        for key in [key for key in self._recv_channels if key[0] == ip]:
+            del self._recv_channels[key]
+
+    def _send_frame(self, opcode, payload, ip, flags=0, codec=_compression.NONE):
+        """Sends payload as one frame, or as FLAG_FRAGMENT frames if it doesn't fit in one datagram"""
+        payload = memoryview(payload)
+
+        if self._type == _socket.SOCK_STREAM:
+            writer = self._writers.get(ip)
+            if writer is None:
+                raise SocketError("Not connected to %s:%d" % ip)
+            writer.write(_frame.header(opcode, len(payload), flags, self._sender_id, self._next_seq(), codec))
+            writer.write(payload)
+            return
+
+        if self._transport is None:
+            raise SocketError("Socket has not been binded. Bind or connect before sending.")
+
+        size = self._max_send - _frame.HEADER.size
+        if len(payload) <= size:
+            self._transport.sendto(_frame.pack(opcode, payload, flags, self._sender_id, self._next_seq(), codec), ip)
+            return
+
+        msg_id = self._next_seq()
+        for fragment, chunk in _frame.fragments(payload, size, msg_id):
+            self._transport.sendto(_frame.pack(opcode, fragment + chunk, flags | _frame.FLAG_FRAGMENT,
+                                               self._sender_id, self._next_seq(), codec), ip)
+
+    def _spawn(self, coro):
+        """Runs coro in the background, keeping a reference so it isn't garbage collected"""
+        task = _asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def add_blocked(self, ip):
+        """Blocks given IP, or range of IPs in CIDR notation (like '10.0.0.0/8')"""
+        self._blocked.add(ip)
+
+    async def bind(self, addr='127.0.0.1', port=8000):
+        """Binds ip and port to socket"""
+        addr = (addr, port) if port is not None else addr
+        if self._type == _socket.SOCK_STREAM:
+            self._server = await _asyncio.start_server(self._accept, addr[0], addr[1], family=self._family)
+            sockname = self._server.sockets[0].getsockname()
+        else:
+            loop = _asyncio.get_running_loop()
+            self._transport, protocol = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), local_addr=tuple(addr), family=self._family)
+            sockname = self._transport.get_extra_info('sockname')
+
+        self._ip, self._port = sockname[:2]
+        self._binded = True
+
+    def close(self):
+        """Closes socket"""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in list(self._writers.values()):
+            writer.close()
+        self._writers.clear()
+        self._binded = False
+        self._queue.put_nowait(_END)
+
+    async def connect(self, addr, port=None):
+        """Connect to another socket"""
+        ip = _address(addr, port)
+
+        if self._type == _socket.SOCK_STREAM:
+            reader, writer = await _asyncio.open_connection(ip[0], ip[1], family=self._family)
+            ip = writer.get_extra_info('peername')[:2]
+            self._writers[ip] = writer
+            self._spawn(self._read_stream(reader, writer, ip))
+        elif self._transport is None:
+            await self.bind('0.0.0.0', 0)
+
+        self._peer = ip
+        self._connected = True
+        self._send_frame(_frame.CONNECT, bytes(bytearray(_compression.available())), ip)
+        await self._drain(ip)
+
+    def disconnect_all(self):
+        """Disconnects all clients"""
+        for client in self._clients:
+            self._send_frame(_frame.DISCONNECT, b'', client)
+        self._clients.clear()
+
+    def disconnect_client(self, client_ip, client_port):
+        """Disconnects a client"""
+        if self._clients.remove((client_ip, client_port)):
+            self._send_frame(_frame.DISCONNECT, b'', (client_ip, client_port))
+
+    def get_ip(self):
+        """Gets ip"""
+        return self._ip
+
+    def get_port(self):
+        """Gets port"""
+        return self._port
+
+    def getclients(self):
+        """Returns a list of all clients"""
+        return list(self._clients)
+
+    def getsockname(self):
+        return (self._ip, self._port)
+
+    async def leave(self):
+        """If socket is connected to a server, disconnects socket from server"""
+        if self._connected:
+            self._send_frame(_frame.LEAVE, b'', self._peer)
+            await self._drain(self._peer)
+            self._connected = False
+
+    async def onAccept(self, addr):
+        "Reimplement this coroutine in your own subclass. Called for new stream connections"
+        pass
+
+    async def onConnect(self, addr):
+        "Reimplement this coroutine in your own subclass"
+        pass
+
+    async def recv(self):
+        """Waits for the next message and returns it as a str. Returns None once the socket is closed"""
+        data = await self.recv_bytes()
+        if data is None:
+            return None
+        return data.decode('latin-1')
+
+    async def recv_bytes(self):
+        """Like recv, but returns bytes"""
+        item = await self.recvfrom_bytes()
+        return item if item is None else item[0]
+
+    async def recvfrom(self):
+        """Waits for the next message. Returns (data, ip)"""
+        item = await self.recvfrom_bytes()
+        if item is None:
+            return None
+        return item[0].decode('latin-1'), item[1]
+
+    async def recvfrom_bytes(self):
+        """Like recvfrom, but the data is bytes"""
+        item = await self._queue.get()
+        if item is _END:
+            self._queue.put_nowait(_END)  # So everyone else waiting wakes up too
+            return None
+        ip, data, framed = item
+        return data, ip
+
+    async def send(self, data, addr=None):
+        """Sends data to the peer (or addr). Returns the number of bytes sent"""
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'latin-1')
+
+        ip = _address(addr) if addr else self._peer
+        if ip is None:
+            raise SocketError("Socket is not connected. Connect or give an address.")
+
+        codec = _compression.for_peer(self._codec, self._peer_codecs.get(ip, ()))
+        payload, used = _compression.encode(data, codec, self._compress_threshold)
+        self._send_frame(_frame.DATA, payload, ip, _frame.FLAG_COMPRESSED if used else 0, used)
+        await self._drain(ip)
+        return len(data)
+
+    async def sendto(self, data, addr, port=None):
+        return await self.send(data, _address(addr, port))
+
+    async def sendtoall(self, data):
+        for client in self._clients:
+            await self.sendto(data, client)
+
+    def set_codec(self, codec, level=None):
+        """Sets the codec (id or name) used to compress sent data, optionally with a compression level"""
+        codec = _compression.get(codec)
+        if level is not None:
+            codec = codec.__class__(level)
+        self._codec = codec
+
+    def set_compress_threshold(self, size):
+        """Sets the size (in bytes) below which data is sent without compression"""
+        self._compress_threshold = size
+
+
+class AsyncServer(AsyncSocket):
+
+    """asyncio version of pysocket.Server"""
+
+    def __init__(self, addr, type=2, codec=_compression.ZLIB):
+        AsyncSocket.__init__(self, type=type, codec=codec)
+        self._addr = addr
+
+    async def quit(self):
+        """Quits server after disconnecting all clients"""
+        self.disconnect_all()
+        self.close()
+
+    async def sendtoall(self, data, _ip=None):
+        for client in self._clients:
+            if not _ip or client[1] != _ip[1]:
+                await self.sendto(data, client)
+
+    async def serve(self):
+        """Sends everything that is recived to all of the other clients, until the server is closed"""
+        while True:
+            item = await self.recvfrom_bytes()
+            if item is None:
+                return
+            data, ip = item
+            if data:
+                await self.sendtoall(data, ip)
+
+    async def start(self):
+        """Binds the server"""
+        await self.bind(self._addr[0], self._addr[1])
+
+
+class AsyncClient(AsyncSocket):
+
+    """asyncio version of pysocket.Client"""
+
+    def __init__(self, addr, server, type=2, codec=_compression.ZLIB):
+        AsyncSocket.__init__(self, type=type, codec=codec)
+        self._addr = addr
+        self._server_addr = server
+
+    async def quit(self):
+        """Leaves the server and closes the client"""
+        await self.leave()
+        self.close()
+
+    async def start(self):
+        """Binds the client and connects it to the server"""
+        if self._type != _socket.SOCK_STREAM:
+            await self.bind(self._addr[0], self._addr[1])
+        await self.connect(self._server_addr[0], self._server_addr[1])
@@ -0,0 +1,122 @@
+"""
+pysocket.buffers
+~~~~~~~~~~~~~~~~
+
+Preallocated buffers, so the receive path doesn't allocate a new bytes object
+for every datagram, and bounded buffers for the messages sockets keep.
+
+"""
+
+import collections as _collections
+import itertools as _itertools
+import threading as _threading
+
+
+class BufferPool(object):
+
+    """A pool of equally sized bytearrays which can be reused between recives"""
+
+    def __init__(self, size=65535, count=4):
+        self.size = size
+        self.count = count
+        self._free = [bytearray(size) for i in range(count)]
+
+    def acquire(self):
+        """Returns a free buffer, allocating a new one if the pool is empty"""
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buf):
+        """Gives a buffer back to the pool"""
+        if len(self._free) < self.count and len(buf) == self.size:
+            self._free.append(buf)
+
+
+def _sizeof(item):
+    """Size of a message, or of the data in an (ip, data) pair"""
+    if isinstance(item, (tuple, list)):
+        item = item[-1]
+    try:
+        return len(item)
+    except TypeError:
+        return 0
+
+
+class RingBuffer(object):
+
+    """Bounded FIFO of messages. Once it holds maxlen messages, or max_bytes bytes of
+    data, the oldest messages are dropped to make room and counted in dropped"""
+
+    def __init__(self, maxlen=10000, max_bytes=None, sizeof=_sizeof):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self._sizeof = sizeof
+        self._items = _collections.deque()
+        self._bytes = 0
+        self._lock = _threading.Lock()
+
+    def __iter__(self):
+        """Iterates over a snapshot of the messages, without removing them"""
+        with self._lock:
+            return iter(list(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def _trim(self):
+        while self._items and ((self.maxlen is not None and len(self._items) > self.maxlen) or
+                               (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            size = self._sizeof(self._items.popleft())
+            self._bytes -= size
+            self.dropped += 1
+            self.dropped_bytes += size
+
+    def append(self, item):
+        """Adds a message, dropping the oldest ones if the buffer is full"""
+        with self._lock:
+            self._items.append(item)
+            self._bytes += self._sizeof(item)
+            self._trim()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def drain(self):
+        """Yields (and removes) messages, oldest first, until the buffer is empty"""
+        while True:
+            try:
+                yield self.pop()
+            except IndexError:
+                return
+
+    def last(self, amount):
+        """Returns the newest amount messages, oldest first"""
+        with self._lock:
+            items = list(_itertools.islice(reversed(self._items), amount))
+        items.reverse()
+        return items
+
+    @property
+    def nbytes(self):
+        """Bytes of data held"""
+        return self._bytes
+
+    def pop(self):
+        """Removes and returns the oldest message. Raises IndexError if the buffer is empty"""
+        with self._lock:
+            item = self._items.popleft()
+            self._bytes -= self._sizeof(item)
+            return item
+
+    def set_limits(self, maxlen=None, max_bytes=None):
+        """Changes the limits (None means unlimited), dropping messages if they're now exceeded"""
+        with self._lock:
+            self.maxlen = maxlen
+            self.max_bytes = max_bytes
+            self._trim()
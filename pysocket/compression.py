@@ -0,0 +1,147 @@
+"""
+pysocket.compression
+~~~~~~~~~~~~~~~~~~~~
+
+Registry of the compression codecs a socket can use for its payloads. zlib is
+always available; lz4 and zstd are registered when their modules can be
+imported. Every frame records the id of the codec its payload was compressed
+with, so receivers never have to guess.
+
+"""
+
+import zlib as _zlib
+
+# Codec ids, as sent in the frame header
+NONE = 0
+ZLIB = 1
+LZ4 = 2
+ZSTD = 3
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(object):
+
+    """Base class for codecs. Sub-class and register() to add a new one"""
+
+    id = NONE
+    name = 'none'
+
+    def __init__(self, level=None):
+        self.level = level
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+
+    id = ZLIB
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return _zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return _zlib.decompress(data)
+
+
+class LZ4Codec(Codec):
+
+    id = LZ4
+    name = 'lz4'
+
+    def __init__(self, level=0):
+        import lz4.frame
+        self._lz4 = lz4.frame
+        self.level = level
+
+    def compress(self, data):
+        return self._lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return self._lz4.decompress(data)
+
+
+class ZstdCodec(Codec):
+
+    id = ZSTD
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self.level = level
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+_codecs = {}
+
+
+def register(codec):
+    """Registers a codec instance, replacing any codec with the same id"""
+    _codecs[codec.id] = codec
+
+
+def get(codec):
+    """Returns the codec with the given id or name"""
+    for registered in _codecs.values():
+        if codec == registered.id or codec == registered.name:
+            return registered
+    raise CodecError("Unknown codec %r" % (codec,))
+
+
+def available():
+    """Returns the ids of all the registered codecs"""
+    return sorted(_codecs)
+
+
+def for_peer(codec, peer_codecs=()):
+    """Returns codec if the peer can decompress it, otherwise zlib which everyone has"""
+    if codec.id in (NONE, ZLIB) or codec.id in peer_codecs:
+        return codec
+    return get(ZLIB)
+
+
+def encode(data, codec, threshold=0):
+    """Compresses data unless it's smaller than threshold or doesn't shrink. Returns (data, id of the codec used)"""
+    if codec.id == NONE or len(data) < threshold:
+        return data, NONE
+
+    compressed = codec.compress(data)
+    if len(compressed) >= len(data):
+        # Data was already compressed (or can't be), so send it as is
+        return data, NONE
+
+    return compressed, codec.id
+
+
+def decode(data, codec):
+    """Reverses encode, given the id of the codec used"""
+    if codec == NONE:
+        return data
+    return get(codec).decompress(data)
+
+
+register(Codec())
+register(ZlibCodec())
+for _cls in (LZ4Codec, ZstdCodec):
+    try:
+        register(_cls())
+    except ImportError:
+        pass  # Optional dependency isn't installed
+del _cls
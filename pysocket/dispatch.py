@@ -0,0 +1,142 @@
+"""
+pysocket.dispatch
+~~~~~~~~~~~~~~~~~
+
+Runs user callbacks (onAccept, onConnect, proc_recv functions) away from the
+thread that recived the data, so a slow handler can't hold up reciving. A
+bounded queue sits in front of the worker pool, and what happens when it's
+full is chosen with the policy.
+
+"""
+
+import collections as _collections
+import concurrent.futures as _futures
+import threading as _threading
+import traceback as _traceback
+
+# Full-queue policies
+BLOCK = 'block'  # Wait until there's room. Slows down reciving instead of losing messages
+DROP_OLDEST = 'drop_oldest'  # Drop the oldest message which hasn't started yet
+REJECT = 'reject'  # Drop the new message
+
+
+class _Task(object):
+
+    __slots__ = ('func', 'args', 'process', 'started', 'cancelled')
+
+    def __init__(self, func, args, process):
+        self.func = func
+        self.args = args
+        self.process = process  # Run in the process pool, if there is one
+        self.started = False
+        self.cancelled = False
+
+
+class Dispatcher(object):
+
+    """Hands callbacks to a pool of workers through a queue of at most maxsize callbacks.
+
+    If ordered is true, callbacks submitted with the same key (pysocket uses the
+    client address) run one at a time in the order they were submitted; callbacks
+    with different keys still run in parallel. If processes is true, callbacks run
+    in a process pool, and so must be picklable (module level functions), unless
+    they're submitted with process=False."""
+
+    def __init__(self, workers=4, maxsize=1000, policy=BLOCK, ordered=True, processes=False):
+        if not policy in (BLOCK, DROP_OLDEST, REJECT):
+            raise ValueError("Unknown policy %r" % (policy,))
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ordered = ordered
+        self.processes = processes
+        self.dropped = 0  # Callbacks dropped by DROP_OLDEST
+        self.rejected = 0  # Callbacks dropped by REJECT
+        self._pending = 0
+        self._order = _collections.deque()  # Tasks in submission order, for DROP_OLDEST
+        self._keys = {}  # key -> deque of tasks waiting for the one running
+        self._cond = _threading.Condition()
+        self._threads = _futures.ThreadPoolExecutor(workers)
+        self._processes = _futures.ProcessPoolExecutor(workers) if processes else None
+
+    def __len__(self):
+        """Number of callbacks waiting to run"""
+        return self._pending
+
+    def _make_room(self):
+        """Called with the lock held while the queue is full. Returns if the new callback can be queued"""
+        while self._pending >= self.maxsize:
+            if self.policy == REJECT:
+                self.rejected += 1
+                return False
+            elif self.policy == DROP_OLDEST:
+                task = self._order.popleft()
+                if not task.started and not task.cancelled:
+                    task.cancelled = True
+                    self._pending -= 1
+                    self.dropped += 1
+            else:
+                self._cond.wait()
+        return True
+
+    def _run(self, task):
+        """Runs a task on the current (worker) thread, unless it was dropped"""
+        with self._cond:
+            if task.cancelled:
+                return
+            task.started = True
+            self._pending -= 1
+            self._cond.notify()
+
+        try:
+            if self._processes is not None and task.process:
+                self._processes.submit(task.func, *task.args).result()
+            else:
+                task.func(*task.args)
+        except Exception:
+            _traceback.print_exc()  # Like an exception in a thread, report it and keep going
+
+    def _run_key(self, key):
+        """Runs the tasks queued for key one after another"""
+        while True:
+            with self._cond:
+                tasks = self._keys[key]
+                if not tasks:
+                    del self._keys[key]
+                    return
+                task = tasks.popleft()
+            self._run(task)
+
+    def shutdown(self, wait=True):
+        """Stops the workers once the queued callbacks have run (or straight away if wait is false)"""
+        self._threads.shutdown(wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait)
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args). Pass key= to keep callbacks with the same key in order, and process=False
+        to run it on a worker thread even if there's a process pool (for callbacks which can't be pickled).
+        Returns False if the callback was rejected because the queue is full"""
+        key = kwargs.pop('key', None)
+        process = kwargs.pop('process', True)
+
+        with self._cond:
+            if not self._make_room():
+                return False
+
+            task = _Task(func, args, process)
+            self._pending += 1
+            if self.policy == DROP_OLDEST:
+                while self._order and (self._order[0].started or self._order[0].cancelled):
+                    self._order.popleft()
+                self._order.append(task)
+
+            if self.ordered and key is not None:
+                if key in self._keys:
+                    self._keys[key].append(task)  # The worker already running key picks it up
+                    return True
+                self._keys[key] = _collections.deque([task])
+                self._threads.submit(self._run_key, key)
+            else:
+                self._threads.submit(self._run, task)
+        return True
@@ -0,0 +1,276 @@
+"""
+pysocket.frame
+~~~~~~~~~~~~~~
+
+The binary wire format used by pysocket sockets. Every datagram starts with a
+fixed header, followed by the (possibly compressed) payload:
+
+    magic     2s  b'PS'
+    version   B   protocol version
+    opcode    B   DATA, CONNECT, DISCONNECT, LEAVE, CODECS, ACK, BATCH, OBJECT,
+                  SUBSCRIBE, UNSUBSCRIBE, PUBLISH, FILE or HEARTBEAT
+    flags     B   FLAG_* bits (and the serializer id of an OBJECT in the high 4 bits)
+    codec     B   id of the codec the payload was compressed with
+    sender    I   random id of the sending socket
+    seq       I   per-socket sequence number
+    length    I   payload length in bytes
+
+Messages which don't fit in one datagram are sent as FLAG_FRAGMENT frames, whose
+payload starts with a fragment header (message id, index, fragment count) and
+carries one slice of the encoded message. A Reassembler puts them back together.
+
+Small messages can be coalesced into one BATCH frame, whose (decoded) payload is
+each message prefixed with its length.
+
+Objects sent with send_obj are OBJECT frames, and the id of the serializer
+(see pysocket.serialization) is in the high 4 bits of their flags.
+
+SUBSCRIBE and UNSUBSCRIBE payloads are a topic pattern (see pysocket.topics),
+UTF-8 encoded. The (decoded) payload of a PUBLISH frame is the length of the
+topic, the topic, then the message.
+
+FILE frames carry the chunks of a file transfer (see pysocket.transfer), and are
+never compressed, so streams can write their payload straight from the file.
+
+HEARTBEAT frames have no payload. Clients send them to show the server they're
+still there (see pysocket.heartbeat).
+
+"""
+
+import struct as _struct
+import time as _time
+from collections import namedtuple as _namedtuple, OrderedDict as _OrderedDict
+
+MAGIC = b'PS'
+VERSION = 1
+HEADER = _struct.Struct('!2sBBBBIII')
+FRAGMENT = _struct.Struct('!IHH')  # message id, index, count
+BATCH_LENGTH = _struct.Struct('!I')  # Length of each message in a BATCH payload
+TOPIC_LENGTH = _struct.Struct('!H')  # Length of the topic at the start of a PUBLISH payload
+
+# Opcodes
+DATA = 0
+CONNECT = 1
+DISCONNECT = 2
+LEAVE = 3
+CODECS = 4  # Reply to CONNECT listing the codecs the server supports
+ACK = 5  # Acknowledges FLAG_RELIABLE frames (see pysocket.reliable)
+BATCH = 6  # Several coalesced DATA messages
+OBJECT = 7  # A serialized object
+SUBSCRIBE = 8  # Subscribes the sender to the topic (pattern) in the payload
+UNSUBSCRIBE = 9
+PUBLISH = 10  # A message published to a topic
+FILE = 11  # One part of a file transfer (see pysocket.transfer)
+HEARTBEAT = 12  # The sender is still there
+
+# Flags
+FLAG_FRAGMENT = 0x01  # Payload is one fragment of a larger message
+FLAG_COMPRESSED = 0x02  # Payload has been compressed
+FLAG_RELIABLE = 0x04  # Seq is a per-peer sequence number, and the frame must be ACKed
+SERIALIZER_SHIFT = 4  # OBJECT frames keep their serializer id in the flags, above the FLAG_* bits
+
+# Rough bytes of bookkeeping, counted against a Reassembler's max_bytes along with the fragments themselves
+MESSAGE_OVERHEAD = 512  # For each message being put back together
+PART_OVERHEAD = 64  # For each fragment of it which has arrived
+
+# Maps the names in socket._packets to opcodes
+OPCODES = {'connect': CONNECT, 'disconnect': DISCONNECT, '-disconnect-': LEAVE}
+
+
+class FrameError(Exception):
+    pass
+
+
+Frame = _namedtuple('Frame', 'version opcode flags codec sender seq payload')
+
+
+def header(opcode, length, flags=0, sender=0, seq=0, codec=0):
+    """Returns just the header of a frame, for sending alongside a separate payload buffer"""
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, codec, sender, seq, length)
+
+
+def pack(opcode, payload=b'', flags=0, sender=0, seq=0, codec=0):
+    """Returns a complete frame (header and payload) as bytes"""
+    return header(opcode, len(payload), flags, sender, seq, codec) + bytes(payload)
+
+
+def unpack(data):
+    """Parses a frame. Returns None if data isn't a pysocket frame"""
+    if len(data) < HEADER.size or bytes(data[:2]) != MAGIC:
+        return None
+
+    magic, version, opcode, flags, codec, sender, seq, length = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise FrameError("Unsupported frame version %d" % version)
+
+    payload = data[HEADER.size:HEADER.size + length]
+    if len(payload) != length:
+        raise FrameError("Truncated frame (expected %d bytes, got %d)" % (length, len(payload)))
+
+    return Frame(version, opcode, flags, codec, sender, seq, payload)
+
+
+class Reassembler(object):
+
+    """Puts fragmented messages back together. Fragments of different messages (and
+    from different senders) can arrive interleaved and in any order. Incomplete
+    messages are dropped after timeout seconds, or oldest first once the fragments
+    being held take up more than max_bytes or there are more than max_messages of
+    them. A peer can only have max_per_peer messages in flight, so one peer can't
+    take up the whole table"""
+
+    def __init__(self, timeout=5.0, max_bytes=64 * 1024 * 1024, max_messages=1024, max_per_peer=64):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_per_peer = max_per_peer
+        self.expired = 0  # Number of messages dropped because of the timeout
+        self.evicted = 0  # Number of messages dropped because of max_bytes or max_messages
+        self.refused = 0  # Number of messages not started because their peer was at max_per_peer
+        self._messages = _OrderedDict()  # (sender, message id) -> [started, parts, count, size, peer]
+        self._peers = {}  # peer -> number of messages it has in _messages
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _drop(self, key):
+        message = self._messages.pop(key)
+        self._bytes -= message[3]
+        peer = message[4]
+        self._peers[peer] -= 1
+        if not self._peers[peer]:
+            del self._peers[peer]
+
+    def add(self, sender, frame, peer=None):
+        """Adds a FLAG_FRAGMENT frame from sender (any hashable). peer (sender if not
+        given) is who the message counts against for max_per_peer. Returns the whole
+        message once its last fragment arrives, otherwise None"""
+        msg_id, index, count = FRAGMENT.unpack_from(frame.payload)
+        if index >= count:
+            raise FrameError("Fragment %d of a %d fragment message" % (index, count))
+        chunk = frame.payload[FRAGMENT.size:]
+        if index < count - 1 and not len(chunk):
+            raise FrameError("Empty fragment %d of a %d fragment message" % (index, count))
+        if (count - 1) * (len(chunk) if index < count - 1 else 1) > self.max_bytes:
+            raise FrameError("A %d fragment message is bigger than max_bytes" % count)
+
+        now = _time.monotonic()
+        self.expire(now)
+
+        key = (sender, msg_id)
+        message = self._messages.get(key)
+        if message is None:
+            peer = sender if peer is None else peer
+            if self._peers.get(peer, 0) >= self.max_per_peer:
+                self.refused += 1
+                return None
+            while len(self._messages) >= self.max_messages:
+                self._drop(next(iter(self._messages)))
+                self.evicted += 1
+            message = self._messages[key] = [now, {}, count, MESSAGE_OVERHEAD, peer]
+            self._peers[peer] = self._peers.get(peer, 0) + 1
+            self._bytes += MESSAGE_OVERHEAD
+
+        parts = message[1]
+        if message[2] != count:
+            raise FrameError("Fragment of a %d fragment message, which has %d" % (count, message[2]))
+        if index not in parts:
+            parts[index] = bytes(chunk)
+            message[3] += len(chunk) + PART_OVERHEAD
+            self._bytes += len(chunk) + PART_OVERHEAD
+
+        if len(parts) == count:
+            self._drop(key)
+            return b''.join(parts[i] for i in range(count))
+
+        while self._bytes > self.max_bytes and self._messages:
+            self._drop(next(iter(self._messages)))
+            self.evicted += 1
+
+    def expire(self, now=None):
+        """Drops messages which haven't been completed within the timeout"""
+        deadline = (now or _time.monotonic()) - self.timeout
+        while self._messages:
+            key = next(iter(self._messages))
+            if self._messages[key][0] > deadline:
+                break
+            self._drop(key)
+            self.expired += 1
+
+
+def fragments(payload, size, msg_id):
+    """Splits payload into (fragment header, slice) pairs, where no slice is larger than size"""
+    payload = memoryview(payload)
+    size -= FRAGMENT.size
+    count = (len(payload) + size - 1) // size
+    if count > 0xffff:
+        raise FrameError("Message is too large (%d bytes)" % len(payload))
+
+    for index in range(count):
+        yield FRAGMENT.pack(msg_id, index, count), payload[index * size:(index + 1) * size]
+
+
+def fragment_buffers(buffers, size, msg_id):
+    """Like fragments, for a payload made of several buffers. Yields (fragment header, [slices]),
+    where the slices are views of the buffers, so nothing is copied"""
+    views = [memoryview(buf).cast('B') for buf in buffers if len(buf)]
+    total = sum(len(view) for view in views)
+    size -= FRAGMENT.size
+    count = (total + size - 1) // size
+    if count > 0xffff:
+        raise FrameError("Message is too large (%d bytes)" % total)
+
+    for index in range(count):
+        slices = []
+        needed = size
+        while views and needed:
+            view = views[0]
+            if len(view) <= needed:
+                slices.append(views.pop(0))
+                needed -= len(view)
+            else:
+                slices.append(view[:needed])
+                views[0] = view[needed:]
+                needed = 0
+        yield FRAGMENT.pack(msg_id, index, count), slices
+
+
+def pack_batch(messages):
+    """Returns the BATCH payload holding messages"""
+    return b''.join(BATCH_LENGTH.pack(len(message)) + bytes(message) for message in messages)
+
+
+def unpack_batch(payload):
+    """Returns the messages in a BATCH payload"""
+    payload = memoryview(payload)
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        if offset + BATCH_LENGTH.size > len(payload):
+            raise FrameError("Truncated batch")
+        length = BATCH_LENGTH.unpack_from(payload, offset)[0]
+        offset += BATCH_LENGTH.size
+        if offset + length > len(payload):
+            raise FrameError("Truncated batch")
+        messages.append(bytes(payload[offset:offset + length]))
+        offset += length
+    return messages
+
+
+def pack_publish(topic, data):
+    """Returns the payload of a PUBLISH frame"""
+    topic = topic.encode('utf-8')
+    return b''.join((TOPIC_LENGTH.pack(len(topic)), topic, data))
+
+
+def unpack_publish(payload):
+    """Returns (topic, message) from a PUBLISH payload"""
+    payload = memoryview(payload)
+    if len(payload) < TOPIC_LENGTH.size:
+        raise FrameError("Truncated publish")
+    length = TOPIC_LENGTH.unpack_from(payload)[0]
+    end = TOPIC_LENGTH.size + length
+    if end > len(payload):
+        raise FrameError("Truncated publish")
+    return bytes(payload[TOPIC_LENGTH.size:end]).decode('utf-8'), bytes(payload[end:])
@@ -0,0 +1,137 @@
+"""
+pysocket.heartbeat
+~~~~~~~~~~~~~~~~~~
+
+Finds peers which have gone quiet. Clients with heartbeats turned on send a
+HEARTBEAT frame every interval, so a client which vanishes without leaving is
+noticed once misses intervals pass without hearing anything from it.
+
+Deadlines are kept in a hashed timing wheel: a ring of slots, one per tick,
+where a deadline goes in the slot of the tick it falls in. Scheduling is one
+dict insert, and each tick only looks at the deadlines in one slot, however
+many peers there are. Hearing from a peer only records the time; its deadline
+is moved on when it comes round, instead of on every frame.
+
+"""
+
+import math as _math
+import threading as _threading
+import time as _time
+
+
+class TimingWheel(object):
+
+    """Keys which expire after a delay, rounded up to the next tick. slots * tick is one turn of the
+    wheel; longer delays wait in their slot for the turns in between. Not thread safe on its own"""
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self._start = _time.monotonic()
+        self._current = 0  # The last tick expire() has got to
+        self._slots = [{} for i in range(slots)]  # key -> tick it expires at
+        self._where = {}  # key -> slot it's in
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def cancel(self, key):
+        """Stops key from expiring. Returns if it was scheduled"""
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+        self._where.clear()
+
+    def expire(self, now=None):
+        """Returns the keys whose time has come, and forgets them"""
+        now = _time.monotonic() if now is None else now
+        tick = int((now - self._start) / self.tick)
+        if tick <= self._current:
+            return []
+
+        expired = []
+        for i in range(max(self._current + 1, tick - self.slots + 1), tick + 1):  # Each slot once at most
+            slot = self._slots[i % self.slots]
+            for key, when in list(slot.items()):
+                if when <= tick:
+                    del slot[key]
+                    del self._where[key]
+                    expired.append(key)
+        self._current = tick
+        return expired
+
+    def schedule(self, key, delay, now=None):
+        """Expires key after delay seconds, replacing when it was going to"""
+        now = _time.monotonic() if now is None else now
+        self.cancel(key)
+        when = max(self._current + 1, int(_math.ceil((now + delay - self._start) / self.tick)))
+        slot = when % self.slots
+        self._slots[slot][key] = when
+        self._where[key] = slot
+
+
+class Heartbeats(object):
+
+    """Peers which are expected to be heard from every interval seconds, and expire after misses
+    intervals of silence. Peers are heard from on the reciving thread and expired on the reactor, so
+    the wheel is only changed with the lock held"""
+
+    def __init__(self, interval=1.0, misses=3, slots=512):
+        self.interval = interval
+        self.misses = misses
+        self.timeout = interval * misses
+        self.expired = 0  # Peers which have expired
+        self.wheel = TimingWheel(interval / 4.0, slots)  # So a peer expires within a quarter interval of its deadline
+        self._seen = {}  # addr -> time it was last heard from
+        self._lock = _threading.Lock()
+
+    def __contains__(self, addr):
+        return addr in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+            self.wheel.clear()
+
+    def expire(self, now=None):
+        """Returns the peers which haven't been heard from for timeout seconds, and forgets them"""
+        now = _time.monotonic() if now is None else now
+        dead = []
+        with self._lock:
+            for addr in self.wheel.expire(now):
+                last = self._seen.get(addr)
+                if last is None:
+                    continue
+                left = last + self.timeout - now
+                if left > 0:
+                    self.wheel.schedule(addr, left, now)  # Heard from since it was scheduled
+                else:
+                    del self._seen[addr]
+                    dead.append(addr)
+            self.expired += len(dead)
+        return dead
+
+    def forget(self, addr):
+        with self._lock:
+            if self._seen.pop(addr, None) is not None:
+                self.wheel.cancel(addr)
+
+    def seen(self, addr, now=None):
+        """Notes that addr was heard from"""
+        now = _time.monotonic() if now is None else now
+        with self._lock:
+            if not addr in self._seen:
+                self.wheel.schedule(addr, self.timeout, now)
+            self._seen[addr] = now
@@ -0,0 +1,189 @@
+"""
+pysocket.limits
+~~~~~~~~~~~~~~~
+
+Limits which stop one client from taking more than its share of a server.
+
+InboundLimits gives every sender token buckets for messages and bytes. A
+message which would overdraw either is dropped, or its sender disconnected,
+before it's decompressed or handled.
+
+SendQueues holds what's sent in a bounded queue per destination, which the
+reactor writes out without blocking, a few messages from each destination in
+turn. A peer which can't keep up only fills its own queue, and what happens
+when it's full is chosen with the policy, instead of every send (and every
+other client) waiting on it.
+
+"""
+
+import collections as _collections
+import threading as _threading
+import time as _time
+
+# Over-limit policies
+DROP = 'drop'  # Drop the new message
+DROP_OLDEST = 'drop_oldest'  # Drop the oldest queued message (send queues only)
+DISCONNECT = 'disconnect'  # Disconnect the client
+
+
+class InboundLimits(object):
+
+    """Token buckets per sender, refilled at messages (per second) and bytes (per second), holding
+    up to burst seconds of each. None leaves that one unlimited. Senders whose buckets are full are
+    forgotten once more than max_tracked are known, as a full bucket is the same as a new one"""
+
+    def __init__(self, messages=None, bytes=None, burst=1.0, policy=DROP, max_tracked=65536):
+        if not policy in (DROP, DISCONNECT):
+            raise ValueError("Unknown policy %r" % (policy,))
+
+        self.messages = messages
+        self.bytes = bytes
+        self.burst = burst
+        self.policy = policy
+        self.max_tracked = max_tracked
+        self.dropped = 0  # Messages over the limits
+        self.disconnected = 0  # Clients disconnected by DISCONNECT
+        self._max_messages = messages * burst if messages is not None else None
+        self._max_bytes = bytes * burst if bytes is not None else None
+        self._buckets = {}  # addr -> [message tokens, byte tokens, time of last refill]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _prune(self, now):
+        for addr, bucket in list(self._buckets.items()):
+            if self._refill(bucket, now):
+                del self._buckets[addr]
+
+    def _refill(self, bucket, now):
+        """Adds the tokens earned since the last refill. Returns if the buckets are full"""
+        elapsed = now - bucket[2]
+        bucket[2] = now
+        full = True
+        if self._max_messages is not None:
+            bucket[0] = min(self._max_messages, bucket[0] + elapsed * self.messages)
+            full = bucket[0] == self._max_messages
+        if self._max_bytes is not None:
+            bucket[1] = min(self._max_bytes, bucket[1] + elapsed * self.bytes)
+            full = full and bucket[1] == self._max_bytes
+        return full
+
+    def allow(self, addr, size, now=None):
+        """Takes one message and size bytes from addr's buckets. Returns False (and takes nothing) if
+        either doesn't have enough"""
+        now = _time.monotonic() if now is None else now
+        bucket = self._buckets.get(addr)
+        if bucket is None:
+            if len(self._buckets) >= self.max_tracked:
+                self._prune(now)
+            bucket = self._buckets[addr] = [self._max_messages, self._max_bytes, now]
+        else:
+            self._refill(bucket, now)
+
+        if (self._max_messages is not None and bucket[0] < 1) or (self._max_bytes is not None and bucket[1] < size):
+            self.dropped += 1
+            return False
+        if self._max_messages is not None:
+            bucket[0] -= 1
+        if self._max_bytes is not None:
+            bucket[1] -= size
+        return True
+
+    def forget(self, addr):
+        self._buckets.pop(addr, None)
+
+
+class SendQueues(object):
+
+    """Bounded queues of data waiting to be written, one per destination, each holding up to maxlen
+    messages and max_bytes bytes. None means unlimited"""
+
+    def __init__(self, maxlen=1000, max_bytes=4 * 1024 * 1024, policy=DROP_OLDEST, budget=64):
+        if not policy in (DROP, DROP_OLDEST, DISCONNECT):
+            raise ValueError("Unknown policy %r" % (policy,))
+
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.budget = budget  # Messages written to one destination before moving on to the next
+        self.dropped = 0  # Messages dropped by DROP and DROP_OLDEST
+        self.disconnected = 0  # Destinations disconnected by DISCONNECT
+        self._queues = {}  # addr -> deque of [data, bytes written]
+        self._bytes = _collections.Counter()  # addr -> bytes queued
+        self._lock = _threading.Lock()
+
+    def __len__(self):
+        """Number of messages queued, to every destination"""
+        return sum(len(queue) for queue in list(self._queues.values()))
+
+    def _full(self, addr, queue, size):
+        return ((self.maxlen is not None and len(queue) >= self.maxlen) or
+                (self.max_bytes is not None and self._bytes[addr] + size > self.max_bytes))
+
+    def clear(self):
+        with self._lock:
+            self._queues.clear()
+            self._bytes.clear()
+
+    def discard(self, addr):
+        """Drops everything queued to addr"""
+        with self._lock:
+            self._queues.pop(addr, None)
+            self._bytes.pop(addr, None)
+
+    def drain(self, write):
+        """Writes out what's queued with write(addr, data), which returns the number of bytes written and
+        raises BlockingIOError if the destination can't take any more now (or OSError if it's gone).
+        Returns if anything is left queued"""
+        with self._lock:
+            for addr in list(self._queues):
+                queue = self._queues[addr]
+                try:
+                    for i in range(self.budget):
+                        if not queue:
+                            break
+                        item = queue[0]
+                        sent = write(addr, memoryview(item[0])[item[1]:] if item[1] else item[0])
+                        item[1] += sent
+                        if item[1] < len(item[0]):
+                            break  # Short write, so the destination is full
+                        queue.popleft()
+                        self._bytes[addr] -= len(item[0])
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    queue.clear()  # Gone, so nothing more can be sent to it
+
+                if not queue:
+                    del self._queues[addr]
+                    del self._bytes[addr]
+            return bool(self._queues)
+
+    def put(self, addr, data):
+        """Queues data (bytes) to be written to addr. Returns False if the queue is full and the policy is
+        DISCONNECT, after dropping what was queued to addr"""
+        with self._lock:
+            queue = self._queues.get(addr)
+            if queue is None:
+                queue = self._queues[addr] = _collections.deque()
+
+            if self._full(addr, queue, len(data)):
+                if self.policy == DISCONNECT:
+                    self.disconnected += 1
+                    del self._queues[addr]
+                    self._bytes.pop(addr, None)
+                    return False
+                if self.policy == DROP_OLDEST:
+                    # The first message can't be dropped once part of it is written, or a stream would be corrupted
+                    first = 1 if queue and queue[0][1] else 0
+                    while len(queue) > first and self._full(addr, queue, len(data)):
+                        self._bytes[addr] -= len(queue[first][0])
+                        del queue[first]
+                        self.dropped += 1
+                if self._full(addr, queue, len(data)):
+                    self.dropped += 1
+                    return True
+
+            queue.append([data, 0])
+            self._bytes[addr] += len(data)
+            return True
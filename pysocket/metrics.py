@@ -0,0 +1,344 @@
+"""
+pysocket.metrics
+~~~~~~~~~~~~~~~~
+
+Counters and histograms kept by every socket, and exporters which publish
+them. Updating them on the hot path is a few integer additions (and a bisect,
+for the one message in every sample which is timed), without taking a lock, so
+counts can be out by a message when several threads send on one socket at once.
+
+    >>> server.stats()['messages_in']
+    >>> exporter = PrometheusServer(('127.0.0.1', 9100), {'game': server})
+
+"""
+
+import bisect as _bisect
+import collections as _collections
+import os as _os
+import socket as _socket
+import threading as _threading
+import time as _time
+
+from http.server import BaseHTTPRequestHandler as _BaseHTTPRequestHandler, HTTPServer as _HTTPServer
+
+from . import reactor as _reactor
+
+_perf_counter = _time.perf_counter
+
+LATENCY_BOUNDS = tuple(1e-6 * 2 ** i for i in range(24))  # 1us to about 8s
+COUNT_BOUNDS = tuple(2 ** i for i in range(11))  # 1 to 1024
+PACKET_BOUNDS = tuple(2 ** i for i in range(13))  # 1 to 4096, the most datagrams drained per wakeup
+
+
+class Histogram(object):
+
+    """Counts of observed values in fixed buckets. Bucket i counts values <= bounds[i],
+    and the last bucket counts values over every bound"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[_bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile, or None if nothing was observed"""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': list(zip(self.bounds + (float('inf'),), self.counts))}
+
+
+class Metrics(object):
+
+    """What one socket has done, since it was made. Latencies are timed for one message
+    in every sample (a power of two), to keep the cost per message down. Traffic is kept
+    for at most max_clients addresses, the longest kept going first, so spoofed or scanning
+    traffic can't make it grow without bound"""
+
+    def __init__(self, sample=8, max_clients=1024):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.frames_out = 0  # Messages (or batches of them) framed and sent...
+        self.datagrams_out = 0  # ...and the datagrams (or stream writes) they took
+        self.raw_bytes = 0  # Bytes given to the codecs...
+        self.encoded_bytes = 0  # ...and what they made of them
+        self.errors = _collections.Counter()  # Errors swallowed by _catch_exceptions, by errno (or class name)
+        self.send_seconds = Histogram()
+        self.recv_seconds = Histogram()
+        self.fragmented = Histogram(COUNT_BOUNDS)  # Datagrams per message, for messages which needed more than one
+        self.wakeups = 0  # Times the reactor drained the socket...
+        self.packets_per_wakeup = Histogram(PACKET_BOUNDS)  # ...datagrams each time
+        self.drain_depth = Histogram(COUNT_BOUNDS)  # ...and the recive syscalls it took
+        self.clients = {}  # (ip, port) -> [messages in, bytes in, messages out, bytes out]
+        self.max_clients = max_clients
+        self.clients_evicted = 0  # Addresses whose traffic was dropped to stay within max_clients
+        self.set_sample(sample)
+
+    def _framed(self, raw, encoded, datagrams):
+        self.raw_bytes += raw
+        self.encoded_bytes += encoded
+        self.frames_out += 1
+        self.datagrams_out += datagrams
+        if datagrams > 1:
+            self.fragmented.observe(datagrams)
+
+    def _traffic(self, addr):
+        """Returns the traffic counted for addr, starting it (and making room for it) if it's new"""
+        traffic = self.clients.get(addr)
+        if traffic is None:
+            while len(self.clients) >= self.max_clients:
+                try:
+                    self.clients.pop(next(iter(self.clients)), None)
+                except (RuntimeError, StopIteration):
+                    break  # Changed by another thread meanwhile
+                self.clients_evicted += 1
+            traffic = self.clients[addr] = [0, 0, 0, 0]
+        return traffic
+
+    def batched(self, raw, encoded, datagrams):
+        """Records a batch of coalesced messages (already counted by sent) being framed and sent"""
+        self._framed(raw, encoded, datagrams)
+
+    def broadcast(self, addrs, size, start, encoded, datagrams):
+        """Records one message, encoded once, sent to every address in addrs"""
+        self.messages_out += len(addrs)
+        self.bytes_out += size * len(addrs)
+        self._framed(size, encoded, datagrams)
+        self.send_seconds.observe(_perf_counter() - start)  # Rare enough to time every one
+        for addr in addrs:
+            traffic = self._traffic(addr)
+            traffic[2] += 1
+            traffic[3] += size
+
+    def drained(self, packets, depth):
+        """Records the reactor reciving packets datagrams with depth syscalls, on one readiness event"""
+        self.wakeups += 1
+        self.packets_per_wakeup.observe(packets)
+        self.drain_depth.observe(depth)
+
+    def encoded(self, raw, encoded):
+        self.raw_bytes += raw
+        self.encoded_bytes += encoded
+
+    def error(self, error):
+        if isinstance(error, _socket.timeout):
+            code = 'timeout'
+        elif error.args and isinstance(error.args[0], int):
+            code = error.args[0]
+        else:
+            code = error.__class__.__name__
+        self.errors[code] += 1
+
+    def forget(self, addr):
+        """Drops the traffic counted for a client which has gone"""
+        self.clients.pop(tuple(addr), None)
+
+    def recived(self, addr, size, start):
+        """Records a message of size bytes from addr. start is the perf_counter() when reciving started"""
+        self.messages_in += 1
+        self.bytes_in += size
+        if not self.messages_in & self._mask:
+            self.recv_seconds.observe(_perf_counter() - start)
+        traffic = self._traffic(addr)
+        traffic[0] += 1
+        traffic[1] += size
+
+    def sent(self, addr, size, start, encoded=None, datagrams=0):
+        """Records a message of size bytes to addr, encoded into encoded bytes and sent as datagrams
+        (left out if it was coalesced). start is the perf_counter() when sending started"""
+        self.messages_out += 1
+        self.bytes_out += size
+        if datagrams:
+            self.raw_bytes += size
+            self.encoded_bytes += encoded
+            self.frames_out += 1
+            self.datagrams_out += datagrams
+            if datagrams > 1:
+                self.fragmented.observe(datagrams)
+        if not self.messages_out & self._mask:
+            self.send_seconds.observe(_perf_counter() - start)
+        if addr is not None:
+            traffic = self._traffic(addr)
+            traffic[2] += 1
+            traffic[3] += size
+
+    def set_sample(self, sample):
+        """Times one message in every sample (rounded up to a power of two). 1 times them all"""
+        self.sample = 1
+        while self.sample < sample:
+            self.sample *= 2
+        self._mask = self.sample - 1
+
+    def snapshot(self):
+        # Messages sent in one datagram aren't observed one by one, so add them to the histogram here
+        datagrams = Histogram(COUNT_BOUNDS)
+        datagrams.counts = list(self.fragmented.counts)
+        datagrams.counts[0] = self.frames_out - self.fragmented.count
+        datagrams.count = self.frames_out
+        datagrams.sum = self.fragmented.sum + datagrams.counts[0]
+
+        return {'messages_in': self.messages_in, 'bytes_in': self.bytes_in,
+                'messages_out': self.messages_out, 'bytes_out': self.bytes_out,
+                'frames_out': self.frames_out, 'datagrams_out': self.datagrams_out,
+                'compression_ratio': self.encoded_bytes / float(self.raw_bytes) if self.raw_bytes else None,
+                'errors': dict(self.errors),
+                'send_seconds': self.send_seconds.snapshot(), 'recv_seconds': self.recv_seconds.snapshot(),
+                'datagrams_per_message': datagrams.snapshot(), 'wakeups': self.wakeups,
+                'packets_per_wakeup': self.packets_per_wakeup.snapshot(), 'drain_depth': self.drain_depth.snapshot(),
+                'clients_evicted': self.clients_evicted,
+                'clients': dict((addr, {'messages_in': traffic[0], 'bytes_in': traffic[1],
+                                        'messages_out': traffic[2], 'bytes_out': traffic[3]})
+                                for addr, traffic in list(self.clients.items()))}
+
+
+def _labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels) if labels else ''
+
+
+def prometheus(snapshots, prefix='pysocket', per_client=True):
+    """Returns {name: stats() snapshot} in the Prometheus text format"""
+    lines = []
+    seen = set()
+
+    def metric(name, kind, value, labels):
+        name = '%s_%s' % (prefix, name)
+        if not name in seen:
+            seen.add(name)
+            lines.append('# TYPE %s %s' % (name, kind))
+        if value is not None:
+            lines.append('%s%s %r' % (name, _labels(labels), value))
+
+    def histogram(name, snapshot, labels):
+        metric(name, 'histogram', None, labels)
+        cumulative = 0
+        for bound, count in snapshot['buckets']:
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_%s_bucket%s %d' % (prefix, name, _labels(labels + [('le', le)]), cumulative))
+        lines.append('%s_%s_sum%s %r' % (prefix, name, _labels(labels), snapshot['sum']))
+        lines.append('%s_%s_count%s %d' % (prefix, name, _labels(labels), snapshot['count']))
+
+    for source, stats in sorted(snapshots.items()):
+        labels = [('socket', source)]
+        for name in ('messages_in', 'bytes_in', 'messages_out', 'bytes_out', 'frames_out', 'datagrams_out', 'wakeups',
+                     'clients_evicted'):
+            metric(name + '_total', 'counter', stats[name], labels)
+        metric('compression_ratio', 'gauge', stats['compression_ratio'], labels)
+        for error, count in sorted(stats['errors'].items(), key=str):
+            metric('errors_total', 'counter', count, labels + [('error', error)])
+        for queue, depth in sorted(stats['queues'].items()):
+            metric('queue_depth', 'gauge', depth, labels + [('queue', queue)])
+        for buffer, count in sorted(stats['dropped'].items()):
+            metric('dropped_total', 'counter', count, labels + [('buffer', buffer)])
+        metric('clients', 'gauge', stats['connected_clients'], labels)
+        for name in ('send_seconds', 'recv_seconds', 'datagrams_per_message', 'packets_per_wakeup', 'drain_depth'):
+            histogram(name, stats[name], labels)
+        if per_client:
+            for addr, traffic in sorted(stats['clients'].items()):
+                client = labels + [('client', '%s:%s' % addr[:2])]
+                for name, value in sorted(traffic.items()):
+                    metric('client_%s_total' % name, 'counter', value, client)
+
+    return '\n'.join(lines) + '\n'
+
+
+class Exporter(object):
+
+    """Base class for exporters. sources is {name: socket}, or anything else with a stats() method.
+    Subclasses publish collect() however they like"""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def close(self):
+        pass
+
+    def collect(self):
+        """Returns {name: stats()} for every source"""
+        return dict((name, source.stats()) for name, source in list(self.sources.items()))
+
+
+class PrometheusFile(Exporter):
+
+    """Writes the stats of sources to path in the Prometheus text format (for node_exporter's
+    textfile collector) every interval seconds, from the reactor. Call write() to write now"""
+
+    def __init__(self, path, sources, interval=15.0, per_client=True):
+        Exporter.__init__(self, sources)
+        self.path = path
+        self.interval = interval
+        self.per_client = per_client
+        self._timer = None
+        if interval:
+            self._timer = _reactor.get_reactor().call_later(interval, self._tick)
+
+    def _tick(self):
+        try:
+            self.write()
+        finally:
+            self._timer = _reactor.get_reactor().call_later(self.interval, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def write(self):
+        """Writes the file, atomically so a scrape never sees half of it"""
+        temp = '%s.%d.tmp' % (self.path, _os.getpid())
+        with open(temp, 'w') as f:
+            f.write(prometheus(self.collect(), per_client=self.per_client))
+        _os.replace(temp, self.path)
+
+
+class PrometheusServer(Exporter):
+
+    """Serves the stats of sources in the Prometheus text format over HTTP on addr (any path)"""
+
+    def __init__(self, addr, sources, per_client=True):
+        Exporter.__init__(self, sources)
+        self.per_client = per_client
+        exporter = self
+
+        class Handler(_BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = prometheus(exporter.collect(), per_client=exporter.per_client).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Scrapes every few seconds would fill stderr
+
+        self._server = _HTTPServer(tuple(addr), Handler)
+        self.addr = self._server.server_address
+        self._thread = _threading.Thread(target=self._server.serve_forever, name='pysocket-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,242 @@
+"""
+pysocket.mmsg
+~~~~~~~~~~~~~
+
+Batched datagram syscalls. On Linux, sendmmsg is called through ctypes so one
+syscall sends a datagram to many addresses, and recvmmsg so one syscall
+recives every datagram waiting (up to a batch) into preallocated buffers;
+ctypes releases the GIL for the duration of the calls. Everywhere else (or if
+libc can't be loaded) the same APIs fall back to loops of sendto and
+recvfrom_into calls.
+
+"""
+
+import ctypes as _ctypes
+import ctypes.util as _ctypes_util
+import errno as _errno
+import select as _select
+import socket as _socket
+
+MAX_BATCH = 1024  # UIO_MAXIOV, the most messages the kernel takes in one call
+
+
+class iovec(_ctypes.Structure):
+    _fields_ = [('iov_base', _ctypes.c_void_p), ('iov_len', _ctypes.c_size_t)]
+
+
+class msghdr(_ctypes.Structure):
+    _fields_ = [('msg_name', _ctypes.c_void_p), ('msg_namelen', _ctypes.c_uint32),
+                ('msg_iov', _ctypes.POINTER(iovec)), ('msg_iovlen', _ctypes.c_size_t),
+                ('msg_control', _ctypes.c_void_p), ('msg_controllen', _ctypes.c_size_t),
+                ('msg_flags', _ctypes.c_int)]
+
+
+class mmsghdr(_ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', _ctypes.c_uint)]
+
+
+class timespec(_ctypes.Structure):
+    _fields_ = [('tv_sec', _ctypes.c_long), ('tv_nsec', _ctypes.c_long)]
+
+
+class sockaddr_storage(_ctypes.Structure):
+    _fields_ = [('ss_family', _ctypes.c_ushort), ('ss_data', _ctypes.c_ubyte * 126)]
+
+
+class sockaddr_in(_ctypes.Structure):
+    _fields_ = [('sin_family', _ctypes.c_ushort), ('sin_port', _ctypes.c_uint16),
+                ('sin_addr', _ctypes.c_ubyte * 4), ('sin_zero', _ctypes.c_ubyte * 8)]
+
+
+class sockaddr_in6(_ctypes.Structure):
+    _fields_ = [('sin6_family', _ctypes.c_ushort), ('sin6_port', _ctypes.c_uint16),
+                ('sin6_flowinfo', _ctypes.c_uint32), ('sin6_addr', _ctypes.c_ubyte * 16),
+                ('sin6_scope_id', _ctypes.c_uint32)]
+
+
+def _load_libc():
+    try:
+        libc = _ctypes.CDLL(_ctypes_util.find_library('c'), use_errno=True)
+        libc.sendmmsg.argtypes = [_ctypes.c_int, _ctypes.POINTER(mmsghdr), _ctypes.c_uint, _ctypes.c_int]
+        libc.sendmmsg.restype = _ctypes.c_int
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None  # Not Linux (or no sendmmsg in this libc)
+
+
+_libc = _load_libc()
+HAVE_SENDMMSG = _libc is not None
+HAVE_RECVMMSG = False
+if _libc is not None:
+    try:
+        _libc.recvmmsg.argtypes = [_ctypes.c_int, _ctypes.POINTER(mmsghdr), _ctypes.c_uint, _ctypes.c_int,
+                                   _ctypes.POINTER(timespec)]
+        _libc.recvmmsg.restype = _ctypes.c_int
+        HAVE_RECVMMSG = True
+    except AttributeError:
+        pass  # libc without recvmmsg
+
+# Errors which only mean one destination couldn't be reached, so the rest of the batch is still sent
+_SKIP_ERRORS = (_errno.ECONNREFUSED, _errno.EHOSTUNREACH, _errno.ENETUNREACH, _errno.EINVAL, _errno.EACCES)
+
+
+def _sockaddr(family, addr):
+    """Returns a ctypes sockaddr for a numeric (ip, port) address"""
+    ip = addr[0] or ('0.0.0.0' if family == _socket.AF_INET else '::')
+    if family == _socket.AF_INET6:
+        sockaddr = sockaddr_in6(_socket.AF_INET6, _socket.htons(addr[1]))
+        _ctypes.memmove(sockaddr.sin6_addr, _socket.inet_pton(_socket.AF_INET6, ip), 16)
+    else:
+        sockaddr = sockaddr_in(_socket.AF_INET, _socket.htons(addr[1]))
+        _ctypes.memmove(sockaddr.sin_addr, _socket.inet_pton(_socket.AF_INET, ip), 4)
+    return sockaddr
+
+
+def _address(sockaddr):
+    """Returns a ctypes sockaddr_storage as the address tuple socket.recvfrom would give"""
+    if sockaddr.ss_family == _socket.AF_INET6:
+        addr = sockaddr_in6.from_buffer(sockaddr)
+        return (_socket.inet_ntop(_socket.AF_INET6, bytes(addr.sin6_addr)), _socket.ntohs(addr.sin6_port),
+                addr.sin6_flowinfo, addr.sin6_scope_id)
+    addr = sockaddr_in.from_buffer(sockaddr)
+    return (_socket.inet_ntop(_socket.AF_INET, bytes(addr.sin_addr)), _socket.ntohs(addr.sin_port))
+
+
+class RecvBatch(object):
+
+    """Preallocated buffers for up to count datagrams of up to size bytes each. recv() fills as many as
+    are waiting, without blocking, and batch[i] is then (memoryview of datagram i, address). The views
+    are only valid until the next recv()"""
+
+    def __init__(self, count=32, size=65535):
+        self.count = count
+        self.size = size
+        self._buf = bytearray(count * size)
+        self._view = memoryview(self._buf)
+        self._lengths = [0] * count
+        self._addrs = [None] * count
+        self._msgs = None
+        self._poll = None
+
+        if HAVE_RECVMMSG:
+            self._names = (sockaddr_storage * count)()
+            self._iovs = (iovec * count)()
+            self._msgs = (mmsghdr * count)()
+            self._base = (_ctypes.c_char * len(self._buf)).from_buffer(self._buf)  # Keeps the address valid
+            base = _ctypes.addressof(self._base)
+            for i, msg in enumerate(self._msgs):
+                self._iovs[i].iov_base = base + i * size
+                self._iovs[i].iov_len = size
+                msg.msg_hdr.msg_name = _ctypes.addressof(self._names[i])
+                msg.msg_hdr.msg_iov = _ctypes.cast(_ctypes.addressof(self._iovs[i]), _ctypes.POINTER(iovec))
+                msg.msg_hdr.msg_iovlen = 1
+
+    def __getitem__(self, i):
+        start = i * self.size
+        return self._view[start:start + self._lengths[i]], self._addrs[i]
+
+    def _recvmmsg(self, sock):
+        for msg in self._msgs:
+            msg.msg_hdr.msg_namelen = _ctypes.sizeof(sockaddr_storage)  # The kernel overwrites it
+        fd = sock.fileno()
+        while True:
+            count = _libc.recvmmsg(fd, self._msgs, self.count, _socket.MSG_DONTWAIT, None)
+            if count >= 0:
+                break
+            error = _ctypes.get_errno()
+            if error == _errno.EINTR:
+                continue
+            elif error in (_errno.EAGAIN, _errno.EWOULDBLOCK):
+                return 0
+            raise OSError(error, _errno.errorcode.get(error, 'Unknown error'))
+
+        for i in range(count):
+            self._lengths[i] = self._msgs[i].msg_len
+            self._addrs[i] = _address(self._names[i])
+        return count
+
+    def recv(self, sock):
+        """Recives the datagrams waiting on sock, up to count. Returns how many were recived (0 if none were)"""
+        if self._msgs is not None and sock.family in (_socket.AF_INET, _socket.AF_INET6):
+            return self._recvmmsg(sock)
+
+        # A socket with a timeout would wait for data, so check there's some first
+        check = sock.gettimeout()
+        for i in range(self.count):
+            if check and not _select.select([sock], [], [], 0)[0]:
+                return i
+            start = i * self.size
+            try:
+                self._lengths[i], self._addrs[i] = sock.recvfrom_into(self._view[start:start + self.size], self.size,
+                                                                      getattr(_socket, 'MSG_DONTWAIT', 0))
+            except (BlockingIOError, InterruptedError):
+                return i
+        return self.count
+
+
+class SendBatch(object):
+
+    """Sends the same datagram to a fixed list of addresses. The message headers
+    are built once, and all of them point at one shared iovec, so sending a new
+    datagram to every address only changes that iovec"""
+
+    def __init__(self, family, addrs):
+        self.addrs = tuple(addrs)
+        self._family = family
+        self._msgs = None
+
+        if HAVE_SENDMMSG and family in (_socket.AF_INET, _socket.AF_INET6):
+            try:
+                self._names = [_sockaddr(family, addr) for addr in self.addrs]
+            except (OSError, ValueError, TypeError, IndexError):
+                return  # Not all numeric addresses, so fallback to sendto
+
+            self._iov = iovec()
+            self._msgs = (mmsghdr * len(self.addrs))()
+            for msg, name in zip(self._msgs, self._names):
+                msg.msg_hdr.msg_name = _ctypes.addressof(name)
+                msg.msg_hdr.msg_namelen = _ctypes.sizeof(name)
+                msg.msg_hdr.msg_iov = _ctypes.pointer(self._iov)
+                msg.msg_hdr.msg_iovlen = 1
+
+    def _sendmmsg(self, sock, data):
+        data = bytes(data)
+        self._iov.iov_base = _ctypes.cast(_ctypes.c_char_p(data), _ctypes.c_void_p)
+        self._iov.iov_len = len(data)
+        fd = sock.fileno()
+        sent = 0
+        size = _ctypes.sizeof(mmsghdr)
+
+        while sent < len(self.addrs):
+            count = _libc.sendmmsg(fd, _ctypes.cast(_ctypes.addressof(self._msgs) + sent * size, _ctypes.POINTER(mmsghdr)),
+                                   min(len(self.addrs) - sent, MAX_BATCH), 0)
+            if count >= 0:
+                sent += count
+                continue
+
+            error = _ctypes.get_errno()
+            if error == _errno.EINTR:
+                continue
+            elif error in (_errno.EAGAIN, _errno.EWOULDBLOCK):
+                # Send buffer is full, so wait until there's room
+                _select.select([], [sock], [], sock.gettimeout())
+            elif error in _SKIP_ERRORS:
+                sent += 1
+            else:
+                raise OSError(error, _errno.errorcode.get(error, 'Unknown error'))
+        return sent
+
+    def send(self, sock, data):
+        """Sends data to every address. Returns how many datagrams were sent"""
+        if self._msgs is not None:
+            return self._sendmmsg(sock, data)
+
+        sent = 0
+        for addr in self.addrs:
+            try:
+                sock.sendto(data, addr)
+                sent += 1
+            except OSError as error:
+                if not error.errno in _SKIP_ERRORS + (_errno.EAGAIN,):
+                    raise
+        return sent
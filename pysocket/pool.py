@@ -0,0 +1,212 @@
+"""
+pysocket.pool
+~~~~~~~~~~~~~
+
+Keeps connected Clients to each server address, so code making many short
+requests doesn't pay for binding a socket and the connect handshake every
+time. Clients are checked out, used by one caller at a time and checked back
+in. They're health checked before being handed out again, and ones which fail
+the check, or sit idle for longer than idle_timeout, are evicted with
+Client.quit (which tells the server they're leaving).
+
+"""
+
+import collections as _collections
+import socket as _socket
+import threading as _threading
+import time as _time
+
+from . import reactor as _reactor
+from .pysocket import Client, SocketError
+
+
+class ClientPool(object):
+
+    """Up to max_size Clients per server address.
+
+    health_check(client), if given, is called (as well as the built-in check that the
+    client is still connected) before an idle client is reused, and should return if it
+    can be. factory(server) makes a new connected client, by default a Client over type"""
+
+    def __init__(self, max_size=8, idle_timeout=60.0, health_check=None, factory=None,
+                 type=_socket.SOCK_DGRAM, timeout=0.5):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.evicted = 0
+        self._health_check = health_check
+        self._factory = factory or (lambda server: Client(('0.0.0.0', 0), server, timeout, type))
+        self._idle = {}  # server -> deque of (client, time checked in), most recently used last
+        self._out = {}  # client -> server, for checked out clients
+        self._sizes = _collections.Counter()  # server -> clients idle, checked out or being made
+        self._cond = _threading.Condition()
+        self._timer = None
+        self._closed = False
+
+    def __len__(self):
+        """Number of clients in the pool, idle or checked out"""
+        return sum(self._sizes.values())
+
+    def _arm(self):
+        """Starts the idle timer for when the longest idle client expires. Call with the lock held"""
+        if self._timer is not None or self.idle_timeout is None:
+            return
+        oldest = [idle[0][1] for idle in self._idle.values() if idle]
+        if oldest:
+            delay = max(min(oldest) + self.idle_timeout - _time.monotonic(), 0)
+            self._timer = _reactor.get_reactor().call_later(delay, self._reap)
+
+    def _evict(self, client):
+        """Disconnects a client from its server. Call without the lock held"""
+        self.evicted += 1
+        try:
+            client.quit()
+        except Exception:
+            pass  # Already gone
+
+    def _healthy(self, client):
+        if not client._connected or client._socket.fileno() == -1:
+            return False  # Disconnected by the server, or closed
+        if client._is_stream() and not client._peer in client._conns:
+            return False  # The stream has ended
+        if self._health_check is not None:
+            try:
+                return bool(self._health_check(client))
+            except Exception:
+                return False
+        return True
+
+    def _make(self, server):
+        """Makes a new client for server, which has already been counted in _sizes"""
+        try:
+            client = self._factory(server)
+        except Exception:
+            with self._cond:
+                self._sizes[server] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+            self._out[client] = server
+        return client
+
+    def _reap(self):
+        """Evicts clients which have been idle for idle_timeout. Runs on the reactor"""
+        expired = []
+        with self._cond:
+            self._timer = None
+            now = _time.monotonic()
+            for server, idle in self._idle.items():
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    expired.append(idle.popleft()[0])
+                    self._sizes[server] -= 1
+            if expired:
+                self._cond.notify_all()
+            self._arm()
+
+        for client in expired:
+            self._evict(client)
+
+    def checkin(self, client, discard=False):
+        """Gives a client back to the pool. If discard is true (or it fails the health check), it's evicted"""
+        with self._cond:
+            if not client in self._out:
+                raise ValueError("%r was not checked out of this pool" % (client,))
+        healthy = not discard and self._healthy(client)
+
+        with self._cond:
+            server = self._out.pop(client)
+            if healthy and not self._closed:
+                self._idle.setdefault(server, _collections.deque()).append((client, _time.monotonic()))
+                self._arm()
+            else:
+                self._sizes[server] -= 1
+                healthy = False
+            self._cond.notify()
+
+        if not healthy:
+            self._evict(client)
+
+    def checkout(self, server, timeout=None):
+        """Returns a connected client for server, reusing an idle one if there is one. If max_size are
+        already checked out, waits up to timeout seconds (forever if None) for one to be checked in"""
+        server = tuple(server)
+        deadline = None if timeout is None else _time.monotonic() + timeout
+
+        while True:
+            client = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise SocketError("Pool is closed")
+                    if self._idle.get(server):
+                        client, since = self._idle[server].pop()  # The most recently used, so the least likely to have broken
+                        self._out[client] = server
+                        break
+                    if self._sizes[server] < self.max_size:
+                        self._sizes[server] += 1  # Keep the place while the client is made
+                        break
+
+                    remaining = None if deadline is None else deadline - _time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise SocketError("No client for %r was checked in within %s seconds" % (server, timeout))
+                    self._cond.wait(remaining)
+
+            if client is None:
+                return self._make(server)
+            if self._healthy(client):
+                return client
+
+            # Broken while it was idle, so evict it and try again
+            with self._cond:
+                del self._out[client]
+                self._sizes[server] -= 1
+            self._evict(client)
+
+    def close(self):
+        """Evicts every idle client. Clients checked out are evicted when they're checked in"""
+        with self._cond:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            idle = []
+            for server, clients in self._idle.items():
+                idle.extend(client for client, since in clients)
+                self._sizes[server] -= len(clients)
+            self._idle.clear()
+            self._cond.notify_all()
+
+        for client in idle:
+            self._evict(client)
+
+    def connection(self, server, timeout=None):
+        """Context manager which checks a client out, and back in at the end. If the block
+        raises an exception, the client is evicted instead, in case it's left in a bad state"""
+        return _Connection(self, server, timeout)
+
+    def warm(self, server, count=1):
+        """Connects clients to server until count are idle (or the pool for server is full)"""
+        server = tuple(server)
+        while True:
+            with self._cond:
+                if self._closed or len(self._idle.get(server, ())) >= count or self._sizes[server] >= self.max_size:
+                    return
+                self._sizes[server] += 1
+            self.checkin(self._make(server))
+
+
+class _Connection(object):
+
+    def __init__(self, pool, server, timeout):
+        self._pool = pool
+        self._server = server
+        self._timeout = timeout
+        self._client = None
+
+    def __enter__(self):
+        self._client = self._pool.checkout(self._server, self._timeout)
+        return self._client
+
+    def __exit__(self, type, value, traceback):
+        self._pool.checkin(self._client, discard=type is not None)
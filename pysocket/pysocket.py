@@ -1,42 +1,121 @@
 import socket as _socket
+import collections as _collections
+import selectors as _selectors
 import zlib as _zlib
 import time as _time
 import sys as _sys
 import threading as _threading
+import random as _random
+import signal as _signal
+import pickle as _pickle
+import traceback as _traceback
+
+from . import buffers as _buffers
+from . import compression as _compression
+from . import dispatch as _dispatch
+from . import frame as _frame
+from . import heartbeat as _heartbeat
+from . import limits as _limits
+from . import metrics as _metrics
+from . import mmsg as _mmsg
+from . import reactor as _reactor
+from . import serialization as _serialization
+from . import stream as _stream
+from . import topics as _topics
+from . import transfer as _transfer
+from . import tracing as _tracing
+from . import registry as _registry
+from . import reliable as _reliable
+from . import workers as _workers
+
+
+_MSG_DONTWAIT = getattr(_socket, 'MSG_DONTWAIT', 0)
+_MAX_DRAIN = 4096  # Datagrams recived per readiness event, so one busy socket can't starve the others
+_MAX_ACCEPT = 1024  # Connections accepted per readiness event, for the same reason
+_LIMITED = (_frame.DATA, _frame.BATCH, _frame.OBJECT, _frame.PUBLISH, _frame.SUBSCRIBE, _frame.UNSUBSCRIBE)
 
 
 class SocketError(Exception):
     pass
 
 
+class _Loaded(object):
+
+    """An object _recv_frame deserialized, and the size of its serialized form"""
+
+    __slots__ = ('obj', 'size')
+
+    def __init__(self, obj, size):
+        self.obj = obj
+        self.size = size
+
+
 class socket():
 
     """Base class which replaces socket.socket"""
     
-    def __init__(self, family=2, type=2, proto=0, _sock=None, ip=None, port=None, timeout=0.5, thread=False):
-        """Makes a new socket"""
-        self._always_accept = False
+    def __init__(self, family=2, type=2, proto=0, _sock=None, ip=None, port=None, timeout=0.5, thread=False, legacy=False):
+        """Makes a new socket. If legacy is true, the old (pre-frame) protocol is used"""
         self._socket = _socket.socket(family, type, proto, _sock)
         self._socket_fam = family
         self._socket_type = type
         self._socket_proto = proto
         self._socket_sock = _sock
-        self._blocked = []
-        self._clients = []
+        self._blocked = _registry.Blocklist()
+        self._clients = _registry.ClientRegistry()
         self._is_server = False
         self._max_recv = 65535
-        self._max_send = 65535
+        self._max_send = 65507  # Largest UDP payload over IPv4
         self._binded = False
         self._connected = False
         self._timeout = timeout
         self._packets = {'disconnect': '*<disconnect>*', '-disconnect-': '*<-disconnect->*',
                          'sending': '*<sending data>*', 'sent': '*<sent data>*', 'connect': '*<-connect->*'}
-        self._timers = []
+        self._watching = None  # The socket object the reactor is watching for us
         self._stop_recv = False
         self._recv_started = False
-        self._threaded_recvs = []
+        self._threaded_recvs = _buffers.RingBuffer(10000, 64 * 1024 * 1024)
         self._thread = thread
-        self._history = []
+        self._history = _buffers.RingBuffer(1000, 16 * 1024 * 1024)
+        self._legacy = legacy
+        self._sender_id = _random.getrandbits(32)
+        self._seq = 0
+        self._codec = _compression.get(_compression.ZLIB)
+        self._compress_threshold = 128  # Payloads smaller than this are sent raw
+        self._peer_codecs = {}
+        self._peer = None
+        self._buffers = _buffers.BufferPool(self._max_recv)
+        self._reassembler = _frame.Reassembler()
+        self._broadcast_batch = None  # mmsg.SendBatch for the last set of addresses broadcast to
+        self._dispatcher = None  # dispatch.Dispatcher which runs callbacks, or None to run them inline
+        self._reuse_port = False  # Set SO_REUSEPORT before binding
+        self._listening = False  # If the socket is listening (so it doesn't block, and connections are accepted)
+        self._conns = {}  # (ip, port) -> stream.Connection, for stream sockets
+        self._selector = None  # Selector over the listening socket and _conns, for stream sockets
+        self._ready = _collections.deque()  # (ip, frame) parsed from streams, or put back in order, but not handled yet
+        self._watch_callback = None  # Callback the reactor calls for each connection, for stream sockets
+        self._reliable = False  # Send datagrams with reliable delivery
+        self._reliability = _reliable.Reliability(self._transmit)
+        self._coalesce = None  # (delay, max_bytes) when small sends are coalesced into BATCH frames
+        self._coalesced = {}  # addr (None for the peer) -> [messages, bytes], waiting to be flushed
+        self._coalesce_timer = None
+        self._coalesce_lock = _threading.RLock()
+        self._metrics = _metrics.Metrics()
+        self._tracer = None  # tracing.Tracer, when messages are traced
+        self._recv_trace = None  # Trace of the message _recv_frame just returned
+        self._sent_seq = 0  # Sequence number of the last frame made
+        self._serializer = _serialization.get(_serialization.STRUCT)  # Used by send_obj
+        self._allowed_serializers = set(id for id in _serialization.available() if _serialization.get(id).safe)
+        self._topics = _topics.TopicIndex()  # Topics the clients are subscribed to
+        self._recv_topic = None  # Topic of the message _recv_frame just returned, if it was published to one
+        self._inbound_limits = None  # limits.InboundLimits on what each sender may send us
+        self._send_queues = None  # limits.SendQueues, when sends are queued and written out by the reactor
+        self._drain_scheduled = False  # If the reactor is going to drain _send_queues
+        self._file_writer = None  # transfer.FileWriter recv_file is writing to
+        self._recv_batch_size = 32  # Datagrams recived per syscall on the reactor (0 recives one per event)
+        self._recv_batch = None  # mmsg.RecvBatch, made when the reactor first drains the socket
+        self._heartbeats = None  # heartbeat.Heartbeats of the clients, when quiet ones are removed
+        self._heartbeat_timer = None  # Reactor timer which sends heartbeats (clients) or expires clients (servers)
 
         # Set socket timeout and options
         self._socket.settimeout(self._timeout)
@@ -49,8 +128,22 @@ class socket():
 
     def __reinit__(self):
         """Re-inits the socket. Good for when we want to start from fresh"""
+        self._unwatch()
+        self._close_conns()
+        self._reliability.close()
+        self._stop_heartbeat()
+        with self._coalesce_lock:
+            self._coalesced.clear()
+            if self._coalesce_timer is not None:
+                self._coalesce_timer.cancel()
+                self._coalesce_timer = None
+        if self._send_queues is not None:
+            self._send_queues.drain(self._write_queued)  # Best effort, as the socket is about to close
+            self._send_queues.clear()
         self._socket.close()
         self._socket = _socket.socket(self._socket_fam, self._socket_type, self._socket_proto, self._socket_sock)
+        self._sender_id = _random.getrandbits(32)  # So peers don't take the new sequence for old frames
+        self._seq = 0
 
         # Update now-changed values
         self._is_server = False
@@ -60,9 +153,125 @@ class socket():
         # Set socket timeout and options
         self._socket.settimeout(self._timeout)
         self._socket.setsockopt(1, 6, 1)
+        if self._reuse_port:
+            self._socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEPORT, 1)
+        if self._socket_type == _socket.SOCK_STREAM:
+            self._socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)  # Don't wait for TIME_WAIT to rebind
+
+    def _accept_conns(self):
+        """Accepts every connection waiting on the listening socket (up to _MAX_ACCEPT). Returns their addresses"""
+        accepted = []
+        while len(accepted) < _MAX_ACCEPT:
+            try:
+                sock, addr = self._socket.accept()
+            except (BlockingIOError, InterruptedError, _socket.timeout):
+                break  # The backlog is empty
+            except OSError as error:
+                self._catch_exceptions(error)  # Like running out of file descriptors, which leaves the rest waiting
+                break
+            if addr[0] in self._blocked:
+                sock.close()
+                continue
+            self._accepted(sock, addr)
+            accepted.append(addr)
+        return accepted
+
+    def _accept_datagram(self, ip, frame):
+        """Handles ACKs and reliable frames as they arrive. Returns if frame is left for _recv_frame to handle
+        (otherwise, whatever it put in order is in _ready)"""
+        if frame.opcode == _frame.ACK:
+            self._reliability.ack(ip, frame.payload)
+            return False
+
+        if frame.flags & _frame.FLAG_RELIABLE:
+            # ACK it, and handle whatever is now in order (which may be nothing, or many frames)
+            ready, ack = self._reliability.receive(ip, frame._replace(payload=bytes(frame.payload)))
+            self._transmit(_frame.pack(_frame.ACK, ack, sender=self._sender_id, seq=self._next_seq()), ip)  # Never queued
+            self._ready.extend((ip, frame) for frame in ready)
+            return False
+        return True
+
+    def _accepted(self, sock, addr, receive=True):
+        """Adds an accepted connection to the client registry, and passes it to onAccept. If receive is true (and
+        the socket is framed), its frames are recived along with the other connections"""
+        sock.settimeout(self._timeout)
+        conn = _stream.Connection(sock, addr)
+        if receive and self._is_stream():
+            self._add_conn(conn)
+        self._clients.add(conn.addr, conn)
+        self._dispatch_hook(self.onAccept, conn, conn.addr)
+        return conn
+
+    def _add_conn(self, conn):
+        """Starts reciving frames from a stream connection"""
+        self._conns[conn.addr] = conn
+        self._stream_selector().register(conn.sock, _selectors.EVENT_READ, conn)
+        if self._watch_callback is not None and conn.sock is not self._socket:
+            _reactor.get_reactor().register(conn.sock, self._watch_callback)
+
+    def _broadcast(self, data, addrs, opcode=_frame.DATA):
+        """Sends data to every address in addrs, encoding and framing it only once"""
+        if self._legacy:
+            for addr in addrs:
+                self.sendto(data, addr)
+            return
+
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'latin-1')
+        self.flush()  # Keep it behind anything coalesced before it
+        start = _time.perf_counter()
+        trace = self._trace('broadcast', None)
+
+        # Only use the socket's codec if every recipient has it
+        addrs = tuple(addrs)
+        codec = self._codec
+        for addr in addrs:
+            codec = _compression.for_peer(codec, self._peer_codecs.get(addr, ()))
+
+        payload, used = _compression.encode(data, codec, self._compress_threshold)
+        flags = _frame.FLAG_COMPRESSED if used != _compression.NONE else 0
+        if trace is not None:
+            trace.mark('compress')
+
+        count = 0
+        if self._reliable and not self._is_stream():
+            # Every peer has its own sequence numbers, so only the payload can be shared
+            for addr in addrs:
+                count = self._send_reliable(addr, opcode, payload, flags, used)
+        elif self._is_stream():
+            # Streams can't share a syscall, but the frame is still only encoded once
+            for buffers in self._frames(opcode, payload, flags, used):
+                count += 1
+                for addr in addrs:
+                    if addr in self._conns:
+                        self._sendmsg(buffers, addr)
+        elif self._send_queues is not None:
+            for buffers in self._frames(opcode, payload, flags, used):
+                count += 1
+                datagram = b''.join(buffers)
+                for addr in addrs:
+                    self._queue_send(datagram, addr)
+        else:
+            if self._broadcast_batch is None or self._broadcast_batch.addrs != addrs:
+                self._broadcast_batch = _mmsg.SendBatch(self._socket_fam, addrs)
+
+            for buffers in self._frames(opcode, payload, flags, used):
+                count += 1
+                try:
+                    self._broadcast_batch.send(self._socket, b''.join(buffers))
+                except Exception as error:
+                    self._catch_exceptions(error)
+
+        self._metrics.broadcast(addrs, len(data), start, len(payload), count)
+        if trace is not None:
+            trace.mark('send')
+            trace.size = len(data)
+            trace.args['recipients'] = len(addrs)
+            self._finish_trace(trace)
 
     def _catch_exceptions(self, error):
         """Shortcut so we don't have to paste the below code everywhere"""
+        self._metrics.error(error)
         if error.args[0] is "timed out":
             pass  # "Timed out" is not a real exception, so we can just leave this out
         elif error.args[0] is 22:
@@ -74,23 +283,577 @@ class socket():
         elif error.args[0] is 111:
             pass  # "Connection refused" is also not a real exception
 
+    def _close_conn(self, addr):
+        """Stops reciving from a stream connection and closes it"""
+        conn = self._conns.pop(tuple(addr), None)
+        if conn is None:
+            return
+        if self._selector is not None:
+            self._selector.unregister(conn.sock)
+        if conn.sock is not self._socket:
+            _reactor.get_reactor().unregister(conn.sock)
+            conn.close()
+
+    def _close_conns(self):
+        """Closes every stream connection, e.g. before the socket is remade"""
+        for addr in list(self._conns):
+            self._close_conn(addr)
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        self._ready.clear()
+        self._listening = False
+
+    def _coalesce_add(self, data, addr):
+        """Buffers data to be sent to addr in the next BATCH frame. Returns False if it's too big to coalesce"""
+        delay, max_bytes = self._coalesce
+        size = _frame.BATCH_LENGTH.size + len(data)
+        key = tuple(addr) if addr else None
+
+        with self._coalesce_lock:
+            pending = self._coalesced.get(key)
+            if size > max_bytes:
+                # Sent on its own, but still after the messages buffered before it
+                if pending is not None:
+                    self._flush(key)
+                return False
+
+            if pending is not None and pending[1] + size > max_bytes:
+                self._flush(key)  # The datagram is full
+                pending = None
+            if pending is None:
+                pending = self._coalesced[key] = [[], 0]
+            pending[0].append(bytes(data))  # The caller may reuse its buffer once send returns
+            pending[1] += size
+
+            if self._coalesce_timer is None:
+                self._coalesce_timer = _reactor.get_reactor().call_later(delay, self._flush_timer)
+        return True
+
+    def _codec_for(self, addr):
+        """Returns the codec to use for data sent to addr"""
+        return _compression.for_peer(self._codec, self._peer_codecs.get(addr, ()))
+
     def _compress(self, string, level=6):
+        """Double zlib compression, as used by the old (pre-frame) protocol"""
         # py2k
         if _sys.version_info[0] is 2:
             return bytearray(_zlib.compress(_zlib.compress(string, level), level))
         
         # py3k
         data = bytes(string, 'latin-1')
-        return bytearray(_zlib.compress(_zlib.compress(data, level), level))
+        compressed = bytearray(_zlib.compress(_zlib.compress(data, level), level))
+        self._metrics.encoded(len(data), len(compressed))
+        return compressed
+
+    def _conn_client(self, ip):
+        """Adds a client to the self._clients registry, unless its ip is blocked"""
+        if ip[0] in self._blocked:
+            return ''
+        self._dispatch_hook(self.onConnect, ip, ip)
+        self._clients.add(ip, self._clients.value(ip))  # Keeps the connection of a stream client
+        if self._heartbeats is not None:
+            self._heartbeats.seen(tuple(ip))
+        return ''
 
     def _decompress(self, string, level=6):
+        """Reverses _compress"""
         # py2k
         if _sys.version_info[0] is 2:
             return _zlib.decompress(_zlib.decompress(buffer(string)))
         
         # py3k
         return _zlib.decompress(_zlib.decompress(string)).decode('latin-1')
-    
+
+    def _dispatch(self, func, *args, **kwargs):
+        """Runs a user callback on the dispatcher if one is set, otherwise straight away.
+        If trace= is given, the trace's dispatch stage ends (and it's finished) when the callback returns"""
+        trace = kwargs.pop('trace', None)
+        if trace is not None:
+            if self._dispatcher is not None and self._dispatcher.processes:
+                self._finish_trace(trace)  # A wrapped callback can't be pickled for another process
+            else:
+                func = self._traced(func, trace)
+
+        if self._dispatcher is not None:
+            if not self._dispatcher.submit(func, *args, **kwargs):
+                if trace is not None:
+                    trace.args['rejected'] = True
+                    self._finish_trace(trace)
+                return False
+            return True
+        func(*args)
+        return True
+
+    def _dispatch_hook(self, hook, arg, key):
+        """Runs onAccept, onConnect or onDisconnect like _dispatch, but always on a thread, as a method of the
+        socket can't be pickled for a process dispatcher"""
+        if self._dispatcher is not None:
+            return self._dispatcher.submit(hook, arg, key=key, process=False)
+        hook(arg)
+        return True
+
+    def _drain_datagrams(self, callback, mask):
+        """Recives every datagram waiting (up to _MAX_DRAIN) a batch per syscall, and has callback handle each
+        batch before the buffers are reused. Runs on the reactor when the socket is readable"""
+        batch = self._recv_batch
+        if batch is None or batch.count != self._recv_batch_size:
+            batch = self._recv_batch = _mmsg.RecvBatch(self._recv_batch_size, self._max_recv)
+
+        sock = self._socket
+        packets = depth = 0
+        while packets < _MAX_DRAIN and self._watching is sock:  # Stops if the socket is unwatched (or closed) meanwhile
+            try:
+                count = batch.recv(sock)
+            except Exception as error:
+                self._catch_exceptions(error)
+                break
+            depth += 1
+            if not count:
+                break
+            packets += count
+
+            for i in range(count):
+                view, ip = batch[i]
+                try:
+                    frame = _frame.unpack(view)
+                    if frame is None:
+                        self._ready.append((None, bytes(view)))
+                    elif self._accept_datagram(ip, frame):
+                        self._ready.append((ip, frame))  # Its payload is a view of the batch, so handle it before the next recv
+                except Exception as error:
+                    self._metrics.error(error)  # Only this datagram is bad, so skip it and keep the rest of the batch
+            while self._ready and self._watching is sock:
+                try:
+                    callback(mask)
+                except Exception as error:
+                    self._metrics.error(error)
+                    _traceback.print_exc()  # As the reactor would, but without losing the rest of the batch
+
+            if count < batch.count:
+                break  # Fewer than a batch, so the socket has been drained (without a syscall to find out)
+        self._metrics.drained(packets, depth)
+
+    def _drain_sends(self):
+        """Writes out what's queued to send. Runs on the reactor"""
+        self._drain_scheduled = False
+        queues = self._send_queues
+        if queues is not None and queues.drain(self._write_queued):
+            # Some destination can't take any more yet, so try again shortly
+            self._drain_scheduled = True
+            _reactor.get_reactor().call_later(0.001, self._drain_sends)
+
+    def _encode(self, data, addr=None):
+        """Turns data into a frame payload for addr. Returns (payload, flags, codec id)"""
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'latin-1')
+
+        payload, codec = _compression.encode(data, self._codec_for(addr), self._compress_threshold)
+        return payload, _frame.FLAG_COMPRESSED if codec != _compression.NONE else 0, codec
+
+    def _finish_trace(self, trace):
+        tracer = self._tracer
+        if tracer is not None:
+            tracer.finish(trace)
+
+    def _flush(self, key):
+        """Sends the messages buffered for key (an address, or None for the peer). Call with _coalesce_lock held"""
+        messages = self._coalesced.pop(key)[0]
+        if len(messages) == 1:
+            opcode, data = _frame.DATA, messages[0]  # Nothing to share the frame with
+        else:
+            opcode, data = _frame.BATCH, _frame.pack_batch(messages)
+
+        payload, flags, codec = self._encode(data, key or self._peer)
+        self._metrics.batched(len(data), len(payload), self._send_frames(opcode, payload, flags, key, codec))
+
+    def _flush_timer(self):
+        """Flushes when the coalescing delay is up. Runs on the reactor"""
+        with self._coalesce_lock:
+            self._coalesce_timer = None
+        try:
+            self.flush()
+        except Exception as error:
+            self._catch_exceptions(error)
+
+    def _forget_limits(self, addr):
+        """Drops the inbound budget and send queue of a client which has gone"""
+        if self._inbound_limits is not None:
+            self._inbound_limits.forget(tuple(addr))
+        if self._send_queues is not None:
+            self._send_queues.discard(tuple(addr))
+
+    def _frames(self, opcode, payload, flags, codec=_compression.NONE, seq=None):
+        """Yields the buffers of each datagram needed to send payload (a bytes-like object, or a list
+        of them which are sent without being joined). seq() numbers the frames if given"""
+        seq = seq or self._next_seq
+        size = self._max_send - _frame.HEADER.size
+        buffers = payload if isinstance(payload, list) else None
+        length = len(payload) if buffers is None else sum(len(buf) for buf in buffers)
+
+        if length <= size or self._is_stream():  # Streams have no datagram size limit
+            self._sent_seq = seq()
+            header = _frame.header(opcode, length, flags, self._sender_id, self._sent_seq, codec)
+            yield [header, payload] if buffers is None else [header] + buffers
+            return
+
+        flags |= _frame.FLAG_FRAGMENT
+        msg_id = self._next_seq()
+        if buffers is not None:
+            for fragment, chunks in _frame.fragment_buffers(buffers, size, msg_id):
+                self._sent_seq = seq()
+                length = len(fragment) + sum(len(chunk) for chunk in chunks)
+                yield [_frame.header(opcode, length, flags, self._sender_id, self._sent_seq, codec), fragment] + chunks
+            return
+
+        for fragment, chunk in _frame.fragments(payload, size, msg_id):
+            self._sent_seq = seq()
+            header = _frame.header(opcode, len(fragment) + len(chunk), flags, self._sender_id, self._sent_seq, codec)
+            yield [header, fragment, chunk]
+
+    def _is_stream(self):
+        """Returns if the socket sends frames over a stream (like TCP) rather than as datagrams"""
+        return self._socket_type == _socket.SOCK_STREAM and not self._legacy
+
+    def _loads(self, serializer, payload):
+        """Deserializes the payload of an OBJECT frame, if objects from that serializer are allowed"""
+        if not serializer in self._allowed_serializers:
+            raise SocketError("Recived an object from serializer %d, which isn't allowed" % serializer)
+        if not isinstance(payload, bytes):
+            payload = bytes(payload)  # It's a view of a reused buffer, and the object may keep views of it
+        return _Loaded(_serialization.get(serializer).loads(memoryview(payload)), len(payload))
+
+    def _next_seq(self):
+        """Returns the sequence number for the next outgoing frame"""
+        self._seq = (self._seq + 1) & 0xffffffff
+        return self._seq
+
+    def _publish(self, topic, data, publisher=None):
+        """Sends data to the clients subscribed to topic, except publisher. Returns how many it was sent to"""
+        addrs = [addr for addr in self._topics.match(topic) if addr != publisher]
+        if addrs:
+            self._broadcast(_frame.pack_publish(topic, data), addrs, _frame.PUBLISH)
+        return len(addrs)
+
+    def _queue_send(self, data, addr):
+        """Queues data to be written to addr (or the peer) by the reactor"""
+        addr = tuple(addr) if addr else self._peer
+        if not self._send_queues.put(addr, data):
+            # Its queue is full, and the policy is to disconnect it. The DISCONNECT is queued like anything else
+            self.disconnect_client(addr[0], addr[1])
+        if not self._drain_scheduled:
+            # Set first, as the reactor may drain (and clear it) before call_soon returns
+            self._drain_scheduled = True
+            _reactor.get_reactor().call_soon(self._drain_sends)
+
+    def _recv(self, buffersize, _ip, _isthread, text, _keep_trace=False, _into=None):
+        """Shared body of recv and recv_bytes. If text is true, data is returned as a str.
+        If _keep_trace is true, the message's trace is left in _recv_trace for the caller to finish.
+        If _into (a writable byte memoryview) is given, a plain message is copied straight into it, and the
+        number of bytes written is returned instead of the data"""
+
+        if not buffersize:
+            buffersize = self._max_recv
+
+        if self._binded:
+            try:
+                start = _time.perf_counter()
+                size = None
+                if self._legacy:
+                    ip, data = self._recv_legacy(buffersize)
+                    if not text and not isinstance(data, bytes):
+                        data = bytes(data, 'latin-1')
+                    self._recv_trace = self._trace('recv', ip, start) if ip is not None and data else None
+                    if self._recv_trace is not None:
+                        self._recv_trace.mark('receive')  # Decompressing is part of reciving in the old protocol
+                else:
+                    ip, data = self._recv_frame(buffersize, not _isthread, _into)
+                    if data.__class__ is _Loaded:
+                        size, data = data.size, data.obj  # Recived with send_obj
+                    elif data.__class__ is int:
+                        size, data = data, None  # Already in _into, so there's no copy for the history
+                    elif text and ip is not None:
+                        data = data.decode('latin-1')
+
+                if ip is None:
+                    # Not sent by a pysocket socket, so return it untouched
+                    return data
+
+                if size is None:
+                    size = len(data)
+                if size:
+                    self._metrics.recived(ip, size, start)
+                    if data is not None:
+                        self._history.append([ip, data])
+                if data is None:
+                    data = size
+
+                # Return data
+                if not _isthread:
+                    if not _ip:
+                        result = data
+                    else:
+                        result = (ip, data)
+                else:
+                    if not _ip:
+                        if size:
+                            self._threaded_recvs.append(data)
+                    else:
+                        self._threaded_recvs.append((ip, data))
+                    result = ''
+
+                trace = self._recv_trace
+                if trace is not None:
+                    trace.size = size
+                    trace.mark('deliver')
+                    if not _keep_trace:
+                        self._recv_trace = None
+                        self._finish_trace(trace)
+                return result
+
+            except Exception as error:
+                self._catch_exceptions(error)
+                return '' if text else b''  # Because socket timed out, return a string
+
+        raise SocketError("Socket has not been binded. Bind before reciving.")
+
+    def _recv_frame(self, buffersize, wait=True, into=None):
+        """Recives one message in the frame format. Returns (ip, bytes), or (None, bytes) for foreign data.
+        If into is given, a plain message is copied into it from the recive buffer, and (ip, bytes written)
+        is returned. If wait is false, returns (ip, b'') after a fragment instead of waiting for the rest of the message.
+        On the reactor it never waits, so nothing else on it is held up"""
+        in_loop = _reactor.get_reactor().in_loop()
+        wait = wait and not in_loop
+        buf = None
+        tracer = self._tracer
+        self._recv_trace = None
+        self._recv_topic = None
+        try:
+            while True:
+                if tracer is not None:
+                    start = _time.perf_counter()
+                if self._ready:
+                    ip, frame = self._ready.popleft()
+                    if ip is None:
+                        return None, frame  # Foreign data, put there by _drain_datagrams
+                elif self._is_stream():
+                    ip, frame = self._recv_stream(wait)
+                    if frame is None:
+                        return ip, b''
+                else:
+                    if buf is None:
+                        buf = self._buffers.acquire()
+                    try:
+                        flags = _MSG_DONTWAIT if in_loop else 0
+                        size, ip = self._socket.recvfrom_into(buf, min(buffersize, len(buf)), flags)
+                    except BlockingIOError:
+                        return self._peer, b''  # Nothing more has arrived yet
+                    frame = _frame.unpack(memoryview(buf)[:size])
+
+                    if frame is None:
+                        # Probably normal socket sent data
+                        return None, bytes(buf[:size])
+
+                    if not self._accept_datagram(ip, frame):
+                        if not self._ready and not wait:
+                            return ip, b''
+                        continue
+
+                if frame.opcode == _frame.CODECS:
+                    # The server's half of the codec handshake. Nothing for the user here, so recive again
+                    self._peer_codecs[ip] = set(bytearray(frame.payload))
+                    continue
+
+                if frame.opcode in (_frame.DATA, _frame.BATCH, _frame.OBJECT, _frame.PUBLISH) and frame.flags & _frame.FLAG_FRAGMENT:
+                    payload = self._reassembler.add((ip, frame.sender), frame, ip)
+                    if payload is None:
+                        if not wait:
+                            return ip, b''
+                        continue  # Wait for the rest of the message
+                else:
+                    payload = frame.payload
+                break
+
+            heartbeats = self._heartbeats
+            if heartbeats is not None and ip in self._clients:
+                heartbeats.seen(tuple(ip))  # Anything from a client shows it's still there, not just heartbeats
+
+            limits = self._inbound_limits
+            if limits is not None and frame.opcode in _LIMITED and not limits.allow(ip, len(payload)):
+                # Over its budget, so drop it before it costs anything more
+                if limits.policy == _limits.DISCONNECT:
+                    limits.disconnected += 1
+                    self.disconnect_client(ip[0], ip[1])
+                return ip, b''
+
+            if frame.opcode == _frame.CONNECT:
+                self._peer_codecs[ip] = set(bytearray(frame.payload))
+                self._sendmsg([_frame.pack(_frame.CODECS, bytes(bytearray(_compression.available())),
+                                           sender=self._sender_id, seq=self._next_seq())], ip)
+                self._conn_client(ip)
+                return ip, b''
+            elif frame.opcode == _frame.LEAVE:
+                self._rem_client(ip)
+                return ip, b''
+            elif frame.opcode == _frame.DISCONNECT:
+                self.__reinit__()
+                return ip, b''
+            elif frame.opcode in (_frame.SUBSCRIBE, _frame.UNSUBSCRIBE):
+                if ip in self._clients:
+                    try:
+                        pattern = bytes(frame.payload).decode('utf-8')
+                        if frame.opcode == _frame.SUBSCRIBE:
+                            self._topics.subscribe(ip, pattern)
+                        else:
+                            self._topics.unsubscribe(ip, pattern)
+                    except ValueError:
+                        raise SocketError("Recived an invalid topic from %s:%s" % ip[:2])
+                return ip, b''
+            elif frame.opcode == _frame.FILE:
+                writer = self._file_writer
+                if writer is not None:
+                    writer.feed(ip, payload)
+                return ip, b''
+            elif frame.opcode == _frame.HEARTBEAT:
+                return ip, b''
+
+            trace = tracer.begin('recv', ip, self._sender_id, start) if tracer is not None else None
+            if trace is not None:
+                trace.mark('receive')
+                trace.sender, trace.seq = frame.sender, frame.seq
+
+            if frame.flags & _frame.FLAG_COMPRESSED:
+                try:
+                    payload = _compression.decode(payload, frame.codec)
+                except _compression.CodecError:
+                    raise SocketError("Recived data compressed with an unsupported codec (%d)" % frame.codec)
+
+            if trace is not None:
+                trace.mark('decompress')
+                self._recv_trace = trace
+
+            if frame.opcode == _frame.BATCH:
+                # Coalesced messages. Return the first, and hand out the rest as if they came one by one
+                messages = _frame.unpack_batch(payload)
+                if not messages:
+                    return ip, b''
+                self._ready.extendleft(reversed([(ip, _frame.Frame(frame.version, _frame.DATA, 0, 0, frame.sender,
+                                                                   frame.seq, message)) for message in messages[1:]]))
+                return ip, messages[0]
+            elif frame.opcode == _frame.OBJECT:
+                obj = self._loads(frame.flags >> _frame.SERIALIZER_SHIFT, payload)
+                if trace is not None:
+                    trace.mark('deserialize')
+                return ip, obj
+            elif frame.opcode == _frame.PUBLISH:
+                topic, data = _frame.unpack_publish(payload)
+                if self._is_server:
+                    # Published by a client, so pass it on to the subscribers (but not back to the client)
+                    if ip in self._clients:
+                        self._publish(topic, data, ip)
+                    return ip, b''
+                self._recv_topic = topic
+                return ip, data
+            if into is not None:
+                # The only copy, and like socket.recv_into, what doesn't fit is discarded
+                size = min(len(payload), len(into))
+                into[:size] = payload[:size]
+                return ip, size
+            return ip, bytes(payload)
+        finally:
+            if buf is not None:
+                self._buffers.release(buf)
+
+    def _recv_legacy(self, buffersize):
+        """Recives one message in the old (pre-frame) protocol. Returns (ip, data)"""
+
+        # Nested functions for processing the recived data
+        def recvall(ip):
+            """Recives all the chunks of data from the sending socket, and then returns the data"""
+            data = ''
+
+            # Recive all chunks of data and store in the data str
+            while True:
+
+                recv = self._decompress(self._socket.recv(buffersize))
+
+                if recv == self._packets['sent']:  # 'is' comparison fails
+                    break
+
+                data += recv
+
+            return data
+
+        data = self._socket.recv(buffersize)
+        try:
+            ip = self._decompress(data).split(',')
+            ip = (ip[0], int(ip[1]))
+        except:
+            if self._decompress(data) in self._packets.values():
+                # Probably called too late to get ip. Just break
+                return None, ''
+            else:
+                # Probably normal socket sent data
+                return None, data
+
+        data = self._decompress(self._socket.recv(buffersize))
+
+        if data in self._packets.values():
+            # Rename just for clarity
+            packet = data
+
+            # Make switch dict, check packets & work accordingly
+            switch_dict = {self._packets['disconnect']: self.__reinit__, self._packets['-disconnect-']: self._rem_client,
+                           self._packets['connect']: self._conn_client, self._packets['sending']: recvall}
+            try: data = switch_dict.get(packet)(ip)
+            except: switch_dict.get(packet)(); data = ''
+
+        return ip, data or ''
+
+    def _recv_ready(self, mask):
+        """Called by the reactor when the socket is readable"""
+        self._recv(False, False, True, True)
+
+    def _recv_stream(self, wait=True):
+        """Returns (ip, frame) for the next frame from any stream, accepting connections on the way.
+        Returns (ip, None) if no frame has arrived (straight away if wait is false, or on the reactor)"""
+        if self._ready:
+            return self._ready.popleft()
+
+        timeout = self._timeout if wait and not _reactor.get_reactor().in_loop() else 0
+        deadline = None if timeout is None else _time.monotonic() + timeout
+        ip = self._peer
+        while not self._ready:
+            events = self._stream_selector().select(None if deadline is None else max(0, deadline - _time.monotonic()))
+            for key, mask in events:
+                ip = self._stream_event(key.data)
+            if not self._ready and (deadline is None or _time.monotonic() < deadline):
+                continue
+            break
+
+        if self._ready:
+            return self._ready.popleft()
+        if timeout:
+            raise _socket.timeout('timed out')
+        return ip, None
+
+    def _reliable_to(self, addr):
+        """Returns if frames to addr go through reliable delivery"""
+        return self._reliable and addr is not None and not self._legacy and not self._is_stream()
+
+    def _rem_client(self, addr):
+        """Removes a client from the self._clients registry"""
+        removed = self._clients.remove(addr)
+        self._topics.remove(addr)
+        self._forget_limits(addr)
+        self._reliability.forget(addr)
+        self._metrics.forget(addr)
+        if self._heartbeats is not None:
+            self._heartbeats.forget(tuple(addr))
+        if removed:
+            self._dispatch_hook(self.onDisconnect, tuple(addr), tuple(addr))
+        return ''
+
     def _send(self, send, data, sendto):
         try:
             if sendto:
@@ -100,49 +863,324 @@ class socket():
         except Exception as error:
             self._catch_exceptions(error)
 
-    def accept(self, blocking=False):
-        """Accepts client connection request"""
+    def _send_control(self, opcode, topic):
+        """Sends a SUBSCRIBE or UNSUBSCRIBE frame to the server"""
+        if self._legacy:
+            raise SocketError("Topics can't be used with the old protocol")
+        self.flush()
+        self._send_frames(opcode, topic.encode('utf-8'), 0, None)
+
+    def _send_data(self, data, addr, trace):
+        """Body of send and send_bytes, for the frame protocol. trace is the message's Trace, if it's traced"""
+        if isinstance(data, memoryview) and data.format != 'B':
+            data = data.cast('B')
+        start = _time.perf_counter()
+        if trace is not None:
+            trace.mark('encode', start)
+            trace.size = len(data)
+
+        if self._coalesce is not None and self._coalesce_add(data, addr):
+            self._metrics.sent(tuple(addr) if addr else self._peer, len(data), start)  # Encoded when it's flushed
+            if trace is not None:
+                trace.args['coalesced'] = True
+                self._finish_trace(trace)
+            return len(data)
+
+        payload, flags, codec = self._encode(data, addr or self._peer)
+        if trace is not None:
+            trace.mark('compress')
+        count = self._send_frames(_frame.DATA, payload, flags, addr, codec)
+        self._metrics.sent(tuple(addr) if addr else self._peer, len(data), start, len(payload), count)
+
+        if trace is not None:
+            trace.mark('send')
+            trace.sender, trace.seq = self._sender_id, self._sent_seq
+            self._finish_trace(trace)
+        return len(data)
+
+    def _send_file_chunk(self, addr, kind, transfer_id, offset, checksum=0, data=b''):
+        """Sends one FILE frame of a transfer to addr. Over datagrams it always goes reliably"""
+        payload = [_transfer.CHUNK.pack(kind, transfer_id, offset, checksum), data]
+        if self._is_stream():
+            self._send_frames(_frame.FILE, payload, 0, addr)
+        else:
+            self._send_reliable(addr, _frame.FILE, payload, 0)
+
+    def _send_frames(self, opcode, payload, flags, _sendto, codec=_compression.NONE):
+        """Sends payload as one frame, or as FLAG_FRAGMENT frames if it doesn't fit in one datagram.
+        Returns the number of frames"""
+        if self._reliable_to(_sendto or self._peer):
+            return self._send_reliable(_sendto or self._peer, opcode, payload, flags, codec)
+
+        count = 0
+        for buffers in self._frames(opcode, payload, flags, codec):
+            self._sendmsg(buffers, _sendto)
+            count += 1
+        return count
+
+    def _send_legacy(self, data, _send, _sendto, ip=False, trace=None):
+        """Sends data using the old (pre-frame) protocol"""
+        olddata = data
+
+        # Compress data
+        data = self._compress(data)
+        if trace is not None:
+            trace.mark('compress')
+
+        # Send data
+        self._send(_send, self._compress(self.getsockname(_tosend=True)), _sendto)
+        if not olddata in self._packets.values() and not ip:
+            self._send(_send, self._compress(self._packets['sending']), _sendto)
+
+        if len(data) < self._max_send:
+            self._send(_send, data, _sendto)
+        else:
+            chunk = 0
+
+            # Send all chunks of data
+            while True:
+                if len(data[chunk:]) > self._max_send:
+                    self._send(_send, data[chunk:chunk + self._max_send], _sendto)
+                    chunk += self._max_send
+                else:
+                    self._send(_send, data[chunk:], _sendto)
+                    break
+
+        if not olddata in self._packets.values() and not ip:
+            self._send(_send, self._compress(self._packets['sent']), _sendto)
+
+        if trace is not None:
+            trace.mark('send')
+            trace.size = len(olddata)
+            self._finish_trace(trace)
+
+    def _send_packet(self, packet, _send=None, _sendto=None):
+        """Sends one of the control packets in self._packets"""
+        if _send == None:
+            _send = self._socket.send
+
+        if self._legacy:
+            self._send_legacy(self._packets[packet], _send, _sendto)
+            return
+        self.flush()
+
+        payload = b''
+        if packet == 'connect':
+            # Tell the server which codecs we can decompress
+            payload = bytes(bytearray(_compression.available()))
+        if self._reliable_to(_sendto or self._peer):
+            self._send_reliable(_sendto or self._peer, _frame.OPCODES[packet], payload, 0)
+            return
+        self._sendmsg([_frame.pack(_frame.OPCODES[packet], payload, sender=self._sender_id, seq=self._next_seq())], _sendto)
+
+    def _send_reliable(self, addr, opcode, payload, flags, codec=_compression.NONE):
+        """Sends payload to addr through its reliable channel"""
+        channel = self._reliability.channel(addr)
+        count = 0
+        with channel.lock:  # Frames have to be queued in the order they're numbered
+            for buffers in self._frames(opcode, payload, flags | _frame.FLAG_RELIABLE, codec, channel.next_seq):
+                channel.send(_frame.HEADER.unpack_from(buffers[0])[6], b''.join(buffers))
+                count += 1
+        return count
+
+    def _sendmsg(self, buffers, _sendto=None):
+        """Sends buffers as one datagram (or one write to a stream), without joining them first where the platform allows"""
+        if self._send_queues is not None:
+            self._queue_send(b''.join(buffers), _sendto)
+            return
+
+        if self._is_stream():
+            conn = self._conns.get(tuple(_sendto) if _sendto else self._peer)
+            if conn is None:
+                raise SocketError("Not connected to %r" % (_sendto or self._peer,))
+            try:
+                conn.send(buffers)
+            except Exception as error:
+                self._catch_exceptions(error)
+            return
+
+        try:
+            if hasattr(self._socket, 'sendmsg'):
+                if _sendto:
+                    self._socket.sendmsg(buffers, (), 0, _sendto)
+                else:
+                    self._socket.sendmsg(buffers)
+            elif _sendto:
+                self._socket.sendto(b''.join(buffers), _sendto)
+            else:
+                self._socket.send(b''.join(buffers))
+        except Exception as error:
+            self._catch_exceptions(error)
+
+    def _start_recv(self):
+        """Starts threaded reciving, with the data going to threaded_recvs"""
+        self._recv_started = True
+        self._stop_recv = False
+        self._watch(self._recv_ready)
+
+    def _stop_heartbeat(self):
+        """Stops sending heartbeats, or expiring clients which don't"""
+        timer, self._heartbeat_timer = self._heartbeat_timer, None
+        if timer is not None:
+            timer.cancel()
+        self._heartbeats = None
+
+    def _stream_closed(self, conn):
+        """A stream ended (or broke), which means the same as a LEAVE from a client or a DISCONNECT from the server"""
+        opcode = _frame.DISCONNECT if conn.sock is self._socket else _frame.LEAVE
+        self._close_conn(conn.addr)
+        self._ready.append((conn.addr, _frame.Frame(_frame.VERSION, opcode, 0, 0, 0, 0, b'')))
+
+    def _stream_event(self, conn):
+        """Handles a readable listening socket (conn is None) or connection. Returns the ip involved"""
+        if conn is None:
+            accepted = self._accept_conns()
+            return accepted[-1] if accepted else self._peer
 
-        # Block
-        if blocking:
-            self._socket.settimeout(None)
-        
         try:
-            conn, addr = self._socket.accept()
+            size = conn.buffer.fill(conn.sock)
+        except (BlockingIOError, InterruptedError, _socket.timeout):
+            return conn.addr
+        except OSError:
+            size = 0  # Reset, so the same as the stream ending
 
-            # If the client ip isn't in the blocked list, then we add it to the clients list
-            if not addr[0] in self._blocked:
-                self.onAccept(addr)
-                self._clients.append((addr[0], addr[1]))
+        if not size:
+            self._stream_closed(conn)
+            return conn.addr
 
-            if blocking:
-                # Unblock
-                self._socket.settimeout(self._timeout)
-                
-                # Like socket.accept
-                return conn, addr
-                
+        try:
+            # One recv_into may have read any number of frames
+            for frame in conn.buffer.frames():
+                self._ready.append((conn.addr, frame))
+        except _frame.FrameError:
+            self._stream_closed(conn)  # Can't find where the next frame starts, so the stream is no use
+        return conn.addr
+
+    def _stream_selector(self):
+        if self._selector is None:
+            self._selector = _selectors.DefaultSelector()
+        return self._selector
+
+    def _trace(self, kind, addr, start=None):
+        """Returns a new tracing.Trace for a message, or None if it isn't traced"""
+        tracer = self._tracer
+        if tracer is None:
+            return None
+        return tracer.begin(kind, addr, self._sender_id, start)
+
+    def _traced(self, func, trace):
+        """Wraps a callback so trace's dispatch stage ends when it returns"""
+        def traced(*args):
+            try:
+                return func(*args)
+            finally:
+                trace.mark('dispatch')
+                self._finish_trace(trace)
+        return traced
+
+    def _transmit(self, datagram, addr):
+        """Sends one datagram for the reliable channels (which may be on the reactor thread)"""
+        try:
+            self._socket.sendto(datagram, addr)
         except Exception as error:
-            if self._binded and error.args[0] is "timed out":
-                # accept() is not supposed to time out, so we thread it
-                if self.thread:
-                    _threading.Thread(target=self.accept).run()
+            self._catch_exceptions(error)
+
+    def _unwatch(self):
+        """Stops the reactor from watching the socket"""
+        watched = self._watching is not None or self._watch_callback is not None
+        if self._watching is not None:
+            _reactor.get_reactor().unregister(self._watching)
+            self._watching = None
+        if self._watch_callback is not None:
+            for conn in self._conns.values():
+                if conn.sock is not self._socket:
+                    _reactor.get_reactor().unregister(conn.sock)
+            self._watch_callback = None
+        if watched:
+            _reactor.get_reactor().wait(1.0)  # Let a drain which is running finish, before the socket can be closed
+
+    def _wait_acked(self, channel, limit, failed):
+        """Waits until at most limit frames are waiting for ACKs on a reliable channel. Raises SocketError
+        if the channel gives up on a frame (failed is how many it had given up on before)"""
+        while len(channel) > limit:
+            if channel.failed != failed:
+                raise SocketError("Gave up resending frames after %d tries" % channel.max_retries)
+            if self._watching is not None:
+                _time.sleep(0.001)  # The reactor is handling the ACKs
             else:
-                self._catch_exceptions(error)
+                self._recv(False, False, True, False)  # Handle the ACKs. Anything else goes in threaded_recvs
+
+    def _watch(self, callback):
+        """Has the reactor call callback(mask) whenever the socket is readable"""
+        self._unwatch()
+        self._watching = self._socket
 
-        # If self._always_accept is true, then regardless, rerun this function
-        if self._always_accept:
-            _threading.Thread(target=self.accept).run()
+        def drain(mask, callback=callback):
+            if self._recv_batch_size and not self._is_stream() and not self._legacy:
+                self._drain_datagrams(callback, mask)
+                return
+            callback(mask)
+            while self._ready:  # One read can make many frames ready, but only makes one event
+                callback(mask)
+        callback = drain
+
+        if self._is_stream():
+            self._watch_callback = callback
+            for conn in self._conns.values():
+                if conn.sock is not self._socket:
+                    _reactor.get_reactor().register(conn.sock, callback)
+
+        _reactor.get_reactor().register(self._socket, callback)
+
+    def _write_queued(self, addr, data):
+        """Writes queued data to addr without blocking, for SendQueues.drain. Returns the bytes written"""
+        if self._is_stream():
+            conn = self._conns.get(addr)
+            if conn is None:
+                raise ConnectionResetError("Not connected to %r" % (addr,))
+            return _stream.send_nowait(conn.sock, data)
+        try:
+            # Datagram sockets almost always have room, so unlike streams, waiting for it isn't worth avoiding
+            return self._socket.sendto(data, _MSG_DONTWAIT, addr)
+        except BlockingIOError:
+            raise
+        except OSError as error:
+            self._catch_exceptions(error)  # Datagrams can fail one by one, so only this one is lost
+            return len(data)
+
+    def accept(self, blocking=False):
+        """Accepts every connection waiting, and returns how many were accepted. With blocking, waits for one
+        connection instead and returns (conn, addr) like socket.accept, leaving conn for the caller to read"""
+        if not blocking:
+            return len(self._accept_conns())
+
+        self._socket.settimeout(None)
+        try:
+            while True:
+                sock, addr = self._socket.accept()
+                if not addr[0] in self._blocked:
+                    break
+                sock.close()
+        finally:
+            if self._listening:
+                self._socket.setblocking(False)
+            else:
+                self._socket.settimeout(self._timeout)
+
+        self._accepted(sock, addr, receive=False)
+        return sock, addr
 
     def accept_all(self, MAX=100):
-        """Allows socket to accept all connections"""
+        """Listens, and accepts every connection from now on, on the reactor (unless it's already watching the
+        socket, which accepts them as it recives)"""
         self.listen(MAX)
-        self._always_accept = True
-        self.accept()  # Start the threading loop
+        if self._watching is None:
+            self._watching = self._socket
+            _reactor.get_reactor().register(self._socket, lambda mask: self._accept_conns())
 
     def add_blocked(self, ip):
-        """Blocks given IP"""
-        self._blocked.append(ip)
+        """Blocks given IP, or range of IPs in CIDR notation (like '10.0.0.0/8')"""
+        self._blocked.add(ip)
 
     def bind(self, addr='127.0.0.1', port=8000):
         """Binds ip and port to socket"""
@@ -165,12 +1203,14 @@ class socket():
         self._binded = True
 
         if self._thread:
-            # Start reciving thread
-            _threading.Timer(0.45, self.recv, args=(0, 0, 1)).start()
+            # Start reciving in the reactor
+            self._start_recv()
 
     def close(self):
         """Closes socket"""
         self.stop_threads()  # Stops all of the threads
+        self._stop_heartbeat()
+        self.flush()
         self._socket.close()
 
     def connect(self, addr, port=None, ex=False):
@@ -185,66 +1225,107 @@ class socket():
                 self._socket.connect((addr, port))
             except TypeError:
                 self._socket.connect(addr)
-        self.send(self._packets['connect'])
+        try:
+            self._peer = self._socket.getpeername()
+        except Exception as error:
+            self._catch_exceptions(error)
+        if self._is_stream() and self._peer is not None:
+            self._add_conn(_stream.Connection(self._socket, self._peer))
+        self._send_packet('connect')
         self._is_server = False
         self._connected = True
 
         if self._thread:
-            # Start reciving thread
-            _threading.Timer(0.45, self.recv, args=(0, 0, 1)).start()
+            # Start reciving in the reactor
+            self._start_recv()
 
     def disconnect_all(self):
         """Disconnects all clients"""
         # Tell all clients to disconnect
         for client in self._clients:
-            self.sendto(self._packets['disconnect'], client[0], client[1])
+            if not self._is_stream() or client in self._conns:  # A stream which has ended can't be told
+                self._send_packet('disconnect', self._socket.sendto, (client[0], client[1]))
+            self._close_conn(client)
+            self._reliability.forget(client)
+            self._metrics.forget(client)
 
         # Clear all clients
-        self._clients = []
+        self._clients.clear()
+        self._topics.clear()
+        if self._heartbeats is not None:
+            self._heartbeats.clear()
 
     def disconnect_client(self, client_ip, client_port):
         """Disconnects a client"""
-        for client in self._clients:
-            if client_ip is client[0] and client_port is client[1]:
-                self.sendto(self._packets['disconnect'], client_ip, client_port)
-                del self._clients[self._clients.index(client)]
-                break
+        self._topics.remove((client_ip, client_port))
+        self._forget_limits((client_ip, client_port))
+        self._reliability.forget((client_ip, client_port))
+        self._metrics.forget((client_ip, client_port))
+        if self._heartbeats is not None:
+            self._heartbeats.forget((client_ip, client_port))
+        if self._clients.remove((client_ip, client_port)):
+            if not self._is_stream() or (client_ip, client_port) in self._conns:
+                self._send_packet('disconnect', self._socket.sendto, (client_ip, client_port))
+            self._close_conn((client_ip, client_port))
+
+    def drain_threaded_recvs(self):
+        """Yields (and removes) the data recived by the threads, oldest first"""
+        return self._threaded_recvs.drain()
 
     def dup(self):
         """Returns duplicate of current socket, without ip and port, because of binding conflict issuses"""
         return socket(self._socket_fam, self._socket_type, self._socket_proto, self._socket_sock, timeout=self._timeout)
 
+    def flush(self):
+        """Sends the messages waiting to be coalesced straight away"""
+        with self._coalesce_lock:
+            if self._coalesce_timer is not None:
+                self._coalesce_timer.cancel()
+                self._coalesce_timer = None
+            for key in list(self._coalesced):
+                self._flush(key)
+
     def get_client(self, ip, port=None):
-        for client in self._clients:
-            if ip in client[0]:
-                if port:
-                    if port is client[1]:
-                        return (ip, port)
-                else:
-                    return (ip, client[1])
+        """Returns (ip, port) of a client. If port isn't given, the first client using ip is returned"""
+        return self._clients.get(ip, port)
+
+    def get_connection(self, addr):
+        """Returns the stream.Connection of an accepted client, or None"""
+        return self._clients.value(addr)
 
     def get_ip(self):
         """Gets ip"""
         return self._ip
-    
+
     def get_port(self):
         """Gets port"""
         return self._port
 
     def getclients(self):
-        """Returns a dict of all clients"""
-        return self._clients
+        """Returns a list of all clients"""
+        return list(self._clients)
+
+    def getdropped(self):
+        """Returns how many messages the history and threaded_recvs buffers have dropped because they were full"""
+        return {'history': self._history.dropped, 'threaded_recvs': self._threaded_recvs.dropped,
+                'inbound_limits': self._inbound_limits.dropped if self._inbound_limits is not None else 0,
+                'send_queues': self._send_queues.dropped if self._send_queues is not None else 0}
 
     def gethistory(self, amount=None):
+        """Returns the last amount (or all) [ip, data] pairs recived, oldest first"""
         if not amount:
-            return self._history
-        return self.history[-amount]
+            return list(self._history)
+        return self._history.last(amount)
 
     def getpeerinfo(self):
         """Gets peer info"""
         if not self._is_server:
             return self._socket.getpeername()
 
+    def getreliability(self):
+        """Returns the state of the reliable channel (srtt, rto, cwnd, retransmits...) to each peer"""
+        return self._reliability.stats()
+
     def getsockname(self, _tosend=False):
         if _tosend:
             return self._ip + ', ' + str(self._port)
@@ -254,6 +1335,10 @@ class socket():
     def getsockopt(self, *args):
         return self._socket.getsockopt(*args)
 
+    def getsubscribers(self, topic):
+        """Returns the clients what's published to topic is sent to"""
+        return self._topics.match(topic)
+
     def gettimeout(self):
         return self._timeout
 
@@ -264,114 +1349,135 @@ class socket():
     def leave(self):
         """If socket is connected to a server, disconnects socket from server"""
         if self._connected is True:
-            self.send(self._packets['-disconnect-'])
+            self._send_packet('-disconnect-')
             self._connected = False
         if self._binded:
             self._is_server = True
         self.__reinit__()  # Restart socket
 
     def listen(self, max):
+        """Listens for connections, up to max waiting to be accepted. The listening socket doesn't block, so
+        accepting takes whatever is waiting and returns"""
         self._socket.listen(max)
+        self._socket.setblocking(False)
+        if not self._listening:
+            self._listening = True
+            if self._is_stream():
+                # Connections are accepted by recv (or the reactor) from now on
+                self._stream_selector().register(self._socket, _selectors.EVENT_READ, None)
 
     def makefile(self, mode='r', bufsize=-1):
         return self._socket.makefile(mode, bufsize)
 
-    def onAccept(self, addr):
-        "Reimplement this function in your own subclass"
+    def onAccept(self, conn):
+        "Reimplement this function in your own subclass. conn is the stream.Connection accepted (its address is conn.addr)"
         pass
 
     def onConnect(self, addr):
         "Reimplement this function in your own subclass"
         pass
 
-    def recv(self, buffersize=False, _ip=False, _isthread=False):
-        """Recives data that has been sent from another socket and processes it"""
-
-        if not buffersize:
-            buffersize = self._max_recv
-
-        # Nested functions for processing the recived data
-        def recvall(ip):
-            """Recives all the chunks of data from the sending socket, and then returns the data"""
-            data = ''
-
-            # Recive all chunks of data and store in the data str
-            while True:
-
-                recv = self._decompress(self._socket.recv(buffersize))
-
-                if recv == self._packets['sent']:  # 'is' comparison fails
-                    break
-
-                data += recv
+    def onDisconnect(self, addr):
+        "Reimplement this function in your own subclass. Called when a client leaves, or stops sending heartbeats"
+        pass
 
-            return data
+    def pop_threaded_recv(self):
+        """Removes and returns the oldest data recived by the threads. Raises IndexError if there is none"""
+        return self._threaded_recvs.pop()
+
+    def publish(self, topic, data):
+        """Publishes data (bytes or str) to topic. A server sends it to the clients subscribed to the topic,
+        and a client sends it to its server, which does the same (leaving the client out)"""
+        if self._legacy:
+            raise SocketError("Topics can't be used with the old protocol")
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'latin-1')
+
+        if self._is_server:
+            self._publish(topic, data)
+            return len(data)
+
+        start = _time.perf_counter()
+        payload, flags, codec = self._encode(_frame.pack_publish(topic, data), self._peer)
+        self.flush()  # Keep it behind anything coalesced before it
+        count = self._send_frames(_frame.PUBLISH, payload, flags, None, codec)
+        self._metrics.sent(self._peer, len(data), start, len(payload), count)
+        return len(data)
 
-        def rem_client(addr):
-            """Removes a client from the self._clients dict"""
-            for client in self._clients:
-                if addr[0] == client[0] and addr[1] == client[1]:
-                    del self._clients[self._clients.index(addr)]
-                    return ''
-
-        def conn_client(ip):
-            """Adds a client to the self._clients dict"""
-            self.onConnect(ip)
-            self._clients.append(ip)
-            return ''
+    def recv(self, buffersize=False, _ip=False, _isthread=False):
+        """Recives data that has been sent from another socket and processes it"""
 
         if _isthread:
-            # Restart recv
-            _threading.Timer(0.45, self.recv, args=(0, 0, 1)).start()
-
-        if self._binded:
-            try:
-                data = self._socket.recv(buffersize)
-                try:
-                    ip = self._decompress(data).split(',')
-                    ip = (ip[0], int(ip[1]))
-                except:
-                    if self._decompress(data) in self._packets.values():
-                        # Probably called too late to get ip. Just break
-                        return ''
-                    else:
-                        # Probably normal socket sent data
-                        return data
-                
-                data = self._decompress(self._socket.recv(buffersize))
-               
-                if data in self._packets.values():
-                    # Rename just for clarity
-                    packet = data
-
-                    # Make switch dict, check packets & work accordingly
-                    switch_dict = {self._packets['disconnect']: self.__reinit__, self._packets['-disconnect-']: rem_client,
-                                   self._packets['connect']: conn_client, self._packets['sending']: recvall}
-                    try: data = switch_dict.get(packet)(ip)
-                    except: switch_dict.get(packet)(); data = ''
+            # Recived data is put into threaded_recvs by the reactor from now on
+            if not self._recv_started:
+                self._start_recv()
+            return ''
 
-                if data:
-                    self._history.append([ip, data])
+        return self._recv(buffersize, _ip, _isthread, True)
 
-                # Return data
-                if not _isthread:
-                    if not _ip:
-                        return data
-                    else:
-                        return (ip, data)
-                else:
-                    if not _ip:
-                        if not data is '' and not data is u'':
-                            self._threaded_recvs.append(data)
-                    else:
-                        self._threaded_recvs.append((ip, data))
-                    return ''
+    def recv_bytes(self, buffersize=False, _ip=False):
+        """Like recv, but returns the data as bytes, without going through str"""
+        return self._recv(buffersize, _ip, False, False)
 
-            except Exception as error:
-                self._catch_exceptions(error)
-                return ''  # Because socket timed out, return a string
+    def recv_file(self, dest, addr=None, timeout=10.0):
+        """Recives a file sent with send_file into dest (a path, or a file object opened for binary writing),
+        from addr if given. Raises transfer.TransferError if a chunk is missed or corrupted, or none arrives for
+        timeout seconds. What dest already has is kept, so its offset is where the sender can resume from.
+        Other messages recived meanwhile only go in the history. Returns the number of bytes recived"""
+        if self._legacy:
+            raise SocketError("Files can't be recived with the old protocol")
 
-        raise SocketError("Socket has not been binded. Bind before reciving.")
+        start = _time.perf_counter()
+        writer = self._file_writer = _transfer.FileWriter(dest, addr)
+        try:
+            offset, last = None, _time.monotonic()
+            while True:
+                with writer.cond:
+                    if writer.done or writer.error is not None:
+                        break
+                    if writer.offset != offset:
+                        offset, last = writer.offset, _time.monotonic()  # Still making progress
+                    elif _time.monotonic() - last > timeout:
+                        raise _transfer.TransferError("Nothing was recived for %s seconds" % timeout, offset or 0)
+                    if self._watching is not None:
+                        writer.cond.wait(0.1)  # Chunks are fed in by the reactor
+                        continue
+                self._recv(False, False, False, False)
+        finally:
+            self._file_writer = None
+            writer.close()
+
+        if writer.error is not None:
+            raise writer.error
+        self._metrics.recived(writer.addr, writer.size - writer.start, start)
+        return writer.size - writer.start
+
+    def recv_into(self, buffer, nbytes=0):
+        """Recives a message into buffer (like socket.recv_into). Returns the number of bytes written. A plain
+        message is copied once, straight from the recive buffer, and isn't kept in the history"""
+        view = memoryview(buffer).cast('B')
+        if nbytes:
+            view = view[:nbytes]
+
+        data = self._recv(False, False, False, False, _into=view)
+        if data.__class__ is int:
+            return data  # Copied straight out of the recive buffer
+
+        # Batched, published or foreign data has already been copied out. Like socket.recv_into, data which
+        # doesn't fit is discarded
+        size = min(len(data), len(view))
+        view[:size] = data[:size]
+        return size
+
+    def recv_obj(self, buffersize=False, _ip=False):
+        """Like recv_bytes, but objects sent with send_obj are returned deserialized. Objects from
+        serializers which aren't allowed (see set_serializer) are dropped"""
+        return self._recv(buffersize, _ip, False, False)
+
+    def recv_published(self, buffersize=False):
+        """Like recv_bytes, but returns (topic, data). topic is None for data which wasn't published to a topic"""
+        data = self._recv(buffersize, False, False, False)
+        return self._recv_topic, data
 
     def recvfrom(self, buffersize=None):
         if buffersize == None:
@@ -388,6 +1494,10 @@ class socket():
         buf.write(recv)
         return len(recv)
 
+    def rem_blocked(self, ip):
+        """Unblocks an IP or range which was blocked with add_blocked"""
+        self._blocked.remove(ip)
+
     def send(self, data, oldsock=False, _send=None, _sendto=None, ip=False):
         """Sends data over socket. If oldsock is true, sends without processing data"""
         olddata = data
@@ -396,60 +1506,112 @@ class socket():
             self._send(_send, data, _sendto)
             return len(olddata)
         
-        if _send == None:
-            _send = self._socket.send
-        
-        # Compress data
-        data = self._compress(data)
+        trace = self._trace('send', _sendto or self._peer)
+        if self._legacy:
+            if _send == None:
+                _send = self._socket.send
+            self._send_legacy(data, _send, _sendto, ip, trace)
+        else:
+            self._send_data(bytes(data, 'latin-1') if isinstance(data, str) else data, _sendto, trace)
 
-        # Send data
-        self._send(_send, self._compress(self.getsockname(_tosend=True)), _sendto)
-        if not olddata in self._packets.values() and not ip:
-            self._send(_send, self._compress(self._packets['sending']), _sendto)
-        
-        if len(data) < self._max_send:
-            self._send(_send, data, _sendto)
+        return len(olddata)
+
+    def send_bytes(self, data, addr=None):
+        """Sends a bytes-like object (bytes, bytearray or memoryview) to the peer, or to addr if given"""
+        if self._legacy:
+            return self.send(bytes(data).decode('latin-1'), _send=self._socket.sendto if addr else None, _sendto=addr)
+        return self._send_data(data, addr, self._trace('send', addr or self._peer))
+
+    def send_file(self, src, addr=None, offset=0):
+        """Sends a file (a path, or a file object opened for binary reading) to the peer (or addr), for
+        recv_file. offset resumes a transfer which broke off. Over streams the file is written by the kernel
+        (sendfile). Over datagrams it's sent one mapped chunk per datagram, with reliable delivery, and this
+        returns once every chunk has been acknowledged. Returns the number of bytes sent"""
+        if self._legacy:
+            raise SocketError("Files can't be sent with the old protocol")
+        if self._is_stream() and self._send_queues is not None:
+            raise SocketError("Files can't be sent over streams while sends are queued")
+
+        addr = tuple(addr) if addr else self._peer
+        start = _time.perf_counter()
+        reader = _transfer.FileReader(src, offset)
+        transfer_id = self._next_seq()
+        count = 0
+        self.flush()  # Keep it behind anything coalesced before it
+        try:
+            if self._is_stream():
+                conn = self._conns.get(addr)
+                if conn is None:
+                    raise SocketError("Not connected to %r" % (addr,))
+                self._send_file_chunk(addr, _transfer.START, transfer_id, offset, 0,
+                                      _transfer.START_INFO.pack(reader.size))
+                for position, view in reader.chunks(_transfer.STREAM_CHUNK):
+                    chunk = _transfer.CHUNK.pack(_transfer.DATA, transfer_id, position, _transfer.crc32(view))
+                    self._sent_seq = self._next_seq()
+                    conn.send([_frame.header(_frame.FILE, len(chunk) + len(view), 0, self._sender_id,
+                                             self._sent_seq), chunk])
+                    _stream.sendfile_all(conn.sock, reader.fileobj, position, len(view))
+                    count += 1
+                self._send_file_chunk(addr, _transfer.END, transfer_id, reader.size)
+            else:
+                # Chunks are sent reliably whether or not the socket is, and no faster than they're acknowledged
+                channel = self._reliability.channel(addr)
+                failed = channel.failed
+                self._send_file_chunk(addr, _transfer.START, transfer_id, offset, 0,
+                                      _transfer.START_INFO.pack(reader.size))
+                for position, view in reader.chunks(self._max_send - _frame.HEADER.size - _transfer.CHUNK.size):
+                    self._wait_acked(channel, channel.max_window - 1, failed)
+                    self._send_file_chunk(addr, _transfer.DATA, transfer_id, position, _transfer.crc32(view), view)
+                    count += 1
+                self._send_file_chunk(addr, _transfer.END, transfer_id, reader.size)
+                self._wait_acked(channel, 0, failed)
+        finally:
+            reader.close()
+
+        self._metrics.sent(addr, reader.size - offset, start, reader.size - offset, count + 2)
+        return reader.size - offset
+
+    def send_obj(self, obj, addr=None, serializer=None):
+        """Sends obj to the peer (or addr), serialized with serializer (an id or name), or the socket's
+        serializer (see set_serializer). Returns the size of the serialized object"""
+        if self._legacy:
+            raise SocketError("Objects can't be sent with the old protocol")
+
+        trace = self._trace('send', addr or self._peer)
+        start = _time.perf_counter()
+        serializer = self._serializer if serializer is None else _serialization.get(serializer)
+        buffers = serializer.dumps(obj)
+        size = sum(len(buf) for buf in buffers)
+        if trace is not None:
+            trace.mark('encode')
+            trace.size = size
+
+        flags = serializer.id << _frame.SERIALIZER_SHIFT
+        if len(buffers) == 1:
+            payload, compressed, codec = self._encode(buffers[0], addr or self._peer)
+            flags |= compressed
+            encoded = len(payload)
         else:
-            chunk = 0
-            
-            # Send all chunks of data
-            while True:
-                if len(data[chunk:]) > self._max_send:
-                    self._send(_send, data[chunk:chunk + self._max_send], _sendto)
-                    chunk += self._max_send
-                else:
-                    self._send(_send, data[chunk:], _sendto)
-                    break
+            # Out of band buffers are sent from where they are, so they aren't compressed
+            payload, codec, encoded = buffers, _compression.NONE, size
+        if trace is not None:
+            trace.mark('compress')
 
-        if not olddata in self._packets.values() and not ip:
-            self._send(_send, self._compress(self._packets['sent']), _sendto)
+        self.flush()  # Keep it behind anything coalesced before it
+        count = self._send_frames(_frame.OBJECT, payload, flags, addr, codec)
+        self._metrics.sent(tuple(addr) if addr else self._peer, size, start, encoded, count)
 
-        return len(olddata)
-    
-    def sendall(self, data, _send=None, _sendto=None):
-        # Turn data to bytes if python version is py3k
-        data = self._tobytes(data)
-        
-        # If the data is a packet then just use the send function. Otherwise continue below
-        if data in self._packets.values():
-            self._send(_send, data, _sendto)
+        if trace is not None:
+            trace.mark('send')
+            trace.sender, trace.seq = self._sender_id, self._sent_seq
+            self._finish_trace(trace)
+        return size
 
-        if _send == None:
-            _send = self._socket.send
-        
-        # Compress data
-        data = self._compress(data)
-        
-        # Send data
-        self._send(_send, self._compress(self.getsockname(_tosend=True)), _sendto)
-        self._send(_send, self._compress(self._packets['sending']), _sendto)
-        
-        for d in data:
-            self._socket.send(d)
-            
-        self._send(_send, self._compress(self._packets['sent']), _sendto)
-        
-        return len(data)
+    def sendall(self, data, _send=None, _sendto=None):
+        """Sends all of data (like socket.sendall). On streams, it's written as one frame with sendmsg"""
+        if self._legacy:
+            return self.send(data, _send=_send, _sendto=_sendto)
+        return self.send(data, _sendto=_sendto)
 
     def sendto(self, data, addr, port=None):
         if port:
@@ -458,8 +1620,54 @@ class socket():
             self.send(data, _send=self._socket.sendto, _sendto=addr)
 
     def sendtoall(self, data):
-        for client in self.getclients():
-            self.sendto(data, client)
+        """Sends data to all clients, encoding it only once"""
+        self._broadcast(data, self._clients)
+
+    def set_coalescing(self, enabled=True, delay=0.001, max_bytes=None):
+        """Coalesces small sends to the same address into one BATCH frame, sent after delay seconds
+        or once max_bytes (by default, as much as fits in one datagram) are waiting. flush() sends them sooner"""
+        if not enabled:
+            self.flush()
+            self._coalesce = None
+            return
+        if max_bytes is None:
+            max_bytes = self._max_send - _frame.HEADER.size
+        self._coalesce = (delay, max_bytes)
+
+    def set_codec(self, codec, level=None):
+        """Sets the codec (id or name) used to compress sent data, optionally with a compression level"""
+        codec = _compression.get(codec)
+        if level is not None:
+            codec = codec.__class__(level)
+        self._codec = codec
+
+    def set_compress_threshold(self, size):
+        """Sets the size (in bytes) below which data is sent without compression"""
+        self._compress_threshold = size
+
+    def set_dispatcher(self, dispatcher=None, **options):
+        """Runs onAccept, onConnect, onDisconnect and proc_recv callbacks on a dispatch.Dispatcher (or makes one
+        from options, like workers=8, policy='drop_oldest'). None runs them on the reciving thread again.
+        With processes=True, only proc_recv functions run in the process pool (so they must be picklable);
+        the on* hooks are methods of the socket, and run on the dispatcher's threads"""
+        if dispatcher is None and options:
+            dispatcher = _dispatch.Dispatcher(**options)
+        self._dispatcher = dispatcher
+        return dispatcher
+
+    def set_history_limits(self, maxlen=1000, max_bytes=16 * 1024 * 1024):
+        """Sets how many messages (and bytes of data) the history keeps. None means unlimited"""
+        self._history.set_limits(maxlen, max_bytes)
+
+    def set_inbound_limits(self, messages=None, bytes=None, burst=1.0, policy=_limits.DROP):
+        """Limits each sender to messages per second and bytes per second, with bursts of up to burst
+        seconds' worth. Messages over the limit are dropped, or with policy='disconnect' their sender is
+        disconnected. With no limits, they're turned off. Returns the limits.InboundLimits"""
+        if messages is None and bytes is None:
+            self._inbound_limits = None
+            return None
+        self._inbound_limits = _limits.InboundLimits(messages, bytes, burst, policy)
+        return self._inbound_limits
 
     def set_ip(self, ip):
         """(Re-)binds the socket with given ip"""
@@ -467,12 +1675,60 @@ class socket():
 
     def set_max_acceptions(self, MAX):
         """Sets max allowed connections"""
-        self._socket.listen(MAX)
+        self.listen(MAX)
 
     def set_port(self, port):
         """(Re-)binds the socket with given port"""
         self.bind(self._ip, port)
 
+    def set_reassembly_limits(self, timeout=5.0, max_bytes=64 * 1024 * 1024, max_messages=1024, max_per_peer=64):
+        """Sets how long incomplete fragmented messages are kept, how much memory they can use, and how many
+        of them there can be, in all and from one peer"""
+        self._reassembler.timeout = timeout
+        self._reassembler.max_bytes = max_bytes
+        self._reassembler.max_messages = max_messages
+        self._reassembler.max_per_peer = max_per_peer
+
+    def set_recv_batch(self, count=32):
+        """Sets how many datagrams the reactor recives per syscall (with recvmmsg, where there is one) when
+        draining the socket. 0 recives one datagram per readiness event instead"""
+        self._recv_batch_size = count
+        self._recv_batch = None
+
+    def set_recv_queue_limits(self, maxlen=10000, max_bytes=64 * 1024 * 1024):
+        """Sets how many messages (and bytes of data) threaded_recvs holds. None means unlimited"""
+        self._threaded_recvs.set_limits(maxlen, max_bytes)
+
+    def set_reliable(self, enabled=True, **options):
+        """Turns reliable delivery of sent datagrams on or off (see pysocket.reliable). ACKs are handled
+        as the socket recives, so it must be threaded (or keep reciving) for its sends to make progress.
+        options, like max_window or min_rto, are used for the channels to peers which haven't been sent to yet"""
+        self._reliable = enabled
+        if options:
+            self._reliability.options = options
+
+    def set_send_queues(self, enabled=True, maxlen=1000, max_bytes=4 * 1024 * 1024, policy=_limits.DROP_OLDEST):
+        """Queues sends (up to maxlen messages and max_bytes per destination) for the reactor to write out
+        without blocking, so a slow peer can't hold up sends to anyone else. When a destination's queue is
+        full, policy drops its oldest message ('drop_oldest'), the new one ('drop') or disconnects it
+        ('disconnect'). Returns the limits.SendQueues"""
+        if not enabled:
+            queues, self._send_queues = self._send_queues, None
+            if queues is not None:
+                queues.drain(self._write_queued)  # Best effort, then back to sending straight away
+            return None
+        self._send_queues = _limits.SendQueues(maxlen, max_bytes, policy)
+        return self._send_queues
+
+    def set_serializer(self, serializer=None, allow=None):
+        """Sets the serializer (id or name) send_obj uses by default, and if allow is given, the serializers
+        recived objects are accepted from. Pickle isn't accepted unless it's allowed, as unpickling lets the
+        peer run code, so only allow it from trusted peers"""
+        if serializer is not None:
+            self._serializer = _serialization.get(serializer)
+        if allow is not None:
+            self._allowed_serializers = set(_serialization.get(id).id for id in allow)
+
     def set_socket_fam(self, family):
         """Remakes the socket with given family"""
         self._socket = _socket.socket(family, self._socket_type, self._socket_proto, self._socket_sock)
@@ -493,23 +1749,49 @@ class socket():
         self._socket = _socket.socket(self._socket_fam, type, self._socket_proto, self._socket_sock)
         self._socket_type = type
 
-    def settimeout(self, timeout):
-        """Sets socket timeout"""
-        self._timeout = timeout
-        self._socket.settimeout(timeout)
+    def set_tracer(self, tracer=None, **options):
+        """Traces the stages of sent and recived messages with a tracing.Tracer (or makes one from
+        options, like sample=0.01, slow=0.005). None stops tracing"""
+        if tracer is None and options:
+            tracer = _tracing.Tracer(**options)
+        self._tracer = tracer
+        return tracer
 
     def setsockopt(self, level, option, value):
         self._socket.setsockopt(level, option, value)
 
+    def settimeout(self, timeout):
+        """Sets socket timeout"""
+        self._timeout = timeout
+        if not self._listening:
+            self._socket.settimeout(timeout)  # A listening socket stays non-blocking
+
+    def stats(self):
+        """Returns a snapshot of the socket's metrics (see pysocket.metrics): messages and bytes in and out,
+        compression ratio, send and recive latency, swallowed errors, queue depths and traffic per client"""
+        stats = self._metrics.snapshot()
+        stats['queues'] = {'threaded_recvs': len(self._threaded_recvs), 'history': len(self._history),
+                           'ready': len(self._ready), 'reassembly': len(self._reassembler),
+                           'dispatcher': len(self._dispatcher) if self._dispatcher is not None else 0,
+                           'send': len(self._send_queues) if self._send_queues is not None else 0}
+        stats['dropped'] = self.getdropped()
+        stats['connected_clients'] = len(self._clients)
+        return stats
+
     def stop_threads(self):
-        """If all threads"""
-        self._always_accept = False
+        """Stops all of the threaded reciving"""
         self._stop_recv = True
         self._recv_started = False
+        self._unwatch()
+
+    def subscribe(self, topic):
+        """Asks the server to send this client what's published to topic, which may have wildcards
+        (see pysocket.topics)"""
+        self._send_control(_frame.SUBSCRIBE, topic)
 
     def threaded_recvs(self):
-        """Returns data recived by the threads"""
-        return self._threaded_recvs
+        """Returns (without removing) the data recived by the threads"""
+        return list(self._threaded_recvs)
 
     def type(self):
         return self._socket_type
@@ -518,67 +1800,197 @@ class socket():
         """Unbinds socket"""
         self.__reinit__()
 
+    def unsubscribe(self, topic):
+        """Undoes subscribe(topic)"""
+        self._send_control(_frame.UNSUBSCRIBE, topic)
+
 
 class Server(socket):
 
     """Server class which can be sub-classed"""
 
-    def __init__(self, addr, thread=True, _timeout=0.5):
-        socket.__init__(self, timeout=_timeout)
+    def __init__(self, addr, thread=True, _timeout=0.5, workers=None, type=_socket.SOCK_DGRAM, legacy=False):
+        """Makes a server on addr (over TCP if type is SOCK_STREAM). If workers is given, serve() starts
+        that many worker processes which share addr (using SO_REUSEPORT), and this process only supervises them.
+        If legacy is true, it speaks the old protocol, for clients which haven't moved to frames"""
+        socket.__init__(self, type=type, timeout=_timeout, legacy=legacy)
+        self._workers = None  # workers.Supervisor when serving from worker processes
+        self._worker = None  # Index of this worker, in a worker process
+        self._reuse_port = bool(workers)
         self.bind(addr[0], addr[1])
         self._thread = thread
 
-    def sendtoall(self, data, _ip=None):
-        for client in self.getclients():
-            if _ip:
-                if not client[1] is _ip[1]:
-                    self.sendto(data, client[0], client[1])
-            else:
-                self.sendto(data, client[0], client[1])
-
-    def setthread(self, true_false):
-        self._thread = true_false
+        if workers:
+            self._ip, self._port = self._socket.getsockname()[:2]  # So every worker binds the same port, even if it was 0
+            self._workers = _workers.Supervisor(self._run_worker, workers)
 
-    def serve(self, _retdata=False, _rettoall=True):
-        """Simple serving function"""
+    def _expire_clients(self, heartbeats):
+        """Removes the clients which haven't been heard from for too long, as if they'd left. Runs on the
+        reactor every tick of the timing wheel"""
+        if self._heartbeats is not heartbeats:
+            return  # Turned off (or replaced) meanwhile
+        try:
+            for addr in heartbeats.expire():
+                if not addr in self._clients:
+                    continue
+                try:
+                    self._close_conn(addr)
+                    self._rem_client(addr)
+                except Exception as error:
+                    self._metrics.error(error)  # One client (or its onDisconnect) failing mustn't stop the others expiring
+                    _traceback.print_exc()
+        finally:
+            if self._heartbeats is heartbeats:
+                self._heartbeat_timer = _reactor.get_reactor().call_later(heartbeats.wheel.tick, self._expire_clients,
+                                                                          heartbeats)
+
+    def _forwarded(self, mask):
+        """Broadcasts data forwarded from the other workers to this worker's clients"""
+        for port, data in self._workers.forwarded(self._worker):
+            self._sendtoall(data, port)
+
+    def _run_worker(self, index):
+        """Serves the clients the kernel gives this worker. Runs in the worker process"""
+        def terminate(signum, frame):
+            self.quit()
+            raise SystemExit
+
+        self._worker = index
+        self._thread = True
+        self.bind(self._ip, self._port)  # Joins the SO_REUSEPORT group of the other workers
+        _reactor.get_reactor().register(self._workers.controls[index], self._forwarded)
+        _signal.signal(_signal.SIGTERM, terminate)
+        self.serve()
+        self._workers.ready(index)
+
+        while not self._workers.orphaned():
+            _time.sleep(self._workers.interval)
+
+    def _sendtoall(self, data, port=0):
+        """Sends data to this process's clients, except the one using port"""
+        if port:
+            self._broadcast(data, [client for client in self._clients if client[1] != port])
+        else:
+            self._broadcast(data, self._clients)
 
-        if self._thread:
-            _threading.Timer(0.1, self.serve).start()
-        
+    def _serve(self, _retdata=False, _rettoall=True):
         try:
-            data, ip = self.recvfrom()
+            recived = self.recvfrom()
+            if not recived:
+                return  # Timed out, which recv has already counted
+            data, ip = recived
             if _rettoall:
-                if not data is '':
+                if data:
                     self.sendtoall(data, ip)
                     if _retdata:
                         return (ip, data)
-        except:
-            pass
+        except (SocketError, OSError, _frame.FrameError) as error:
+            self._metrics.error(error)  # Count it, but keep serving
+
+    def bind(self, addr='127.0.0.1', port=8000):
+        """Binds ip and port to socket, and listens for connections if it's a stream socket"""
+        socket.bind(self, addr, port)
+        if self._binded and self._is_stream():
+            self.listen(_socket.SOMAXCONN)
 
     def quit(self):
         """Quits server after disconnecting all clients"""
         self.disconnect_all()
         self.close()
         self._thread = False
+        if self._workers is not None and self._worker is None:
+            self._workers.stop()
+
+    def sendtoall(self, data, _ip=None):
+        """Sends data to all clients (of every worker), except the one using the port of _ip if given"""
+        port = _ip[1] if _ip else 0
+        if self._workers is None or self._worker is not None:
+            self._sendtoall(data, port)  # The supervisor has no clients of its own
+        if self._workers is not None:
+            self._workers.forward(data, port, self._worker)
+
+    def serve(self, _retdata=False, _rettoall=True):
+        """Simple serving function. If the server is threaded, serves from the reactor whenever data arrives.
+        With workers, starts the worker processes (and returns once they're serving)"""
+
+        if self._workers is not None and self._worker is None:
+            if self._workers.processes[0] is None:
+                self.unbind()  # Leave the port to the workers
+                self._workers.start()
+            return
+
+        if self._thread:
+            self._watch(lambda mask: self._serve(_retdata, _rettoall))
+            return
+
+        return self._serve(_retdata, _rettoall)
+
+    def set_heartbeat(self, interval=1.0, misses=3):
+        """Expects clients to be heard from (see Client.set_heartbeat) every interval seconds, and removes ones
+        which have been quiet for misses intervals, calling onDisconnect. Frames are only heard while the server
+        is serving or reciving. None turns it off. Returns the heartbeat.Heartbeats, or None"""
+        self._stop_heartbeat()
+        if interval is None:
+            return None
+
+        heartbeats = self._heartbeats = _heartbeat.Heartbeats(interval, misses)
+        for client in self._clients:
+            heartbeats.seen(client)
+        self._heartbeat_timer = _reactor.get_reactor().call_later(heartbeats.wheel.tick, self._expire_clients, heartbeats)
+        return heartbeats
+
+    def setthread(self, true_false):
+        self._thread = true_false
 
 
 class Client(socket):
 
     """Client class which can be sub-classed"""
 
-    def __init__(self, addr, server, _timeout=0.5):
-        socket.__init__(self, timeout=_timeout)
+    def __init__(self, addr, server, _timeout=0.5, type=_socket.SOCK_DGRAM, legacy=False):
+        """Makes a client on addr, connected to server. If legacy is true, it speaks the old protocol"""
+        socket.__init__(self, type=type, timeout=_timeout, legacy=legacy)
         self.bind(addr[0], addr[1])
         self.connect(server[0], server[1])  
 
+    def _send_heartbeat(self, interval):
+        if self._heartbeat_timer is None:
+            return  # Turned off meanwhile
+        if self._connected:
+            try:
+                self._send_frames(_frame.HEARTBEAT, b'', 0, None)
+            except Exception as error:
+                self._catch_exceptions(error)
+        self._heartbeat_timer = _reactor.get_reactor().call_later(interval, self._send_heartbeat, interval)
+
     def proc_recv(self, func):
-        """Threaded function to recive data and call *func* with the data as the arg"""
-        self.recv(_isthread=True)
-        for data in self.threaded_recvs():
-            func(data)  # Call the function with data as the arg
-        _threading.Timer(0.5, target=self.proc_recv, args=(func))  # Thread function
+        """Calls *func* with the data as the arg whenever data is recived (from the reactor thread). With a
+        process dispatcher, func has to be picklable (a module level function)"""
+        if self._dispatcher is not None and self._dispatcher.processes:
+            try:
+                _pickle.dumps(func)
+            except Exception as error:
+                raise SocketError("proc_recv functions must be picklable with a process dispatcher (%s)" % error)
+
+        def recv_ready(mask):
+            data = self._recv(False, False, False, True, True)
+            trace, self._recv_trace = self._recv_trace, None
+            if data:
+                self._dispatch(func, data, key=self._peer, trace=trace)  # Call the function with data as the arg
+            elif trace is not None:
+                self._finish_trace(trace)
+
+        self._recv_started = True
+        self._watch(recv_ready)
 
     def quit(self):
         """Quits server after disconnecting all clients"""
         self.leave()
         self.close()
+
+    def set_heartbeat(self, interval=1.0):
+        """Sends the server a heartbeat every interval seconds, so a server with heartbeats on (see
+        Server.set_heartbeat) knows the client is still there while it has nothing to send. None turns it off"""
+        self._stop_heartbeat()
+        if interval is not None:
+            self._heartbeat_timer = _reactor.get_reactor().call_later(interval, self._send_heartbeat, interval)
@@ -0,0 +1,203 @@
+"""
+pysocket.reactor
+~~~~~~~~~~~~~~~~
+
+A single event loop thread, built on selectors (epoll on Linux), which watches
+every threaded pysocket socket in the process and runs timed callbacks. It
+replaces re-arming a threading.Timer for every poll, so data is handled as soon
+as it arrives and the number of threads doesn't grow with the number of sockets.
+
+"""
+
+import collections as _collections
+import heapq as _heapq
+import itertools as _itertools
+import os as _os
+import selectors as _selectors
+import socket as _socket
+import threading as _threading
+import time as _time
+import traceback as _traceback
+
+EVENT_READ = _selectors.EVENT_READ
+EVENT_WRITE = _selectors.EVENT_WRITE
+
+
+class TimerHandle(object):
+
+    """Returned by Reactor.call_later. Call cancel() to stop the callback from running"""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor(object):
+
+    """Event loop which calls the registered callback of a file object when it's ready"""
+
+    def __init__(self):
+        self._selector = _selectors.DefaultSelector()
+        self._timers = []
+        self._counter = _itertools.count()  # Keeps timers with the same deadline in order
+        self._pending = _collections.deque()
+        self._thread = None
+        self._running = False
+        self._lock = _threading.Lock()
+
+        # Writing to this wakes the loop up when another thread gives it work
+        self._wake_r, self._wake_w = _socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, EVENT_READ, self._drain_wakeup)
+
+    def _add_timer(self, handle):
+        _heapq.heappush(self._timers, (handle.when, next(self._counter), handle))
+
+    def _call(self, callback, *args):
+        """Runs callback now if on the loop thread, otherwise queues it for the loop"""
+        if self.in_loop():
+            callback(*args)
+        else:
+            self.call_soon(callback, *args)
+
+    def _drain_wakeup(self, mask):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _register(self, fileobj, callback, events):
+        try:
+            self._selector.modify(fileobj, events, callback)
+        except KeyError:
+            self._selector.register(fileobj, events, callback)
+        except ValueError:
+            pass  # File object was closed before the loop got to it
+
+    def _run(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            _traceback.print_exc()  # Don't let one bad callback stop the whole loop
+
+    def _run_once(self):
+        """Waits for the next event or timer and runs its callbacks"""
+        timeout = None
+        if self._pending:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - _time.monotonic())
+
+        for key, mask in self._selector.select(timeout):
+            # An earlier callback may have unregistered this one
+            if self._selector.get_map().get(key.fd) is not key:
+                continue
+            self._run(key.data, mask)
+
+        now = _time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            handle = _heapq.heappop(self._timers)[2]
+            if not handle.cancelled:
+                self._run(handle.callback, *handle.args)
+
+        for i in range(len(self._pending)):
+            callback, args = self._pending.popleft()
+            self._run(callback, *args)
+
+    def _unregister(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass  # Was never registered (or already unregistered)
+
+    def call_later(self, delay, callback, *args):
+        """Runs callback(*args) on the loop thread after delay seconds. Returns a TimerHandle"""
+        handle = TimerHandle(_time.monotonic() + delay, callback, args)
+        self._call(self._add_timer, handle)
+        return handle
+
+    def call_soon(self, callback, *args):
+        """Runs callback(*args) on the loop thread as soon as possible. Safe to call from any thread"""
+        self._pending.append((callback, args))
+        self.start()
+        if not self.in_loop():
+            try:
+                self._wake_w.send(b'\0')
+            except (BlockingIOError, InterruptedError):
+                pass  # Wakeup socket is full, so the loop is going to wake up anyway
+
+    def in_loop(self):
+        """Returns if the caller is running on the loop thread"""
+        return self._thread is _threading.current_thread()
+
+    def register(self, fileobj, callback, events=EVENT_READ):
+        """Calls callback(mask) whenever fileobj is ready for events. Re-registering replaces the callback"""
+        self._call(self._register, fileobj, callback, events)
+
+    def run(self):
+        """Runs the loop on the current thread until stop() is called"""
+        self._thread = _threading.current_thread()
+        self._running = True
+        while self._running:
+            self._run_once()
+        self._thread = None
+
+    def start(self):
+        """Starts the loop thread if it isn't already running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = _threading.Thread(target=self.run, name='pysocket-reactor')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """Stops the loop after its current iteration"""
+        def stop():
+            self._running = False
+        self.call_soon(stop)
+
+    def unregister(self, fileobj):
+        """Stops watching fileobj"""
+        self._call(self._unregister, fileobj)
+
+    def wait(self, timeout=None):
+        """Waits until the loop has run what was queued before now, so a callback which was unregistered isn't
+        still running (on a socket about to be closed, say). Returns False if timeout ran out first"""
+        if self._thread is None or self.in_loop():
+            return True
+        done = _threading.Event()
+        self.call_soon(done.set)
+        return done.wait(timeout)
+
+
+_reactor = None
+_reactor_lock = _threading.Lock()
+
+
+def get_reactor():
+    """Returns the reactor shared by every socket in the process"""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+        return _reactor
+
+
+def _after_fork():
+    """The loop thread doesn't survive a fork, so a child process starts with no reactor"""
+    global _reactor, _reactor_lock
+    _reactor = None
+    _reactor_lock = _threading.Lock()
+
+
+if hasattr(_os, 'register_at_fork'):
+    _os.register_at_fork(after_in_child=_after_fork)
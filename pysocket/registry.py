@@ -0,0 +1,141 @@
+"""
+pysocket.registry
+~~~~~~~~~~~~~~~~~
+
+The containers sockets keep their clients and blocked addresses in. Adding,
+removing and looking up a client are O(1), and checking an address against
+the blocklist costs at most one step per bit of the address, however many
+ranges are blocked.
+
+"""
+
+import ipaddress as _ipaddress
+
+
+class ClientRegistry(object):
+
+    """Clients keyed by (ip, port), with a secondary index of the ports used by each ip"""
+
+    def __init__(self):
+        self._clients = {}  # (ip, port) -> value, in the order the clients were added
+        self._by_ip = {}  # ip -> {port: None}, in the order the ports were added
+
+    def __contains__(self, addr):
+        return tuple(addr) in self._clients
+
+    def __iter__(self):
+        return iter(list(self._clients))
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __repr__(self):
+        return 'ClientRegistry(%r)' % list(self)
+
+    def add(self, addr, value=None):
+        """Adds a client (or replaces its value if it's already added)"""
+        addr = tuple(addr)
+        self._clients[addr] = value
+        self._by_ip.setdefault(addr[0], {})[addr[1]] = None
+
+    def clear(self):
+        self._clients.clear()
+        self._by_ip.clear()
+
+    def get(self, ip, port=None):
+        """Returns (ip, port) of a client, or None. If no port is given the first client using ip is returned"""
+        if port is not None:
+            return (ip, port) if (ip, port) in self._clients else None
+
+        ports = self._by_ip.get(ip)
+        if ports:
+            return (ip, next(iter(ports)))
+
+    def remove(self, addr):
+        """Removes a client. Returns if it was added"""
+        addr = tuple(addr)
+        if self._clients.pop(addr, self) is self:
+            return False
+
+        ports = self._by_ip[addr[0]]
+        del ports[addr[1]]
+        if not ports:
+            del self._by_ip[addr[0]]
+        return True
+
+    def value(self, addr, default=None):
+        """Returns the value stored with a client"""
+        return self._clients.get(tuple(addr), default)
+
+
+class Blocklist(object):
+
+    """Blocked ips and CIDR ranges (like '10.0.0.0/8'), kept in a binary prefix trie. Anything else (like a
+    hostname) is blocked by exact match, as add_blocked always allowed"""
+
+    def __init__(self, entries=()):
+        self._roots = {4: [None, None, False], 6: [None, None, False]}  # Node: [zero child, one child, blocked]
+        self._entries = {}  # Entries as they were given, in the order they were added
+        self._names = set()  # Entries which aren't ips or ranges
+        for entry in entries:
+            self.add(entry)
+
+    def __contains__(self, ip):
+        if ip in self._names:
+            return True
+        try:
+            addr = _ipaddress.ip_address(u'%s' % (ip,))
+        except ValueError:
+            return False  # Not an ip, so can't be in a range
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+
+        node = self._roots[addr.version]
+        value = int(addr)
+        for bit in range(addr.max_prefixlen - 1, -1, -1):
+            if node[2]:
+                return True
+            node = node[(value >> bit) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _walk(self, network, create):
+        node = self._roots[network.version]
+        value = int(network.network_address)
+        for bit in range(network.max_prefixlen - 1, network.max_prefixlen - network.prefixlen - 1, -1):
+            child = (value >> bit) & 1
+            if node[child] is None:
+                if not create:
+                    return None
+                node[child] = [None, None, False]
+            node = node[child]
+        return node
+
+    def add(self, entry):
+        """Blocks an ip or a CIDR range, or anything else by exact match"""
+        try:
+            network = _ipaddress.ip_network(u'%s' % (entry,), strict=False)
+        except ValueError:
+            self._names.add(entry)
+        else:
+            self._walk(network, True)[2] = True
+        self._entries[entry] = None
+
+    def remove(self, entry):
+        """Unblocks an entry which was added with add()"""
+        try:
+            network = _ipaddress.ip_network(u'%s' % (entry,), strict=False)
+        except ValueError:
+            self._names.discard(entry)
+        else:
+            node = self._walk(network, False)
+            if node is not None:
+                node[2] = False
+        self._entries.pop(entry, None)
@@ -0,0 +1,345 @@
+"""
+pysocket.reliable
+~~~~~~~~~~~~~~~~~
+
+Opt-in reliable delivery for datagram sockets. Every peer gets its own send
+channel, so a lossy client only slows down delivery to itself:
+
+    * frames carry FLAG_RELIABLE and a per-channel sequence number
+    * the receiver delivers them in order, holding early frames back, and
+      answers every frame with an ACK of the next sequence number it expects
+      plus SACK blocks of the frames it holds beyond that
+    * the retransmit timeout follows the measured RTT (RFC 6298, with Karn's
+      rule of not timing retransmitted frames, or ones presumed lost)
+    * a frame is resent as soon as 3 frames sent after it have been SACKed
+      (fewer when fewer are in flight). On a timeout, every frame which has
+      been out for longer than the timeout is presumed lost, and they're
+      resent before any new frames as the window opens again
+    * the number of frames in flight is limited by a congestion window which
+      grows by one frame per ACK until ssthresh, then by one frame per window,
+      and is halved on a fast retransmit (reset to 1 on a timeout)
+
+"""
+
+import collections as _collections
+import struct as _struct
+import threading as _threading
+import time as _time
+
+from . import reactor as _reactor
+
+ACK = _struct.Struct('!IB')  # Next sequence number expected, number of SACK blocks
+SACK = _struct.Struct('!II')  # First and last (inclusive) sequence numbers of a block held by the receiver
+MAX_SACKS = 16
+DUPTHRESH = 3  # Frames SACKed after a missing one before it's resent
+
+_MASK = 0xffffffff
+
+
+def _diff(a, b):
+    """a - b for 32 bit sequence numbers which wrap around"""
+    d = (a - b) & _MASK
+    return d - 0x100000000 if d & 0x80000000 else d
+
+
+def pack_ack(expected, blocks=()):
+    blocks = list(blocks)[:MAX_SACKS]
+    return ACK.pack(expected, len(blocks)) + b''.join(SACK.pack(first, last) for first, last in blocks)
+
+
+def unpack_ack(payload):
+    """Returns (expected, [(first, last), ...]) from an ACK payload"""
+    expected, count = ACK.unpack_from(payload)
+    blocks = [SACK.unpack_from(payload, ACK.size + i * SACK.size) for i in range(count)
+              if ACK.size + (i + 1) * SACK.size <= len(payload)]
+    return expected, blocks
+
+
+class _Entry(object):
+
+    __slots__ = ('datagram', 'sent', 'retries', 'sacked', 'lost', 'resent')
+
+    def __init__(self, datagram):
+        self.datagram = datagram
+        self.sent = None
+        self.retries = 0
+        self.sacked = False
+        self.lost = False  # Presumed lost after a timeout, and waiting to be resent
+        self.resent = False  # Fast retransmitted in the current recovery
+
+
+class SendChannel(object):
+
+    """Reliable sending to one peer. transmit(datagram) puts a datagram on the wire"""
+
+    def __init__(self, transmit, max_window=256, min_rto=0.2, max_rto=10.0, max_retries=10):
+        self.max_window = max_window
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 1.0
+        self.cwnd = 2.0
+        self.ssthresh = float(max_window)
+        self.retransmits = 0
+        self.failed = 0  # Frames given up on after max_retries
+        self._transmit = transmit
+        self._seq = 0
+        self._unacked = _collections.OrderedDict()  # seq -> _Entry, oldest first
+        self._backlog = _collections.deque()  # (seq, datagram) waiting for room in the window
+        self._recover = None  # Highest seq sent when the current fast recovery started
+        self._timer = None
+        self.lock = _threading.RLock()  # Hold while numbering and sending frames, to keep them in order
+
+    def __len__(self):
+        """Frames which haven't been acknowledged yet"""
+        return len(self._unacked) + len(self._backlog)
+
+    def _arm(self):
+        if self._timer is None and self._unacked:
+            self._timer = _reactor.get_reactor().call_later(self.rto, self._on_timeout)
+
+    def _fill(self):
+        """Sends frames while the window has room, resending lost frames before new ones"""
+        room = min(int(self.cwnd), self.max_window) - self._in_flight()
+        for entry in self._unacked.values():
+            if room <= 0:
+                break
+            if entry.lost:
+                entry.lost = False
+                self._resend(entry)
+                room -= 1
+
+        while self._backlog and room > 0:
+            seq, datagram = self._backlog.popleft()
+            entry = self._unacked[seq] = _Entry(datagram)
+            self._send(entry)
+            room -= 1
+        self._arm()
+
+    def _in_flight(self):
+        return sum(1 for entry in self._unacked.values() if not entry.sacked and not entry.lost)
+
+    def _on_timeout(self):
+        with self.lock:
+            self._timer = None
+            if not self._unacked:
+                return
+
+            now = _time.monotonic()
+            oldest = next(iter(self._unacked.values()))
+            if now - oldest.sent >= self.rto:
+                if oldest.retries >= self.max_retries:
+                    # The peer has gone, so stop trying
+                    self.failed += len(self)
+                    self._unacked.clear()
+                    self._backlog.clear()
+                    return
+
+                # Nothing has got through for a whole timeout, so start again from one frame
+                self.ssthresh = max(self._in_flight() / 2.0, 2.0)
+                self.cwnd = 1.0
+                for entry in self._unacked.values():
+                    if not entry.sacked and now - entry.sent >= self.rto:
+                        entry.lost = True
+                self.rto = min(self.rto * 2, self.max_rto)
+                self._recover = None
+                oldest.lost = False
+                self._resend(oldest)
+            self._arm()
+
+    def _resend(self, entry):
+        entry.retries += 1
+        self.retransmits += 1
+        self._send(entry)
+
+    def _rtt_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def _send(self, entry):
+        entry.sent = _time.monotonic()
+        self._transmit(entry.datagram)
+
+    def ack(self, expected, blocks=()):
+        """Handles an ACK from the peer"""
+        with self.lock:
+            now = _time.monotonic()
+            acked = 0
+
+            # Cumulative part: everything before expected has arrived
+            while self._unacked:
+                seq, entry = next(iter(self._unacked.items()))
+                if _diff(seq, expected) >= 0:
+                    break
+                del self._unacked[seq]
+                if not entry.sacked:
+                    acked += 1
+                    if not entry.retries and not entry.lost:
+                        self._rtt_sample(now - entry.sent)
+
+            # Selective part
+            for first, last in blocks:
+                for seq, entry in self._unacked.items():
+                    if _diff(seq, first) >= 0 and _diff(seq, last) <= 0 and not entry.sacked:
+                        acked += 1
+                        if not entry.retries and not entry.lost:
+                            self._rtt_sample(now - entry.sent)
+                        entry.sacked = True
+                        entry.lost = False
+
+            if self._recover is not None and _diff(expected, self._recover) > 0:
+                self._recover = None  # Everything sent before the loss has arrived
+
+            # Grow the window
+            for i in range(acked):
+                self.cwnd += 1.0 if self.cwnd < self.ssthresh else 1.0 / self.cwnd
+            self.cwnd = min(self.cwnd, float(self.max_window))
+
+            # Fast retransmit the frames which DUPTHRESH later frames have overtaken. With only a
+            # few frames in flight there can't be that many, so fewer will do (early retransmit)
+            dupthresh = min(DUPTHRESH, max(1, len(self._unacked) - 1))
+            sacked_after = 0
+            for seq, entry in reversed(list(self._unacked.items())):
+                if entry.sacked:
+                    sacked_after += 1
+                elif sacked_after >= dupthresh and not entry.resent and not entry.lost:
+                    if self._recover is None:
+                        self._recover = next(reversed(self._unacked))
+                        self.ssthresh = max(self._in_flight() / 2.0, 2.0)
+                        self.cwnd = self.ssthresh
+                    entry.resent = True
+                    self._resend(entry)
+
+            if acked and self._timer is not None:
+                # Progress, so restart the timer from now
+                self._timer.cancel()
+                self._timer = None
+            self._fill()
+
+    def close(self):
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._unacked.clear()
+            self._backlog.clear()
+
+    def next_seq(self):
+        """Returns the sequence number for the next frame. Frames must be sent in this order"""
+        with self.lock:
+            seq = self._seq
+            self._seq = (self._seq + 1) & _MASK
+            return seq
+
+    def send(self, seq, datagram):
+        """Sends (or queues, if the window is full) a datagram carrying frame number seq"""
+        with self.lock:
+            self._backlog.append((seq, bytes(datagram)))
+            self._fill()
+
+    def stats(self):
+        return {'srtt': self.srtt, 'rto': self.rto, 'cwnd': self.cwnd, 'in_flight': self._in_flight(),
+                'queued': len(self._backlog), 'retransmits': self.retransmits, 'failed': self.failed}
+
+
+class RecvChannel(object):
+
+    """Puts the reliable frames from one sender back in order"""
+
+    def __init__(self, max_buffered=1024):
+        self.max_buffered = max_buffered
+        self.duplicates = 0
+        self._expected = 0
+        self._held = {}  # seq -> frame, for frames which arrived early
+
+    def _blocks(self):
+        """SACK blocks for the held frames, nearest first"""
+        blocks = []
+        for seq in sorted(self._held, key=lambda seq: _diff(seq, self._expected)):
+            if blocks and blocks[-1][1] == (seq - 1) & _MASK:
+                blocks[-1][1] = seq
+            else:
+                if len(blocks) == MAX_SACKS:
+                    break
+                blocks.append([seq, seq])
+        return blocks
+
+    def receive(self, frame):
+        """Returns (frames now deliverable in order, ACK payload to send back)"""
+        ready = []
+        distance = _diff(frame.seq, self._expected)
+
+        if distance < 0 or frame.seq in self._held:
+            self.duplicates += 1  # Already have it (our ACK was probably lost)
+        elif distance == 0:
+            ready.append(frame)
+            self._expected = (self._expected + 1) & _MASK
+            while self._expected in self._held:
+                ready.append(self._held.pop(self._expected))
+                self._expected = (self._expected + 1) & _MASK
+        elif distance < self.max_buffered:
+            self._held[frame.seq] = frame
+        # Otherwise it's too far ahead to hold, and the sender will have to resend it
+
+        return ready, pack_ack(self._expected, self._blocks())
+
+
+class Reliability(object):
+
+    """The send and receive channels of one socket. transmit(datagram, addr) puts a datagram on the wire"""
+
+    def __init__(self, transmit, **options):
+        self._transmit = transmit
+        self.options = options  # Passed to every SendChannel
+        self._send = {}  # addr -> SendChannel
+        self._recv = {}  # (addr, sender id) -> RecvChannel
+        self._lock = _threading.Lock()
+
+    def ack(self, addr, payload):
+        channel = self._send.get(tuple(addr))
+        if channel is not None:
+            expected, blocks = unpack_ack(payload)
+            channel.ack(expected, blocks)
+
+    def channel(self, addr):
+        """Returns the send channel for addr"""
+        addr = tuple(addr)
+        with self._lock:
+            channel = self._send.get(addr)
+            if channel is None:
+                channel = self._send[addr] = SendChannel(lambda datagram: self._transmit(datagram, addr), **self.options)
+            return channel
+
+    def close(self):
+        for channel in list(self._send.values()):
+            channel.close()
+        self._send.clear()
+        self._recv.clear()
+
+    def forget(self, addr):
+        """Drops the state kept for a peer which has gone"""
+        addr = tuple(addr)
+        channel = self._send.pop(addr, None)
+        if channel is not None:
+            channel.close()
+        for key in [key for key in self._recv if key[0] == addr]:
+            del self._recv[key]
+
+    def receive(self, addr, frame):
+        """Returns (frames now deliverable in order, ACK payload) for a reliable frame from addr"""
+        key = (tuple(addr), frame.sender)  # A new socket on the same address starts a new sequence
+        channel = self._recv.get(key)
+        if channel is None:
+            channel = self._recv[key] = RecvChannel()
+        return channel.receive(frame)
+
+    def stats(self):
+        """Returns {addr: send channel stats}"""
+        return dict((addr, channel.stats()) for addr, channel in list(self._send.items()))
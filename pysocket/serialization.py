@@ -0,0 +1,249 @@
+"""
+pysocket.serialization
+~~~~~~~~~~~~~~~~~~~~~~
+
+Registry of the serializers send_obj and recv_obj can use. The id of the
+serializer an object was sent with travels in its frame's header, so the
+receiver never has to guess:
+
+    * struct: a compact tagged binary format for None, bools, ints, floats,
+      str, bytes, lists, tuples and dicts. Always available
+    * pickle: pickle protocol 5. Buffers which support it (PickleBuffer, and
+      so numpy arrays) are sent out of band, straight from their own memory
+      instead of being copied into the pickle. Unpickling runs arbitrary code,
+      so sockets only accept pickled objects once they're allowed to
+    * msgpack: registered when the msgpack module can be imported
+
+dumps() returns a list of buffers, which are handed to sendmsg as they are.
+
+"""
+
+import pickle as _pickle
+import struct as _struct
+
+# Serializer ids, as sent in the frame header (4 bits, so up to 15)
+NONE = 0
+STRUCT = 1
+PICKLE = 2
+MSGPACK = 3
+
+
+class SerializerError(Exception):
+    pass
+
+
+class Serializer(object):
+
+    """Base class for serializers. Sub-class and register() to add a new one"""
+
+    id = NONE
+    name = 'none'
+    safe = True  # If loads can't run code, so any peer may send objects with it
+
+    def dumps(self, obj):
+        """Returns obj as a list of bytes-like objects"""
+        raise NotImplementedError
+
+    def loads(self, data):
+        """Returns the object in data (a memoryview of everything dumps returned, joined)"""
+        raise NotImplementedError
+
+
+_TAG = _struct.Struct('!c')
+_INT = _struct.Struct('!cq')
+_FLOAT = _struct.Struct('!cd')
+_SIZED = _struct.Struct('!cI')  # Tag, then the length (or number of items) of what follows
+
+
+class StructSerializer(Serializer):
+
+    id = STRUCT
+    name = 'struct'
+
+    def _dump(self, obj, parts):
+        if obj is None:
+            parts.append(b'N')
+        elif obj is True:
+            parts.append(b'T')
+        elif obj is False:
+            parts.append(b'F')
+        elif isinstance(obj, int):
+            if -0x8000000000000000 <= obj <= 0x7fffffffffffffff:
+                parts.append(_INT.pack(b'i', obj))
+            else:
+                data = obj.to_bytes((obj.bit_length() + 8) // 8, 'big', signed=True)
+                parts.append(_SIZED.pack(b'I', len(data)))
+                parts.append(data)
+        elif isinstance(obj, float):
+            parts.append(_FLOAT.pack(b'd', obj))
+        elif isinstance(obj, str):
+            data = obj.encode('utf-8')
+            parts.append(_SIZED.pack(b's', len(data)))
+            parts.append(data)
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            data = memoryview(obj).cast('B') if isinstance(obj, memoryview) else obj
+            parts.append(_SIZED.pack(b'b', len(data)))
+            parts.append(data)
+        elif isinstance(obj, (list, tuple)):
+            parts.append(_SIZED.pack(b'l' if isinstance(obj, list) else b't', len(obj)))
+            for item in obj:
+                self._dump(item, parts)
+        elif isinstance(obj, dict):
+            parts.append(_SIZED.pack(b'm', len(obj)))
+            for key, value in obj.items():
+                self._dump(key, parts)
+                self._dump(value, parts)
+        else:
+            raise SerializerError("The struct serializer can't send %s objects" % type(obj).__name__)
+
+    def _load(self, data, offset):
+        """Returns (object at offset, offset after it)"""
+        tag = data[offset:offset + 1].tobytes()
+        if tag == b'N':
+            return None, offset + 1
+        elif tag == b'T':
+            return True, offset + 1
+        elif tag == b'F':
+            return False, offset + 1
+        elif tag == b'i':
+            return _INT.unpack_from(data, offset)[1], offset + _INT.size
+        elif tag == b'd':
+            return _FLOAT.unpack_from(data, offset)[1], offset + _FLOAT.size
+
+        size = _SIZED.unpack_from(data, offset)[1]
+        offset += _SIZED.size
+        if tag in (b'I', b's', b'b'):
+            if offset + size > len(data):
+                raise SerializerError("Truncated object")
+            value = data[offset:offset + size]
+            if tag == b'I':
+                value = int.from_bytes(value, 'big', signed=True)
+            elif tag == b's':
+                value = value.tobytes().decode('utf-8')
+            else:
+                value = value.tobytes()
+            return value, offset + size
+        elif tag in (b'l', b't'):
+            items = []
+            for i in range(size):
+                item, offset = self._load(data, offset)
+                items.append(item)
+            return items if tag == b'l' else tuple(items), offset
+        elif tag == b'm':
+            value = {}
+            for i in range(size):
+                key, offset = self._load(data, offset)
+                value[key], offset = self._load(data, offset)
+            return value, offset
+        raise SerializerError("Unknown tag %r" % tag)
+
+    def dumps(self, obj):
+        parts = []
+        self._dump(obj, parts)
+        return [b''.join(parts)]
+
+    def loads(self, data):
+        try:
+            obj, offset = self._load(data, 0)
+        except _struct.error:
+            raise SerializerError("Truncated object")
+        if offset != len(data):
+            raise SerializerError("%d bytes left after the object" % (len(data) - offset))
+        return obj
+
+
+# Pickle payload: pickle length and number of out of band buffers, then the length of each buffer,
+# then the pickle, then the buffers
+_PICKLE = _struct.Struct('!II')
+_BUFFER = _struct.Struct('!Q')
+
+
+class PickleSerializer(Serializer):
+
+    id = PICKLE
+    name = 'pickle'
+    safe = False
+
+    def dumps(self, obj):
+        buffers = []
+
+        def out_of_band(buffer):
+            try:
+                buffers.append(buffer.raw())
+            except BufferError:
+                return True  # Not contiguous, so it has to be copied into the pickle
+            return False
+
+        data = _pickle.dumps(obj, 5, buffer_callback=out_of_band)
+        head = _PICKLE.pack(len(data), len(buffers)) + b''.join(_BUFFER.pack(len(buffer)) for buffer in buffers)
+        if not buffers:
+            return [head + data]
+        return [head, data] + buffers
+
+    def loads(self, data):
+        if len(data) < _PICKLE.size:
+            raise SerializerError("Truncated object")
+        size, count = _PICKLE.unpack_from(data)
+        offset = _PICKLE.size + count * _BUFFER.size
+        if offset > len(data):
+            raise SerializerError("Truncated object")
+        lengths = [_BUFFER.unpack_from(data, _PICKLE.size + i * _BUFFER.size)[0] for i in range(count)]
+        if offset + size + sum(lengths) != len(data):
+            raise SerializerError("Truncated object")
+
+        pickled = data[offset:offset + size]
+        offset += size
+        buffers = []
+        for length in lengths:
+            buffers.append(data[offset:offset + length])  # Views of the recived data, not copies
+            offset += length
+        return _pickle.loads(pickled, buffers=buffers)
+
+
+class MsgpackSerializer(Serializer):
+
+    id = MSGPACK
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, obj):
+        return [self._msgpack.packb(obj, use_bin_type=True)]
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data, raw=False)
+
+
+_serializers = {}
+
+
+def register(serializer):
+    """Registers a serializer instance, replacing any serializer with the same id"""
+    if not 0 < serializer.id < 16:
+        raise ValueError("Serializer ids must be from 1 to 15")
+    _serializers[serializer.id] = serializer
+
+
+def get(serializer):
+    """Returns the serializer with the given id or name (or the serializer itself, if given one)"""
+    if isinstance(serializer, Serializer):
+        return serializer
+    for registered in _serializers.values():
+        if serializer == registered.id or serializer == registered.name:
+            return registered
+    raise SerializerError("Unknown serializer %r" % (serializer,))
+
+
+def available():
+    """Returns the ids of all the registered serializers"""
+    return sorted(_serializers)
+
+
+register(StructSerializer())
+register(PickleSerializer())
+try:
+    register(MsgpackSerializer())
+except ImportError:
+    pass  # Optional dependency isn't installed
@@ -0,0 +1,159 @@
+"""
+pysocket.stream
+~~~~~~~~~~~~~~~
+
+Framing for SOCK_STREAM sockets. TCP doesn't keep message boundaries, so the
+length field of the frame header is used as a length prefix: frames are read
+into one reusable buffer, and every complete frame in it is parsed after each
+recv_into syscall, however many (or few) bytes it returned. Sends hand the
+header and payload to sendmsg together, so a message is one write without
+first being joined into a new bytes object.
+
+"""
+
+import os as _os
+import socket as _socket
+
+from . import frame as _frame
+
+MAX_FRAME = 256 * 1024 * 1024  # Larger lengths mean the stream is corrupt (or hostile)
+
+
+class StreamBuffer(object):
+
+    """Receive buffer for one stream. fill() reads into the free space at the end, and
+    frames() parses the complete frames at the start"""
+
+    def __init__(self, size=65536, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self._buf = bytearray(size)
+        self._start = 0  # Start of the unparsed data
+        self._end = 0  # End of the data
+
+    def __len__(self):
+        """Bytes recived but not parsed yet"""
+        return self._end - self._start
+
+    def _make_room(self):
+        """Moves unparsed data to the front of the buffer, growing it if the next frame won't fit"""
+        needed = self._needed()
+        if self._start:
+            self._buf[:self._end - self._start] = self._buf[self._start:self._end]
+            self._end -= self._start
+            self._start = 0
+        if needed > len(self._buf):
+            self._buf.extend(bytes(needed - len(self._buf)))
+
+    def _needed(self):
+        """Size of the frame at the start of the buffer, or the header size if that isn't known yet"""
+        if self._end - self._start < _frame.HEADER.size:
+            return _frame.HEADER.size
+        length = _frame.HEADER.unpack_from(self._buf, self._start)[-1]
+        return _frame.HEADER.size + length
+
+    def fill(self, sock):
+        """Does one recv_into from sock. Returns the number of bytes read (0 means the stream has ended)"""
+        if self._end == len(self._buf):
+            self._make_room()
+        size = sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += size
+        return size
+
+    def frames(self):
+        """Yields every complete frame in the buffer. Raises FrameError if the stream isn't pysocket frames"""
+        while self._end - self._start >= _frame.HEADER.size:
+            if self._buf[self._start:self._start + 2] != _frame.MAGIC:
+                raise _frame.FrameError("Stream is out of sync (bad magic)")
+
+            size = self._needed()
+            if size - _frame.HEADER.size > self.max_frame:
+                raise _frame.FrameError("Frame of %d bytes is over the limit" % (size - _frame.HEADER.size))
+            if self._end - self._start < size:
+                return
+
+            # The buffer is reused (and may be resized), so copy the payload out of it
+            with memoryview(self._buf) as view:
+                frame = _frame.unpack(view[self._start:self._start + size])
+                frame = frame._replace(payload=bytes(frame.payload))
+            self._start += size
+            if self._start == self._end:
+                self._start = self._end = 0
+            yield frame
+
+
+class Connection(object):
+
+    """One end of a stream: the socket, its peer's address and its receive buffer"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = tuple(addr)
+        self.buffer = StreamBuffer()
+
+        # Every frame is already written in one go, so waiting to fill a segment only adds latency
+        if sock.family in (_socket.AF_INET, _socket.AF_INET6):
+            sock.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
+
+    def __repr__(self):
+        return 'Connection(%r)' % (self.addr,)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, buffers):
+        """Writes buffers to the stream, in as few syscalls as possible"""
+        sendmsg_all(self.sock, buffers)
+
+
+def sendmsg_all(sock, buffers):
+    """Like socket.sendall for a list of buffers. They're written together with sendmsg,
+    so short sends only resend what's left instead of joining the buffers first"""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(bytes(buf) for buf in buffers))
+        return
+
+    buffers = [memoryview(buf).cast('B') for buf in buffers if len(buf)]
+    total = sum(len(buf) for buf in buffers)
+    while buffers:
+        try:
+            sent = sock.sendmsg(buffers)
+        except _socket.timeout:
+            if sum(len(buf) for buf in buffers) == total:
+                raise  # Nothing was written, so the stream is still in sync
+            continue  # Part of a frame was written, so the rest has to follow
+        while sent and buffers:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def sendfile_all(sock, fileobj, offset, count):
+    """Writes count bytes of fileobj from offset to sock with socket.sendfile (so the kernel's sendfile,
+    where there is one). Unlike socket.sendfile, it carries on when the socket's timeout passes, as long
+    as the peer is taking some of the data"""
+    end = offset + count
+    while offset < end:
+        fileobj.seek(offset)
+        try:
+            sock.sendfile(fileobj, offset, end - offset)
+        except _socket.timeout:
+            if fileobj.tell() == offset:
+                raise  # Nothing was taken for a whole timeout
+        offset = fileobj.tell()  # sendfile leaves the file after what it sent, even when it times out
+
+
+def send_nowait(sock, data):
+    """Writes as much of data to sock as it can take straight away. Returns the number of bytes written,
+    or raises BlockingIOError if it can't take any"""
+    if sock.gettimeout() is None:
+        return sock.send(data, getattr(_socket, 'MSG_DONTWAIT', 0))
+    # A socket with a timeout is non-blocking underneath, but send would wait up to the timeout for room
+    return _os.write(sock.fileno(), data)
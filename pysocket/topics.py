@@ -0,0 +1,133 @@
+"""
+pysocket.topics
+~~~~~~~~~~~~~~~
+
+The index a server keeps of which clients are subscribed to which topics.
+Topics are '.' separated levels, like 'scores.football.live'. A subscription
+can use '*' for any one level ('scores.*.live'), or end in '#' for any number
+of levels, none included ('scores.#' matches 'scores' and 'scores.football.live').
+
+Subscriptions are kept in a trie of levels, so finding the subscribers of a
+topic costs one step per level (per matching wildcard) and one per subscriber,
+however many clients and subscriptions there are.
+
+"""
+
+WILDCARD = '*'
+REST = '#'
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'subscribers', 'rest')
+
+    def __init__(self):
+        self.children = {}  # Level (or WILDCARD) -> _Node
+        self.subscribers = {}  # Clients subscribed to exactly this node
+        self.rest = {}  # Clients subscribed to this node followed by REST
+
+
+def _levels(pattern):
+    levels = pattern.split('.')
+    if REST in levels[:-1]:
+        raise ValueError("%r can only be the last level of %r" % (REST, pattern))
+    return levels
+
+
+class TopicIndex(object):
+
+    """Subscriptions of clients (addresses) to topics, and the topics each client is subscribed to"""
+
+    def __init__(self):
+        self._root = _Node()
+        self._by_client = {}  # addr -> {pattern: None}, in the order they subscribed
+
+    def __contains__(self, addr):
+        return tuple(addr) in self._by_client
+
+    def __len__(self):
+        """Number of subscriptions"""
+        return sum(len(patterns) for patterns in self._by_client.values())
+
+    def clear(self):
+        self._root = _Node()
+        self._by_client.clear()
+
+    def match(self, topic):
+        """Returns the clients subscribed to topic, each once"""
+        matched = {}
+        nodes = [self._root]
+        for level in topic.split('.'):
+            found = []
+            for node in nodes:
+                matched.update(node.rest)
+                child = node.children.get(level)
+                if child is not None:
+                    found.append(child)
+                child = node.children.get(WILDCARD)
+                if child is not None:
+                    found.append(child)
+            if not found:
+                return list(matched)
+            nodes = found
+
+        for node in nodes:
+            matched.update(node.rest)
+            matched.update(node.subscribers)
+        return list(matched)
+
+    def remove(self, addr):
+        """Removes every subscription of a client. Returns how many it had"""
+        patterns = list(self._by_client.get(tuple(addr), ()))
+        for pattern in patterns:
+            self.unsubscribe(addr, pattern)
+        return len(patterns)
+
+    def subscribe(self, addr, pattern):
+        """Subscribes a client to pattern. Returns False if it was already subscribed"""
+        addr = tuple(addr)
+        levels = _levels(pattern)
+        rest = levels[-1] == REST
+        node = self._root
+        for level in levels[:-1] if rest else levels:
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        subscribers = node.rest if rest else node.subscribers
+
+        if addr in subscribers:
+            return False
+        subscribers[addr] = None
+        self._by_client.setdefault(addr, {})[pattern] = None
+        return True
+
+    def subscriptions(self, addr):
+        """Returns the patterns a client is subscribed to"""
+        return list(self._by_client.get(tuple(addr), ()))
+
+    def unsubscribe(self, addr, pattern):
+        """Unsubscribes a client from pattern. Returns if it was subscribed"""
+        addr = tuple(addr)
+        patterns = self._by_client.get(addr)
+        if patterns is None or not pattern in patterns:
+            return False
+        del patterns[pattern]
+        if not patterns:
+            del self._by_client[addr]
+
+        levels = _levels(pattern)
+        path = [self._root]
+        for level in levels[:-1] if levels[-1] == REST else levels:
+            path.append(path[-1].children[level])
+        if levels[-1] == REST:
+            del path[-1].rest[addr]
+        else:
+            del path[-1].subscribers[addr]
+
+        # Prune the nodes nobody is subscribed through any more
+        for parent, level, node in reversed(list(zip(path, levels, path[1:]))):
+            if node.children or node.subscribers or node.rest:
+                break
+            del parent.children[level]
+        return True
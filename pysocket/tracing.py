@@ -0,0 +1,144 @@
+"""
+pysocket.tracing
+~~~~~~~~~~~~~~~~
+
+Opt-in timing of the stages each message goes through, to find where the time
+goes when latency spikes:
+
+    send:  encode (to bytes), compress, send (framing and syscalls)
+    recv:  receive (syscall, or reassembly), decompress, deliver (history and
+           threaded_recvs), dispatch (the user's handler, queueing included)
+
+A Tracer keeps the most recent traces, and separately the most recent slow
+ones, and can write them as Chrome trace-event JSON (load it in
+chrome://tracing or Perfetto). A sent trace and the trace of the same message
+recived by another socket share a flow id made from the sender id and sequence
+number in the frame header, so one message can be followed end to end, even
+between processes (timestamps are wall clock based).
+
+    >>> tracer = sock.set_tracer(sample=0.01, slow=0.005)
+    >>> tracer.write_chrome_trace('trace.json')
+
+"""
+
+import collections as _collections
+import json as _json
+import os as _os
+import random as _random
+import threading as _threading
+import time as _time
+
+_perf_counter = _time.perf_counter
+
+
+class Trace(object):
+
+    """The stages of one message. Each stage runs from the end of the one before it (or the start)"""
+
+    __slots__ = ('kind', 'addr', 'socket', 'sender', 'seq', 'size', 'start', 'stages', 'args', '_last')
+
+    def __init__(self, kind, addr=None, socket=0, start=None):
+        self.kind = kind
+        self.addr = addr
+        self.socket = socket  # Sender id of the socket which made the trace
+        self.sender = None  # Sender id and sequence number of the (last) frame carrying the message
+        self.seq = None
+        self.size = None
+        self.start = self._last = _perf_counter() if start is None else start
+        self.stages = []  # (name, start, end)
+        self.args = {}
+
+    def __repr__(self):
+        return 'Trace(%r, %r, %s)' % (self.kind, self.addr, ', '.join('%s=%.1fus' % (name, (end - start) * 1e6)
+                                                                     for name, start, end in self.stages))
+
+    @property
+    def duration(self):
+        return self._last - self.start
+
+    def flow_id(self):
+        """Id shared by the send and recv traces of one message, or None if it isn't known"""
+        if self.sender is None or self.seq is None:
+            return None
+        return '%08x:%d' % (self.sender, self.seq)
+
+    def mark(self, name, at=None):
+        """Ends the stage called name now (or at the perf_counter() time at)"""
+        at = _perf_counter() if at is None else at
+        self.stages.append((name, self._last, at))
+        self._last = at
+
+
+class Tracer(object):
+
+    """Traces sample (0 to 1) of messages. Keeps the last keep traces, and the last slow_keep which took
+    slow seconds or longer. Hooks added with add_hook are called with each trace as it's finished"""
+
+    def __init__(self, sample=1.0, slow=0.01, keep=1000, slow_keep=100):
+        self.sample = sample
+        self.slow = slow
+        self.recent = _collections.deque(maxlen=keep)
+        self.slowest = _collections.deque(maxlen=slow_keep)
+        self._hooks = []
+        self._lock = _threading.Lock()
+        self._offset = _time.time() - _perf_counter()  # Turns perf_counter times into wall clock times
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def begin(self, kind, addr=None, socket=0, start=None):
+        """Returns a new Trace, or None if this message isn't sampled"""
+        if self.sample < 1 and _random.random() >= self.sample:
+            return None
+        return Trace(kind, addr, socket, start)
+
+    def chrome_trace(self, traces=None):
+        """Returns traces (by default the recent ones) as a Chrome trace-event document"""
+        if traces is None:
+            with self._lock:
+                traces = list(self.recent)
+
+        pid = _os.getpid()
+        events = []
+        for trace in traces:
+            tid = trace.socket
+            ts = (trace.start + self._offset) * 1e6
+            args = dict(trace.args, addr='%s:%s' % tuple(trace.addr[:2]) if trace.addr else None, size=trace.size)
+            events.append({'name': trace.kind, 'cat': 'pysocket', 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': ts, 'dur': trace.duration * 1e6, 'args': args})
+            for name, start, end in trace.stages:
+                events.append({'name': name, 'cat': 'pysocket', 'ph': 'X', 'pid': pid, 'tid': tid,
+                               'ts': (start + self._offset) * 1e6, 'dur': (end - start) * 1e6})
+
+            flow = trace.flow_id()
+            if flow is not None:
+                # An arrow from the end of the send to the start of the recive
+                if trace.kind == 'send':
+                    events.append({'name': 'message', 'cat': 'pysocket', 'ph': 's', 'id': flow, 'pid': pid,
+                                   'tid': tid, 'ts': (trace._last + self._offset) * 1e6})
+                else:
+                    events.append({'name': 'message', 'cat': 'pysocket', 'ph': 'f', 'bp': 'e', 'id': flow,
+                                   'pid': pid, 'tid': tid, 'ts': ts})
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.slowest.clear()
+
+    def finish(self, trace):
+        """Keeps a finished trace, and passes it to the hooks"""
+        with self._lock:
+            self.recent.append(trace)
+            if trace.duration >= self.slow:
+                self.slowest.append(trace)
+        for hook in self._hooks:
+            hook(trace)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def write_chrome_trace(self, path, traces=None):
+        """Writes chrome_trace(traces) to path as JSON"""
+        with open(path, 'w') as f:
+            _json.dump(self.chrome_trace(traces), f)
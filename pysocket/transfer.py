@@ -0,0 +1,168 @@
+"""
+pysocket.transfer
+~~~~~~~~~~~~~~~~~
+
+File transfers for send_file and recv_file. A transfer is FILE frames, whose
+payload starts with a chunk header (kind, transfer id, offset, CRC-32):
+
+    START  the size of the whole file. offset is where the transfer starts,
+           so one which broke off can be resumed from what the receiver has
+    DATA   one chunk of the file, at offset, checked against its CRC-32
+    END    the transfer is complete
+
+Files are read one mmap window at a time (or into one reused buffer, for file
+objects which can't be mapped), and written chunk by chunk as they arrive, so
+neither end holds more than a window of the file, whatever its size.
+
+"""
+
+import mmap as _mmap
+import os as _os
+import struct as _struct
+import threading as _threading
+import zlib as _zlib
+
+CHUNK = _struct.Struct('!BIQI')  # kind, transfer id, offset, CRC-32 of the data
+START_INFO = _struct.Struct('!Q')  # Size of the whole file, after the chunk header of START
+
+# Chunk kinds
+START = 0
+DATA = 1
+END = 2
+
+STREAM_CHUNK = 1024 * 1024  # Size of the chunks sent over streams. Datagrams take as much as fits
+WINDOW = 16 * 1024 * 1024  # Most of a file mapped at once
+
+
+class TransferError(Exception):
+
+    """A transfer failed. offset is how much of the file the receiver has, to resume from"""
+
+    def __init__(self, message, offset=0):
+        Exception.__init__(self, message)
+        self.offset = offset
+
+
+def crc32(data):
+    return _zlib.crc32(data) & 0xffffffff
+
+
+class FileReader(object):
+
+    """The chunks of a file (a path, or a file object opened for binary reading) from offset"""
+
+    def __init__(self, src, offset=0):
+        self.owned = not hasattr(src, 'read')
+        self.fileobj = open(src, 'rb') if self.owned else src
+        try:
+            self.fileno = self.fileobj.fileno()
+            self.size = _os.fstat(self.fileno).st_size
+        except (OSError, ValueError, AttributeError):
+            self.fileno = None  # Not a real file (like io.BytesIO), so it's read instead of mapped
+            self.size = self.fileobj.seek(0, _os.SEEK_END)
+        if not 0 <= offset <= self.size:
+            self.close()
+            raise ValueError("Offset %d is outside the file (of %d bytes)" % (offset, self.size))
+        self.offset = offset
+
+    def chunks(self, size):
+        """Yields (offset, memoryview) for each chunk of at most size bytes. A view is only valid until
+        the next one is yielded"""
+        position = self.offset
+        if self.fileno is None:
+            buf = bytearray(size)
+            self.fileobj.seek(position)
+            with memoryview(buf) as whole:
+                while position < self.size:
+                    length = self.fileobj.readinto(whole[:min(size, self.size - position)])
+                    if not length:
+                        raise TransferError("File ended at %d bytes, before its size" % position, position)
+                    with whole[:length] as view:
+                        yield position, view
+                    position += length
+            return
+
+        while position < self.size:
+            # Map whole chunks from position, starting at the page boundary before it
+            start = position - position % _mmap.ALLOCATIONGRANULARITY
+            end = min(self.size, position + max(1, WINDOW // size) * size)
+            window = _mmap.mmap(self.fileno, end - start, access=_mmap.ACCESS_READ, offset=start)
+            try:
+                with memoryview(window) as whole:
+                    while position < end:
+                        length = min(size, end - position)
+                        with whole[position - start:position - start + length] as view:
+                            yield position, view
+                        position += length
+            finally:
+                window.close()
+
+    def close(self):
+        if self.owned:
+            self.fileobj.close()
+
+
+class FileWriter(object):
+
+    """Writes one transfer to dest (a path, or a file object opened for binary writing). Chunks are fed
+    to it as they're recived, from addr if given, or whoever starts a transfer first. Errors are kept in
+    error rather than raised, as chunks are fed in from the reciving path"""
+
+    def __init__(self, dest, addr=None):
+        self.owned = not hasattr(dest, 'write')
+        if self.owned:
+            self.fileobj = open(dest, 'r+b' if _os.path.exists(dest) else 'w+b')
+        else:
+            self.fileobj = dest
+        self.addr = tuple(addr) if addr else None
+        self.id = None
+        self.size = None
+        self.start = None  # Offset the transfer started at
+        self.offset = None  # Offset of the next chunk
+        self.done = False
+        self.error = None
+        self.cond = _threading.Condition()
+
+    def _fail(self, message):
+        self.error = TransferError(message, self.offset or 0)
+
+    def close(self):
+        if self.owned:
+            self.fileobj.close()
+
+    def feed(self, addr, payload):
+        """Handles the payload of a FILE frame from addr"""
+        with self.cond:
+            if self.done or self.error is not None or len(payload) < CHUNK.size:
+                return
+            kind, id, offset, checksum = CHUNK.unpack_from(payload)
+            if kind == START and self.id is None:
+                if self.addr is not None and tuple(addr) != self.addr:
+                    return
+                self.addr, self.id = tuple(addr), id
+                self.size = START_INFO.unpack_from(payload, CHUNK.size)[0]
+                have = self.fileobj.seek(0, _os.SEEK_END)
+                if offset > have:
+                    self._fail("Can't resume at %d bytes, as only %d have been recived" % (offset, have))
+                else:
+                    self.fileobj.seek(offset)
+                    self.start = self.offset = offset
+            elif tuple(addr) != self.addr or id != self.id:
+                return  # Another transfer
+            elif kind == DATA:
+                data = memoryview(payload)[CHUNK.size:]
+                if offset != self.offset:
+                    self._fail("Chunk at %d was missed" % self.offset)
+                elif crc32(data) != checksum:
+                    self._fail("Chunk at %d failed its checksum" % offset)
+                else:
+                    self.fileobj.write(data)
+                    self.offset += len(data)
+            elif kind == END:
+                if self.offset != self.size:
+                    self._fail("Transfer ended at %d of %d bytes" % (self.offset, self.size))
+                else:
+                    self.fileobj.truncate(self.size)  # In case an older, longer file was there
+                    self.fileobj.flush()
+                    self.done = True
+            self.cond.notify_all()
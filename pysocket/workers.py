@@ -0,0 +1,186 @@
+"""
+pysocket.workers
+~~~~~~~~~~~~~~~~
+
+Runs a Server in several processes, so it isn't limited to one core by the GIL.
+Every worker binds the same address with SO_REUSEPORT and the kernel spreads
+clients among them. Each worker (and the supervisor) also has a control socket
+on 127.0.0.1, which broadcasts are forwarded through so they reach the clients
+of every worker. Broadcasts bigger than one datagram are forwarded in chunks,
+and put back together by the workers. The control sockets are made before the workers are forked,
+so a restarted worker gets the same control address as the one it replaces.
+
+"""
+
+import multiprocessing as _multiprocessing
+import os as _os
+import select as _select
+import socket as _socket
+import itertools as _itertools
+import struct as _struct
+import time as _time
+
+from . import reactor as _reactor
+
+HAVE_REUSEPORT = hasattr(_socket, 'SO_REUSEPORT')
+
+# Forwarded broadcast chunk: port of the client to leave out (0 for none), broadcast id, chunk index and
+# number of chunks, then the chunk of data
+FORWARD = _struct.Struct('!HIII')
+MAX_FORWARD = 65507 - FORWARD.size  # Most data in one chunk
+READY = b'ready'
+
+
+class Supervisor(object):
+
+    """Keeps count processes running target(index), restarting any which die"""
+
+    def __init__(self, target, count, interval=0.5):
+        if not HAVE_REUSEPORT:
+            raise OSError('SO_REUSEPORT is not supported on this platform')
+
+        self.count = count
+        self.interval = interval
+        self.restarts = 0
+        self.processes = [None] * count
+        self._target = target
+        self._context = _multiprocessing.get_context('fork')  # Workers start with a copy of the Server
+        self._timer = None
+        self._parent = _os.getpid()
+        self._ids = _itertools.count()
+        self._partial = {}  # Forwarding address -> [broadcast id, chunks], for broadcasts still arriving
+
+        # One control socket per worker, and the last one for the supervisor
+        self.controls = []
+        for i in range(count + 1):
+            control = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)
+            control.bind(('127.0.0.1', 0))
+            control.setblocking(False)
+            self.controls.append(control)
+        self.addrs = [control.getsockname() for control in self.controls]
+
+    def _check(self):
+        """Restarts dead workers. Runs on the supervisor's reactor every interval seconds"""
+        self._drain(self.controls[-1])
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                process.join()
+                self.restarts += 1
+                self._spawn(index)
+        self._timer = _reactor.get_reactor().call_later(self.interval, self._check)
+
+    def _drain(self, control):
+        try:
+            while True:
+                control.recv(65535)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _main(self, index):
+        """Runs in the worker process"""
+        try:
+            self._target(index)
+        finally:
+            _os._exit(0)
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self._main, args=(index,), name='pysocket-worker-%d' % index)
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+
+    def forward(self, data, exclude_port=0, index=None):
+        """Sends data to every worker except index (the caller) to be broadcast to its clients"""
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data, 'latin-1')
+        data = memoryview(data).cast('B')
+
+        control = self.controls[-1 if index is None else index]
+        broadcast = next(self._ids) & 0xffffffff
+        count = max(1, -(-len(data) // MAX_FORWARD))
+        for i, addr in enumerate(self.addrs[:-1]):
+            if i == index:
+                continue
+            for chunk in range(count):
+                message = [FORWARD.pack(exclude_port, broadcast, chunk, count),
+                           data[chunk * MAX_FORWARD:(chunk + 1) * MAX_FORWARD]]
+                try:
+                    control.sendmsg(message, [], 0, addr)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break  # That worker is behind (or restarting), so it misses this broadcast
+
+    def forwarded(self, index):
+        """Yields (exclude_port, data) for each broadcast forwarded to worker index"""
+        control = self.controls[index]
+        while True:
+            try:
+                message, addr = control.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not addr in self.addrs or len(message) < FORWARD.size:
+                continue  # Ignore anything not from us
+            exclude_port, broadcast, chunk, count = FORWARD.unpack_from(message)
+            if count == 1:
+                yield exclude_port, message[FORWARD.size:]
+                continue
+
+            # Chunks from one address arrive in order, so a new broadcast means the last one lost a chunk
+            partial = self._partial.get(addr)
+            if partial is None or partial[0] != broadcast:
+                if chunk != 0:
+                    continue
+                partial = self._partial[addr] = [broadcast, []]
+            if chunk != len(partial[1]) or chunk >= count:
+                del self._partial[addr]  # One was lost
+                continue
+            partial[1].append(message[FORWARD.size:])
+            if len(partial[1]) == count:
+                del self._partial[addr]
+                yield exclude_port, b''.join(partial[1])
+
+    def orphaned(self):
+        """Returns if the supervisor has died, for workers to exit when it does"""
+        return _os.getppid() != self._parent
+
+    def ready(self, index):
+        """Tells the supervisor that worker index is serving"""
+        self.controls[index].sendto(READY, self.addrs[-1])
+
+    def start(self, timeout=5.0):
+        """Starts the workers and the restart timer. Returns once every worker is serving (or after timeout)"""
+        for index in range(self.count):
+            self._spawn(index)
+
+        control = self.controls[-1]
+        waiting = set(self.addrs[:-1])
+        deadline = _time.monotonic() + timeout
+        while waiting and _time.monotonic() < deadline:
+            _select.select([control], [], [], max(0, deadline - _time.monotonic()))
+            try:
+                message, addr = control.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if message == READY:
+                waiting.discard(addr)
+
+        self._timer = _reactor.get_reactor().call_later(self.interval, self._check)
+
+    def stop(self, timeout=1.0):
+        """Stops the workers (they disconnect their clients first) and closes the control sockets"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+        self.processes = [None] * self.count
+
+        for control in self.controls:
+            control.close()
@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 import unittest
 import sys
+import io
 import os
+import pickle
+import asyncio
+import functools
+import random
+import socket
+import tempfile
+import threading
+import time
 
 try:
     import pysocket
 except ImportError:
     sys.path.append('..')
     import pysocket
+import pysocket.aio
+import pysocket.dispatch
+import pysocket.frame
+import pysocket.heartbeat
+import pysocket.limits
+import pysocket.metrics
+import pysocket.pool
+import pysocket.reliable
+import pysocket.serialization
+import pysocket.stream
+import pysocket.topics
+import pysocket.transfer
+import pysocket.tracing
+import pysocket.workers
 
 class Tests(unittest.TestCase):
 
@@ -28,6 +51,14 @@ class Tests(unittest.TestCase):
         self.socket.add_blocked('127.0.0.1')
         assert len(self.socket._blocked) == 1
 
+    def test_blocking_range(self):
+        self.socket.add_blocked('127.0.0.0/8')
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        assert self.socket.getclients() == []
+
     def test_check_socket_type(self):
         assert self.socket.type() == 2
 
@@ -87,6 +118,19 @@ class Tests(unittest.TestCase):
         else:
             assert self.socket.getsockopt(1, 6, 1) == b'\x01'
 
+    def test_gethistory(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        self.socket.set_history_limits(2)
+        for data in ['one', 'two', 'three']:
+            self.new_socket.send(data)
+            self.socket.recv()
+        assert self.socket.gethistory() == [[('127.0.0.1', 8000), 'two'], [('127.0.0.1', 8000), 'three']]
+        assert self.socket.gethistory(1) == [[('127.0.0.1', 8000), 'three']]
+        assert self.socket.getdropped()['history'] == 1
+
     def test_gettimeout(self):
         assert self.socket.gettimeout() == 0.5
 
@@ -123,6 +167,15 @@ class Tests(unittest.TestCase):
         self.new_socket.send('\x87\x88\x89')
         assert self.socket.recv() == '\x87\x88\x89'
 
+    def test_send_recv_buffers(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        for data in [bytearray(b'hello'), memoryview(b'hello')]:
+            assert self.new_socket.send(data) == len('hello')
+            assert self.socket.recv() == 'hello'
+
     def test_send_recv_chunks(self):
         self.socket.bind('127.0.0.1', 12345)
         self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
@@ -131,6 +184,124 @@ class Tests(unittest.TestCase):
         assert self.new_socket.send('hello' * 20000) == len('hello') * 20000
         assert len(self.socket.recv()) == len('hello') * 20000
 
+    def test_send_recv_legacy(self):
+        self.tearDown()
+        self.socket = pysocket.socket(type=2, legacy=True)
+        self.new_socket = pysocket.socket(type=2, legacy=True)
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        assert self.socket.getclients() == [('127.0.0.1', 8000)]
+        self.new_socket.send('hello')
+        assert self.socket.recv() == 'hello'
+
+    def test_send_recv_one_datagram(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.send('hello', _send=self.new_socket._socket.sendto, _sendto=('127.0.0.1', 12345))
+        frame = pysocket.frame.unpack(self.socket._socket.recv(65535))
+        assert frame.opcode == pysocket.frame.DATA
+        assert frame.sender == self.new_socket._sender_id
+        assert not frame.flags & pysocket.frame.FLAG_FRAGMENT
+
+    def test_send_recv_bytes(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        data = os.urandom(150000)  # Doesn't compress, so has to be split over several datagrams
+        assert self.new_socket.send_bytes(memoryview(data)) == len(data)
+        assert self.socket.recv_bytes() == data
+
+    def test_send_recv_interleaved(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        other = pysocket.socket(ip='127.0.0.1', port=8001)
+        first, second = os.urandom(100000), os.urandom(100000)
+        sends = []
+        for sock, data in ((self.new_socket, first), (other, second)):
+            sock._sendmsg = lambda buffers, _sendto=None, sock=sock: sends.append((sock, b''.join(buffers)))
+            sock.send_bytes(data, ('127.0.0.1', 12345))
+        # Send the fragments of both messages interleaved and in reverse order
+        for sock, datagram in reversed(sends[::2] + sends[1::2]):
+            sock._socket.sendto(datagram, ('127.0.0.1', 12345))
+        assert set([self.socket.recv_bytes(), self.socket.recv_bytes()]) == set([first, second])
+        other.close()
+
+    def test_recv_into(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        buf = bytearray(16)
+        self.new_socket.send_bytes(b'hello')
+        assert self.socket.recv_into(buf) == 5
+        assert buf[:5] == b'hello'
+        assert self.socket.gethistory() == []  # Copied straight into buf, so there's no other copy to keep
+        self.new_socket.send_bytes(b'hello' * 10)
+        assert self.socket.recv_into(buf) == 16  # Truncated, like socket.recv_into
+        assert self.socket.stats()['bytes_in'] == 21
+
+    def test_send_recv_codecs(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.connect('127.0.0.1', 12345)
+        self.socket.recv()
+        assert self.socket._peer_codecs[('127.0.0.1', 8000)] == set(pysocket.compression.available())
+        for codec in pysocket.compression.available():
+            self.new_socket.set_codec(codec)
+            self.new_socket.send('hello' * 1000)
+            assert self.socket.recv() == 'hello' * 1000
+
+    def test_send_small_uncompressed(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.send('hello', _send=self.new_socket._socket.sendto, _sendto=('127.0.0.1', 12345))
+        self.new_socket.send('hello' * 1000, _send=self.new_socket._socket.sendto, _sendto=('127.0.0.1', 12345))
+        small = pysocket.frame.unpack(self.socket._socket.recv(65535))
+        large = pysocket.frame.unpack(self.socket._socket.recv(65535))
+        assert not small.flags & pysocket.frame.FLAG_COMPRESSED
+        assert small.payload == b'hello'
+        assert large.flags & pysocket.frame.FLAG_COMPRESSED
+        assert large.codec == pysocket.compression.ZLIB
+
+    def test_sendtoall(self):
+        self.socket.bind('127.0.0.1', 12345)
+        clients = [pysocket.socket(ip='127.0.0.1', port=8000 + i) for i in range(3)]
+        for client in clients:
+            client.connect('127.0.0.1', 12345)
+            self.socket.recv()
+        self.socket.sendtoall('hello' * 100)
+        for client in clients:
+            assert client.recv() == 'hello' * 100
+            client.close()
+
+    def test_coalescing(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        self.new_socket.set_coalescing(delay=60)
+        for i in range(10):
+            self.new_socket.send_bytes(b'hello %d' % i, ('127.0.0.1', 12345))
+        self.new_socket.flush()
+        frame = pysocket.frame.unpack(self.socket._socket.recv(65535))  # All of them in one datagram
+        assert frame.opcode == pysocket.frame.BATCH
+        assert pysocket.frame.unpack_batch(frame.payload) == [b'hello %d' % i for i in range(10)]
+
+        # The reciever gets them one by one, and the timer flushes without being asked
+        self.new_socket.set_coalescing(delay=0.01)
+        for i in range(10):
+            self.new_socket.send_bytes(b'hello %d' % i, ('127.0.0.1', 12345))
+        assert [self.socket.recv_bytes() for i in range(10)] == [b'hello %d' % i for i in range(10)]
+
+    def test_send_batch_fallback(self):
+        self.socket.bind('127.0.0.1', 12345)
+        self.new_socket.bind(port=8000)  # Binds to 127.0.0.1:8000
+        batch = pysocket.mmsg.SendBatch(pysocket.AF_INET, [('localhost', 12345), ('127.0.0.1', 12345)])
+        assert batch._msgs is None  # 'localhost' isn't numeric, so sendmmsg can't be used
+        assert batch.send(self.new_socket._socket, b'hello') == 2
+        assert self.socket._socket.recv(100) == b'hello'
+
     def test_set_ip(self):
         self.socket.bind('127.0.0.1', 12345)
         assert self.socket.get_ip() == '127.0.0.1'
@@ -153,6 +324,1013 @@ class Tests(unittest.TestCase):
         self.socket.unbind()
         assert self.socket.is_binded() == False
 
+class Test_Frame(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        data = pysocket.frame.pack(pysocket.frame.DATA, b'hello', pysocket.frame.FLAG_COMPRESSED, 7, 42)
+        frame = pysocket.frame.unpack(data)
+        assert frame.opcode == pysocket.frame.DATA
+        assert frame.flags == pysocket.frame.FLAG_COMPRESSED
+        assert (frame.sender, frame.seq) == (7, 42)
+        assert frame.payload == b'hello'
+
+    def fragment_frames(self, data, size, msg_id, sender=1):
+        return [pysocket.frame.unpack(pysocket.frame.pack(pysocket.frame.DATA, header + bytes(chunk),
+                                                          pysocket.frame.FLAG_FRAGMENT, sender))
+                for header, chunk in pysocket.frame.fragments(data, size, msg_id)]
+
+    def test_reassemble_out_of_order(self):
+        reassembler = pysocket.frame.Reassembler()
+        first = self.fragment_frames(b'a' * 100, 33, 1)
+        second = self.fragment_frames(b'b' * 100, 33, 2)
+        assert len(first) == 4
+        results = []
+        for frames in zip(reversed(first), second):  # Interleaved, one of them backwards
+            for frame in frames:
+                results.append(reassembler.add('sender', frame))
+        assert [result for result in results if result] == [b'a' * 100, b'b' * 100]
+        assert len(reassembler) == 0
+
+    def test_reassemble_limits(self):
+        reassembler = pysocket.frame.Reassembler(timeout=60, max_bytes=1000)  # Room for one message, with its overhead
+        assert reassembler.add('one', self.fragment_frames(b'a' * 100, 33, 1)[0]) is None
+        assert reassembler.add('two', self.fragment_frames(b'b' * 100, 30, 1)[0]) is None
+        assert reassembler.evicted == 1  # Oldest message was dropped to stay under max_bytes
+        reassembler.timeout = 0
+        reassembler.expire()
+        assert reassembler.expired == 1
+        assert len(reassembler) == 0
+
+    def test_reassemble_mismatched(self):
+        reassembler = pysocket.frame.Reassembler()
+        assert reassembler.add('sender', self.fragment_frames(b'a' * 100, 50, 1)[0]) is None
+        longer = self.fragment_frames(b'a' * 100, 25, 1)  # Same message id, but 4 fragments instead of 2
+        for frame in longer[1:]:
+            self.assertRaises(pysocket.frame.FrameError, reassembler.add, 'sender', frame)
+        assert len(reassembler) == 1
+
+    def test_reassemble_flood(self):
+        reassembler = pysocket.frame.Reassembler(max_bytes=1024 * 1024, max_messages=100, max_per_peer=10)
+        Frame = pysocket.frame.Frame
+        for msg_id in range(2000):
+            # Empty last fragments of huge messages, which used to allocate a table for each without counting it
+            payload = pysocket.frame.FRAGMENT.pack(msg_id, 0xfffe, 0xffff)
+            reassembler.add(('peer', msg_id % 50), Frame(1, 0, 1, 0, 0, 0, payload), 'peer')
+        assert len(reassembler) == 10 and reassembler.refused == 1990  # One peer can't fill the table
+        for msg_id in range(200):
+            payload = pysocket.frame.FRAGMENT.pack(msg_id, 0xfffe, 0xffff)
+            reassembler.add(msg_id, Frame(1, 0, 1, 0, 0, 0, payload))
+        assert len(reassembler) == 100 and reassembler.evicted == 110
+        assert reassembler._bytes <= reassembler.max_bytes
+        huge = pysocket.frame.FRAGMENT.pack(1, 0, 0xffff) + b'a' * 1000  # At least 64 MB once it's all there
+        self.assertRaises(pysocket.frame.FrameError, reassembler.add, 'peer', Frame(1, 0, 1, 0, 0, 0, huge))
+
+    def test_batch(self):
+        messages = [b'', b'a', b'b' * 1000]
+        payload = pysocket.frame.pack_batch(messages)
+        assert pysocket.frame.unpack_batch(payload) == messages
+        self.assertRaises(pysocket.frame.FrameError, pysocket.frame.unpack_batch, payload[:-1])
+
+    def test_unpack_foreign(self):
+        assert pysocket.frame.unpack(b'hello') is None
+
+    def test_unpack_truncated(self):
+        data = pysocket.frame.pack(pysocket.frame.DATA, b'hello')
+        self.assertRaises(pysocket.frame.FrameError, pysocket.frame.unpack, data[:-1])
+
+class Test_Serialization(unittest.TestCase):
+
+    def test_struct(self):
+        serializer = pysocket.serialization.get('struct')
+        obj = {'a': [1, -2 ** 70, 2.5, None, True, False], (1, 'b'): b'\x00' * 10, 'c': 'h\xe9llo'}
+        data = b''.join(serializer.dumps(obj))
+        assert serializer.loads(memoryview(data)) == obj
+        self.assertRaises(pysocket.serialization.SerializerError, serializer.loads, memoryview(data[:-1]))
+        self.assertRaises(pysocket.serialization.SerializerError, serializer.dumps, object())
+
+    def test_pickle_out_of_band(self):
+        serializer = pysocket.serialization.get(pysocket.serialization.PICKLE)
+        data = bytearray(os.urandom(100000))
+        buffers = serializer.dumps({'data': pickle.PickleBuffer(data)})
+        assert buffers[-1].obj is data  # Sent from where it is, not copied into the pickle
+        obj = serializer.loads(memoryview(b''.join(buffers)))
+        assert bytes(obj['data']) == data
+
+    def test_send_recv(self):
+        server = pysocket.socket(ip='127.0.0.1', port=8064)
+        client = pysocket.socket(ip='127.0.0.1', port=8065)
+        try:
+            client.connect('127.0.0.1', 8064)
+            server.recv()
+            assert client.send_obj({'id': 1, 'tags': ['a', 'b']}) > 0
+            assert server.recv_obj() == {'id': 1, 'tags': ['a', 'b']}
+            client.send_obj(0)
+            assert server.recv_obj(_ip=True) == (('127.0.0.1', 8065), 0)
+
+            # Pickle isn't accepted until it's allowed
+            data = bytearray(os.urandom(200000))  # Out of band, and too big for one datagram
+            client.send_obj(pickle.PickleBuffer(data), serializer='pickle')
+            assert server.recv_obj() == b''
+            server.set_serializer(allow=['struct', 'pickle'])
+            client.send_obj(pickle.PickleBuffer(data), serializer='pickle')
+            assert bytes(server.recv_obj()) == data
+        finally:
+            server.close()
+            client.close()
+
+class Test_Topics(unittest.TestCase):
+
+    def test_match(self):
+        index = pysocket.topics.TopicIndex()
+        assert index.subscribe(('a', 1), 'scores.football.live')
+        assert not index.subscribe(('a', 1), 'scores.football.live')
+        index.subscribe(('b', 2), 'scores.*.live')
+        index.subscribe(('c', 3), 'scores.#')
+        index.subscribe(('d', 4), '#')
+        index.subscribe(('c', 3), 'scores.tennis')
+        assert sorted(index.match('scores.football.live')) == [('a', 1), ('b', 2), ('c', 3), ('d', 4)]
+        assert sorted(index.match('scores.tennis')) == [('c', 3), ('d', 4)]
+        assert sorted(index.match('scores')) == [('c', 3), ('d', 4)]
+        assert index.match('weather') == [('d', 4)]
+        self.assertRaises(ValueError, index.subscribe, ('a', 1), 'scores.#.live')
+
+    def test_remove(self):
+        index = pysocket.topics.TopicIndex()
+        index.subscribe(('a', 1), 'x.y.z')
+        index.subscribe(('a', 1), 'x.#')
+        index.subscribe(('b', 2), 'x.y.z')
+        assert len(index) == 3
+        assert index.remove(('a', 1)) == 2
+        assert not ('a', 1) in index
+        assert index.match('x.y.z') == [('b', 2)]
+        assert index.unsubscribe(('b', 2), 'x.y.z')
+        assert not index.unsubscribe(('b', 2), 'x.y.z')
+        assert index._root.children == {}  # Nodes nobody is subscribed through are pruned
+
+class Test_Stream(unittest.TestCase):
+
+    class Chunks(object):
+        """Fake stream socket which returns data in the given chunks"""
+        def __init__(self, chunks):
+            self.chunks = list(chunks)
+
+        def recv_into(self, view):
+            chunk = self.chunks.pop(0) if self.chunks else b''
+            if len(chunk) > len(view):
+                chunk, rest = chunk[:len(view)], chunk[len(view):]
+                self.chunks.insert(0, rest)
+            view[:len(chunk)] = chunk
+            return len(chunk)
+
+    def test_buffer(self):
+        data = b''.join(pysocket.frame.pack(pysocket.frame.DATA, b'x' * size) for size in (5, 0, 100000, 3))
+        # Chunks which split headers, split payloads and hold several frames at once
+        sock = self.Chunks([data[:7], data[7:40], data[40:70000], data[70000:]])
+        buf = pysocket.stream.StreamBuffer(size=64)
+        frames = []
+        while buf.fill(sock):
+            frames.extend(buf.frames())
+        assert [len(frame.payload) for frame in frames] == [5, 0, 100000, 3]
+        assert len(buf) == 0
+
+    def test_bad_stream(self):
+        buf = pysocket.stream.StreamBuffer()
+        buf.fill(self.Chunks([b'GET / HTTP/1.1\r\n\r\n']))
+        self.assertRaises(pysocket.frame.FrameError, list, buf.frames())
+
+    def test_server_client(self):
+        server = pysocket.Server(('127.0.0.1', 8030), type=pysocket.SOCK_STREAM)
+        client = pysocket.Client(('', 0), ('127.0.0.1', 8030), type=pysocket.SOCK_STREAM)
+        client2 = pysocket.Client(('', 0), ('127.0.0.1', 8030), type=pysocket.SOCK_STREAM)
+        server.serve()
+        time.sleep(0.1)
+        assert len(server.getclients()) == 2
+
+        for i in range(20):
+            client.send('message %d' % i)  # Small writes which TCP is free to merge
+        client.sendall('x' * 200000)  # Bigger than a datagram, but still one frame
+        assert [client2.recv() for i in range(20)] == ['message %d' % i for i in range(20)]
+        assert client2.recv() == 'x' * 200000
+
+        client.quit()
+        time.sleep(0.1)
+        assert len(server.getclients()) == 1
+        server.quit()
+        client2.quit()
+
+    def test_accept(self):
+        accepted = []
+
+        class Server(pysocket.Server):
+            def onAccept(self, conn):
+                accepted.append(conn)
+
+        server = Server(('127.0.0.1', 8031), type=pysocket.SOCK_STREAM)
+        server.serve()
+        peers = [socket.create_connection(('127.0.0.1', 8031)) for i in range(200)]  # Far deeper than the recursion used to go
+        deadline = time.time() + 2
+        while len(accepted) < 200 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(accepted) == 200
+        assert sorted(server.getclients()) == sorted(peer.getsockname() for peer in peers)
+        assert server.get_connection(accepted[0].addr) is accepted[0]
+        assert server.stats()['queues']['threaded_recvs'] == 0
+        for peer in peers:
+            peer.close()
+        server.quit()
+
+        # A plain listening socket, accepting on the reactor
+        sock = pysocket.socket(type=pysocket.SOCK_STREAM, ip='127.0.0.1', port=8032)
+        sock.accept_all()
+        peers = [socket.create_connection(('127.0.0.1', 8032)) for i in range(50)]
+        deadline = time.time() + 2
+        while len(sock.getclients()) < 50 and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(sock.getclients()) == 50
+        assert sock.accept() == 0  # Nothing else is waiting, and it doesn't wait for more
+        for peer in peers:
+            peer.close()
+        sock.close()
+
+class FaultyProxy(object):
+
+    """UDP proxy between a client and a server which drops, duplicates and reorders datagrams"""
+
+    def __init__(self, server, loss=0.1, duplicate=0.05, reorder=0.1, seed=1):
+        self.server = server
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.01)  # Longest a reordered datagram is held
+        self.addr = self.sock.getsockname()
+        self.client = None
+        self.held = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                if self.held is not None:
+                    self.sock.sendto(*self.held)
+                    self.held = None
+                continue
+            except OSError:
+                return
+            if addr != self.server:
+                self.client = addr
+            dest = self.client if addr == self.server else self.server
+
+            if self.random.random() < self.loss:
+                continue
+            if self.held is None and self.random.random() < self.reorder:
+                self.held = (data, dest)  # Sent after the next datagram
+                continue
+            self.sock.sendto(data, dest)
+            if self.random.random() < self.duplicate:
+                self.sock.sendto(data, dest)
+            if self.held is not None:
+                self.sock.sendto(*self.held)
+                self.held = None
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+class Test_Reliable(unittest.TestCase):
+
+    def test_channels(self):
+        wire = []
+        sender = pysocket.reliable.SendChannel(wire.append, max_window=4)
+        receiver = pysocket.reliable.RecvChannel()
+        Frame = pysocket.frame.Frame
+        for i in range(6):
+            sender.send(sender.next_seq(), b'%d' % i)
+        assert wire == [b'0', b'1']  # Slow start begins with a window of 2
+        frames = [Frame(1, 0, 0, 0, 0, seq, b'%d' % seq) for seq in range(6)]
+
+        # 1 is lost, 0 is delivered, then 2 is held back and SACKed
+        ready, ack = receiver.receive(frames[0])
+        assert [frame.payload for frame in ready] == [b'0']
+        sender.ack(*pysocket.reliable.unpack_ack(ack))
+        ready, ack = receiver.receive(frames[2])
+        assert ready == [] and pysocket.reliable.unpack_ack(ack) == (1, [(2, 2)])
+
+        # Resent 1 releases both
+        ready, ack = receiver.receive(frames[1])
+        assert [frame.payload for frame in ready] == [b'1', b'2']
+        assert pysocket.reliable.unpack_ack(ack) == (3, [])
+        sender.ack(3)
+        assert len(sender) == 3 and sender.srtt is not None
+        sender.close()
+
+    def test_lossy_link(self):
+        server = pysocket.socket(ip='127.0.0.1', port=8040)
+        proxy = FaultyProxy(('127.0.0.1', 8040), loss=0.1)
+        client = pysocket.socket(ip='127.0.0.1', port=8041, thread=True)  # Threaded, so ACKs are handled
+        client.set_reliable(min_rto=0.05)
+        client.connect(*proxy.addr)
+        try:
+            messages = ['message %d' % i for i in range(200)]
+            for message in messages:
+                client.send(message)
+
+            recived = []
+            deadline = time.time() + 10
+            while len(recived) < len(messages) and time.time() < deadline:
+                data = server.recv()
+                if data:
+                    recived.append(data)
+            assert recived == messages  # Nothing lost, duplicated or out of order
+            assert client.getreliability()[proxy.addr]['retransmits'] > 0
+        finally:
+            proxy.close()
+            client.close()
+            server.close()
+
+    def test_reconnect(self):
+        server = pysocket.socket(ip='127.0.0.1', port=8080)
+        client = pysocket.socket(ip='127.0.0.1', port=8081, thread=True)
+        client.set_reliable()
+        try:
+            for message in ['before', 'after']:
+                client.bind('127.0.0.1', 8081)  # A fresh socket, whose sequence starts again
+                client.connect('127.0.0.1', 8080)
+                client.send(message)
+                data = None
+                deadline = time.time() + 5
+                while not data and time.time() < deadline:
+                    data = server.recv()
+                assert data == message  # Not dropped as a repeat of the old socket's frames
+            server.disconnect_client('127.0.0.1', 8081)
+            assert ('127.0.0.1', 8081) not in server.getreliability()
+        finally:
+            client.close()
+            server.close()
+
+class Test_Compression(unittest.TestCase):
+
+    def test_get(self):
+        assert pysocket.compression.get('zlib').id == pysocket.compression.ZLIB
+        assert pysocket.compression.get(pysocket.compression.NONE).name == 'none'
+        self.assertRaises(pysocket.compression.CodecError, pysocket.compression.get, 'nope')
+
+    def test_roundtrip(self):
+        for codec in pysocket.compression.available():
+            codec = pysocket.compression.get(codec)
+            assert codec.decompress(codec.compress(b'hello' * 100)) == b'hello' * 100
+
+class Test_Metrics(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = pysocket.socket(ip='127.0.0.1', port=8060)
+        self.client = pysocket.socket(ip='127.0.0.1', port=8061)
+        self.client.connect('127.0.0.1', 8060)
+        self.socket.recv()
+
+    def tearDown(self):
+        self.socket.close()
+        self.client.close()
+
+    def test_stats(self):
+        self.client._metrics.set_sample(1)
+        self.client.send('hello' * 1000)
+        self.client.send_bytes(os.urandom(100000))  # Too big for one datagram
+        assert self.socket.recv() == 'hello' * 1000
+        self.socket.recv_bytes()
+        self.socket.recv()  # Times out
+
+        stats = self.client.stats()
+        assert (stats['messages_out'], stats['bytes_out']) == (2, 105000)
+        assert stats['datagrams_out'] == 3
+        assert stats['datagrams_per_message']['buckets'][:2] == [(1, 1), (2, 1)]
+        assert stats['compression_ratio'] < 1
+        assert stats['send_seconds']['count'] == 2
+        assert stats['clients'][('127.0.0.1', 8060)]['bytes_out'] == 105000
+
+        stats = self.socket.stats()
+        assert (stats['messages_in'], stats['bytes_in']) == (2, 105000)
+        assert stats['errors']['timeout'] == 1
+        assert stats['queues']['threaded_recvs'] == 0
+        assert stats['connected_clients'] == 1
+
+    def test_client_limit(self):
+        metrics = pysocket.metrics.Metrics(max_clients=2)
+        for port in range(5):
+            metrics.recived(('10.0.0.1', port), 10, time.perf_counter())  # Say, a scan from one host
+        metrics.sent(('10.0.0.1', 4), 10, time.perf_counter())
+        assert list(metrics.clients) == [('10.0.0.1', 3), ('10.0.0.1', 4)]  # The longest kept went first
+        assert metrics.clients_evicted == 3
+        assert metrics.snapshot()['messages_in'] == 5  # Still counted in the totals
+
+    def test_serve_idle(self):
+        server = pysocket.Server(('127.0.0.1', 8083), thread=False)
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            assert server.serve(True) is None  # Nothing arrives, so it times out
+            assert sys.stderr.getvalue() == ''
+        finally:
+            sys.stderr = stderr
+            server.quit()
+        assert server.stats()['errors'] == {'timeout': 1}
+
+    def test_drain(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)  # Holds the whole burst
+        self.socket.recv(_isthread=True)  # Recive on the reactor
+        self.socket.set_recv_batch(8)
+        for i in range(100):
+            self.client.send('hello %d' % i)
+        data = os.urandom(200000)
+        self.client.send_bytes(data)  # Fragments, which are put back together across batches
+        deadline = time.time() + 2
+        while len(self.socket.threaded_recvs()) < 101 and time.time() < deadline:
+            time.sleep(0.01)
+
+        recived = list(self.socket.drain_threaded_recvs())
+        assert recived[:100] == ['hello %d' % i for i in range(100)]
+        assert recived[100] == data.decode('latin-1')
+        stats = self.socket.stats()
+        assert stats['packets_per_wakeup']['sum'] >= 104
+        assert stats['wakeups'] < 104  # Most wakeups recived more than one datagram
+        assert stats['drain_depth']['count'] == stats['wakeups']
+
+    def test_drain_malformed(self):
+        self.socket.set_recv_batch(32)
+        raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(5):
+            self.client.send('hello %d' % i)
+        raw.sendto(b'PS' + bytes([9]) + b'\x00' * 17, ('127.0.0.1', 8060))  # Unsupported version
+        for i in range(5, 10):
+            self.client.send('hello %d' % i)
+        raw.close()
+        time.sleep(0.05)
+
+        self.socket.recv(_isthread=True)  # Everything waiting is recived in one batch
+        deadline = time.time() + 2
+        while len(self.socket.threaded_recvs()) < 10 and time.time() < deadline:
+            time.sleep(0.01)
+        assert list(self.socket.drain_threaded_recvs()) == ['hello %d' % i for i in range(10)]
+        assert self.socket.stats()['errors'].get('FrameError') == 1
+
+    def test_prometheus(self):
+        self.client.send('hello')
+        self.socket.recv()
+        text = pysocket.metrics.prometheus({'server': self.socket.stats()})
+        assert '# TYPE pysocket_messages_in_total counter' in text
+        assert 'pysocket_messages_in_total{socket="server"} 1' in text
+        assert 'pysocket_client_bytes_in_total{socket="server",client="127.0.0.1:8061"} 5' in text
+        assert 'pysocket_recv_seconds_bucket{socket="server",le="+Inf"}' in text
+
+        exporter = pysocket.metrics.PrometheusServer(('127.0.0.1', 0), {'server': self.socket})
+        try:
+            conn = socket.create_connection(exporter.addr)
+            conn.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+            conn.close()
+            assert response.startswith(b'HTTP/1.0 200')
+            assert b'pysocket_messages_in_total{socket="server"} 1' in response
+        finally:
+            exporter.close()
+
+class Test_Limits(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = pysocket.socket(ip='127.0.0.1', port=8066)
+        self.client = pysocket.socket(ip='127.0.0.1', port=8067)
+        self.client.connect('127.0.0.1', 8066)
+        self.socket.recv()
+
+    def tearDown(self):
+        self.socket.close()
+        self.client.close()
+
+    def test_token_buckets(self):
+        limits = pysocket.limits.InboundLimits(messages=10, bytes=1000, burst=1.0)
+        assert all(limits.allow('a', 10, now=0) for i in range(10))
+        assert not limits.allow('a', 10, now=0)
+        assert limits.allow('b', 10, now=0)  # Every sender has its own buckets
+        assert [limits.allow('a', 10, now=0.5) for i in range(6)] == [True] * 5 + [False]
+        assert not limits.allow('b', 1001, now=0.5)  # Over the byte budget, so no message is taken either
+        assert limits.dropped == 3
+
+    def test_send_queues(self):
+        queues = pysocket.limits.SendQueues(maxlen=2, policy='drop_oldest')
+        for data in (b'1', b'2', b'3'):
+            queues.put('slow', data)
+            queues.put('fast', data)
+        assert queues.dropped == 2
+
+        written = []
+        def write(addr, data):
+            if addr == 'slow':
+                raise BlockingIOError
+            written.append(bytes(data))
+            return len(data)
+        assert queues.drain(write)  # The slow destination is still waiting
+        assert written == [b'2', b'3'] and len(queues) == 2
+
+        queues.policy = 'disconnect'
+        assert not queues.put('slow', b'4')
+        assert len(queues) == 0
+
+    def test_inbound(self):
+        self.socket.set_inbound_limits(messages=5, burst=1.0)
+        for i in range(20):
+            self.client.send('hello')
+        recived = [self.socket.recv() for i in range(20)].count('hello')
+        assert 5 <= recived <= 6
+        assert self.socket.getdropped()['inbound_limits'] == 20 - recived
+
+        self.socket.set_inbound_limits(bytes=100, policy='disconnect')
+        self.client.send_bytes(os.urandom(200))  # Random, so it isn't compressed under the limit
+        assert self.socket.recv() == ''
+        assert self.socket.getclients() == []
+
+    def test_queued_sends(self):
+        self.client.set_send_queues(maxlen=100)
+        for i in range(10):
+            self.client.send('hello %d' % i)  # Written out by the reactor
+        assert [self.socket.recv() for i in range(10)] == ['hello %d' % i for i in range(10)]
+        assert self.client.stats()['queues']['send'] == 0
+
+class Test_Transfer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, 'src')
+        self.dest = os.path.join(self.dir.name, 'dest')
+        self.data = os.urandom(1024 * 1024 + 123)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def recv_file(self, sock):
+        """Starts recv_file(self.dest) on sock in a thread. Returns a function which waits for its result"""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(sock.recv_file(self.dest, timeout=2)))
+        thread.start()
+        return lambda: (thread.join(5), result[0])[1]
+
+    def read(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_datagrams(self):
+        server = pysocket.socket(ip='127.0.0.1', port=8072)
+        client = pysocket.socket(ip='127.0.0.1', port=8073)
+        try:
+            client.connect('127.0.0.1', 8072)
+            server.recv()
+            result = self.recv_file(server)
+            assert client.send_file(self.src) == len(self.data)
+            assert result() == len(self.data)
+            assert self.read() == self.data
+
+            # Resumed from what the receiver already has, from a file object
+            with open(self.dest, 'r+b') as f:
+                f.truncate(300000)
+            result = self.recv_file(server)
+            assert client.send_file(io.BytesIO(self.data), offset=300000) == len(self.data) - 300000
+            assert result() == len(self.data) - 300000
+            assert self.read() == self.data
+        finally:
+            server.close()
+            client.close()
+
+    def test_stream(self):
+        server = pysocket.Server(('127.0.0.1', 8074), thread=False, type=pysocket.SOCK_STREAM)
+        client = pysocket.Client(('', 0), ('127.0.0.1', 8074), type=pysocket.SOCK_STREAM)
+        try:
+            server.recv()
+            result = self.recv_file(server)
+            assert client.send_file(self.src) == len(self.data)
+            assert result() == len(self.data)
+            assert self.read() == self.data
+        finally:
+            client.quit()
+            server.quit()
+
+    def test_checksum(self):
+        transfer = pysocket.transfer
+        writer = transfer.FileWriter(io.BytesIO())
+        writer.feed(('a', 1), transfer.CHUNK.pack(transfer.START, 7, 0, 0) + transfer.START_INFO.pack(8))
+        writer.feed(('a', 1), transfer.CHUNK.pack(transfer.DATA, 7, 0, transfer.crc32(b'1234')) + b'1234')
+        writer.feed(('b', 2), transfer.CHUNK.pack(transfer.DATA, 7, 4, 0) + b'xxxx')  # Not part of the transfer
+        assert writer.error is None
+        writer.feed(('a', 1), transfer.CHUNK.pack(transfer.DATA, 7, 4, transfer.crc32(b'5678')) + b'5679')
+        assert isinstance(writer.error, transfer.TransferError)
+        assert writer.error.offset == 4  # Where to resume from
+
+class Test_Tracing(unittest.TestCase):
+
+    def test_send_recv(self):
+        server = pysocket.socket(ip='127.0.0.1', port=8062)
+        client = pysocket.socket(ip='127.0.0.1', port=8063)
+        try:
+            client.connect('127.0.0.1', 8062)
+            server.recv()
+            sent = client.set_tracer(slow=0)
+            recived = server.set_tracer(slow=1)
+            client.send('hello' * 1000)
+            assert server.recv() == 'hello' * 1000
+
+            send, = sent.recent
+            assert [stage[0] for stage in send.stages] == ['encode', 'compress', 'send']
+            assert list(sent.slowest) == [send]
+            recv, = recived.recent
+            assert [stage[0] for stage in recv.stages] == ['receive', 'decompress', 'deliver']
+            assert recv.size == 5000 and not recived.slowest
+            assert send.flow_id() == recv.flow_id() is not None
+
+            # Both ends of the message are linked in the trace events
+            events = sent.chrome_trace()['traceEvents'] + recived.chrome_trace()['traceEvents']
+            flows = [event for event in events if event['ph'] in ('s', 'f')]
+            assert [event['id'] for event in flows] == [send.flow_id()] * 2
+            assert [event['name'] for event in events if event['ph'] == 'X'][:4] == ['send', 'encode', 'compress', 'send']
+
+            client.set_tracer(sample=0)
+            client.send('hello')
+            server.recv()
+            assert not client._tracer.recent
+        finally:
+            server.close()
+            client.close()
+
+class Test_Buffers(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        ring = pysocket.buffers.RingBuffer(maxlen=3, max_bytes=10)
+        for data in ['ab', 'cd', 'ef', 'gh']:
+            ring.append(data)
+        assert list(ring) == ['cd', 'ef', 'gh']
+        assert ring.dropped == 1
+        ring.append(('127.0.0.1', 'x' * 6))  # Only the data of (ip, data) pairs counts
+        assert ring.nbytes == 10
+        assert ring.last(2) == ['gh', ('127.0.0.1', 'x' * 6)]
+        assert ring.pop() == 'ef'
+        assert list(ring.drain()) == ['gh', ('127.0.0.1', 'x' * 6)]
+        assert len(ring) == 0 and ring.nbytes == 0
+        self.assertRaises(IndexError, ring.pop)
+
+class Test_Registry(unittest.TestCase):
+
+    def test_clients(self):
+        clients = pysocket.registry.ClientRegistry()
+        clients.add(('127.0.0.1', 8000))
+        clients.add(('127.0.0.1', 8001))
+        clients.add(('10.0.0.1', 8000))
+        assert list(clients) == [('127.0.0.1', 8000), ('127.0.0.1', 8001), ('10.0.0.1', 8000)]
+        assert clients.get('127.0.0.1') == ('127.0.0.1', 8000)
+        assert clients.get('127.0.0.1', 8001) == ('127.0.0.1', 8001)
+        assert clients.get('127.0.0.1', 8002) is None
+        assert clients.remove(('127.0.0.1', 8000))
+        assert not clients.remove(('127.0.0.1', 8000))
+        assert clients.get('127.0.0.1') == ('127.0.0.1', 8001)
+        assert len(clients) == 2
+
+    def test_blocklist(self):
+        blocked = pysocket.registry.Blocklist(['10.0.0.0/8', '192.168.1.5', '2001:db8::/32'])
+        assert '10.1.2.3' in blocked
+        assert '192.168.1.5' in blocked
+        assert not '192.168.1.6' in blocked
+        assert '2001:db8::1' in blocked
+        assert '::ffff:10.0.0.1' in blocked
+        assert not 'localhost' in blocked
+        blocked.remove('10.0.0.0/8')
+        assert not '10.1.2.3' in blocked
+        assert len(blocked) == 2
+
+    def test_blocklist_names(self):
+        blocked = pysocket.registry.Blocklist(['localhost', '10.0.0.0/8'])  # Not an ip, so matched exactly
+        assert 'localhost' in blocked
+        assert not 'localhost.localdomain' in blocked
+        assert '10.1.2.3' in blocked
+        assert list(blocked) == ['localhost', '10.0.0.0/8']
+        blocked.remove('localhost')
+        assert not 'localhost' in blocked
+        sock = pysocket.socket()
+        sock.add_blocked('example.com')
+        assert len(sock._blocked) == 1
+        sock.close()
+
+class Test_Heartbeat(unittest.TestCase):
+
+    def test_wheel(self):
+        wheel = pysocket.heartbeat.TimingWheel(tick=1.0, slots=8)
+        start = wheel._start
+        wheel.schedule('a', 2.5, start)
+        wheel.schedule('b', 20, start)  # More than a turn of the wheel away
+        wheel.schedule('c', 1, start)
+        assert wheel.cancel('c') and not wheel.cancel('c')
+        assert wheel.expire(start + 2.9) == []
+        assert wheel.expire(start + 3.0) == ['a']
+        assert wheel.expire(start + 19.5) == []
+        assert wheel.expire(start + 100) == ['b']  # Skipping many turns at once
+        assert len(wheel) == 0
+
+    def test_heartbeats(self):
+        heartbeats = pysocket.heartbeat.Heartbeats(interval=1.0, misses=2)
+        start = heartbeats.wheel._start
+        heartbeats.seen(('127.0.0.1', 1), start)
+        heartbeats.seen(('127.0.0.1', 2), start)
+        heartbeats.seen(('127.0.0.1', 2), start + 1.5)  # Heard from again, so its deadline moves on
+        assert heartbeats.expire(start + 2.25) == [('127.0.0.1', 1)]
+        assert heartbeats.expire(start + 3.25) == []
+        assert heartbeats.expire(start + 3.75) == [('127.0.0.1', 2)]
+        assert len(heartbeats) == 0 and heartbeats.expired == 2
+
+    def test_expiry(self):
+        gone = []
+
+        class Server(pysocket.Server):
+            def onDisconnect(self, addr):
+                gone.append(addr)
+
+        server = Server(('127.0.0.1', 8075))
+        server.set_heartbeat(0.05, 2)
+        server.serve()
+        client = pysocket.Client(('127.0.0.1', 8076), ('127.0.0.1', 8075))
+        client.set_heartbeat(0.02)
+        quiet = pysocket.Client(('127.0.0.1', 8077), ('127.0.0.1', 8075))  # Vanishes without leaving
+        deadline = time.time() + 2
+        while not gone and time.time() < deadline:
+            time.sleep(0.01)
+        assert gone == [('127.0.0.1', 8077)]
+        assert server.getclients() == [('127.0.0.1', 8076)]
+
+        client.quit()  # Leaving calls onDisconnect too
+        deadline = time.time() + 1
+        while len(gone) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert gone == [('127.0.0.1', 8077), ('127.0.0.1', 8076)]
+        quiet.close()
+        server.quit()
+
+    def test_expiry_error(self):
+        gone = []
+
+        class Server(pysocket.Server):
+            def onDisconnect(self, addr):
+                gone.append(addr)
+                if len(gone) == 1:
+                    raise RuntimeError("broken hook")
+
+        server = Server(('127.0.0.1', 8075))
+        server.set_heartbeat(0.05, 2)
+        server.serve()
+        quiet = pysocket.Client(('127.0.0.1', 8076), ('127.0.0.1', 8075))
+        deadline = time.time() + 2
+        while not gone and time.time() < deadline:
+            time.sleep(0.01)
+        quiet2 = pysocket.Client(('127.0.0.1', 8077), ('127.0.0.1', 8075))  # Still expires after the hook failed
+        while len(gone) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert gone == [('127.0.0.1', 8076), ('127.0.0.1', 8077)]
+        assert server.getclients() == []
+        quiet.close()
+        quiet2.close()
+        server.quit()
+
+    def test_legacy(self):
+        server = pysocket.Server(('127.0.0.1', 8084), legacy=True)
+        server.serve()
+        client = pysocket.Client(('127.0.0.1', 8085), ('127.0.0.1', 8084), legacy=True)
+        client2 = pysocket.Client(('127.0.0.1', 8086), ('127.0.0.1', 8084), legacy=True)
+        try:
+            deadline = time.time() + 1
+            while len(server.getclients()) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            assert client.send('hello') == 5
+            assert client2.recv() == 'hello'  # Passed on by the server, in the old protocol
+        finally:
+            server.quit()
+            client.quit()
+            client2.quit()
+
+class Test_Reactor(unittest.TestCase):
+
+    def test_call_later(self):
+        done = threading.Event()
+        reactor = pysocket.reactor.get_reactor()
+        reactor.call_later(0.01, done.set)
+        cancelled = reactor.call_later(0.01, self.fail)
+        cancelled.cancel()
+        assert done.wait(1)
+
+    def test_threaded_recv(self):
+        sock = pysocket.socket(thread=True)
+        new_sock = pysocket.socket()
+        sock.bind('127.0.0.1', 12345)
+        new_sock.bind(port=8000)  # Binds to 127.0.0.1:8000
+        new_sock.connect('127.0.0.1', 12345)
+        new_sock.send('hello')
+        for i in range(100):
+            if sock.threaded_recvs():
+                break
+            time.sleep(0.01)
+        assert sock.threaded_recvs() == ['hello']
+        assert sock.getclients() == [('127.0.0.1', 8000)]
+        sock.close()
+        new_sock.close()
+
+    def test_partial_message(self):
+        server = pysocket.Server(('127.0.0.1', 8082))
+        server.serve()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            header, chunk = next(pysocket.frame.fragments(os.urandom(150000), 60000, 1))
+            sock.sendto(pysocket.frame.pack(pysocket.frame.DATA, header + bytes(chunk), pysocket.frame.FLAG_FRAGMENT, 1),
+                        ('127.0.0.1', 8082))  # Only the first fragment, so the rest never comes
+            time.sleep(0.05)
+            done = threading.Event()
+            start = time.perf_counter()
+            pysocket.reactor.get_reactor().call_soon(done.set)
+            assert done.wait(1)
+            assert time.perf_counter() - start < 0.2  # The reactor wasn't left waiting for the rest
+        finally:
+            sock.close()
+            server.quit()
+
+    def test_one_thread(self):
+        sockets = [pysocket.socket(ip='127.0.0.1', port=12345 + i, thread=True) for i in range(20)]
+        threads = [thread.name for thread in threading.enumerate()]
+        assert threads.count('pysocket-reactor') == 1
+        for sock in sockets:
+            sock.close()
+
+def record(path, data):
+    """proc_recv function for the process dispatcher test. Module level, so it can be pickled"""
+    with open(path, 'a') as f:
+        f.write(data + '\n')
+
+class Test_Dispatch(unittest.TestCase):
+
+    def test_ordered(self):
+        dispatcher = pysocket.dispatch.Dispatcher(workers=4)
+        calls = []
+        for i in range(50):
+            dispatcher.submit(lambda i: (time.sleep(0.001), calls.append(i)), i, key='client')
+        dispatcher.shutdown()
+        assert calls == list(range(50))
+
+    def test_policies(self):
+        release = threading.Event()
+        for policy in (pysocket.dispatch.REJECT, pysocket.dispatch.DROP_OLDEST):
+            release.clear()
+            calls = []
+            dispatcher = pysocket.dispatch.Dispatcher(workers=1, maxsize=2, policy=policy)
+            dispatcher.submit(release.wait)  # Keeps the only worker busy
+            time.sleep(0.05)
+            results = [dispatcher.submit(calls.append, i) for i in range(4)]
+            release.set()
+            dispatcher.shutdown()
+            if policy == pysocket.dispatch.REJECT:
+                assert results == [True, True, False, False]
+                assert calls == [0, 1] and dispatcher.rejected == 2
+            else:
+                assert calls == [2, 3] and dispatcher.dropped == 2
+
+    def test_block(self):
+        release = threading.Event()
+        dispatcher = pysocket.dispatch.Dispatcher(workers=1, maxsize=1)
+        dispatcher.submit(release.wait)
+        time.sleep(0.05)
+        dispatcher.submit(int)
+        threading.Timer(0.1, release.set).start()
+        start = time.time()
+        dispatcher.submit(int)  # Waits for release
+        assert time.time() - start >= 0.05
+        dispatcher.shutdown()
+
+    def test_processes(self):
+        connected = []
+
+        class Server(pysocket.Server):
+            def onConnect(self, addr):
+                connected.append(addr)  # Runs on a thread, so it's seen here
+
+        server = Server(('127.0.0.1', 8078))
+        server.set_dispatcher(workers=2, processes=True)
+        server.serve()
+        client = pysocket.Client(('127.0.0.1', 8079), ('127.0.0.1', 8078))
+        client.set_dispatcher(workers=2, processes=True)
+        self.assertRaises(pysocket.SocketError, client.proc_recv, lambda data: None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'recived')
+            client.proc_recv(functools.partial(record, path))
+            deadline = time.time() + 5
+            while not connected and time.time() < deadline:
+                time.sleep(0.01)
+            assert connected == [('127.0.0.1', 8079)]
+
+            server.sendtoall('hello')
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            with open(path) as f:
+                assert f.read() == 'hello\n'
+
+        client.quit()
+        server.quit()
+        client._dispatcher.shutdown()
+        server._dispatcher.shutdown()
+
+class Test_Aio(unittest.TestCase):
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 5))
+
+    def test_send_recv(self):
+        async def test():
+            server = pysocket.aio.AsyncServer(('127.0.0.1', 8001))
+            await server.start()
+            client = pysocket.aio.AsyncClient(('127.0.0.1', 8002), ('127.0.0.1', 8001))
+            await client.start()
+            assert await client.send('hello' * 1000) == 5000
+            assert await server.recv() == 'hello' * 1000
+            assert server.getclients() == [('127.0.0.1', 8002)]
+            await server.sendto('hi', ('127.0.0.1', 8002))
+            assert await client.recv() == 'hi'
+            await client.quit()
+            await server.quit()
+        self.run_async(test())
+
+    def test_stream(self):
+        async def test():
+            accepted = []
+
+            class Server(pysocket.aio.AsyncServer):
+                async def onAccept(self, addr):
+                    accepted.append(addr)
+
+            server = Server(('127.0.0.1', 8001), type=pysocket.SOCK_STREAM)
+            await server.start()
+            client = pysocket.aio.AsyncClient(None, ('127.0.0.1', 8001), type=pysocket.SOCK_STREAM)
+            await client.start()
+            await client.send(b'hello')
+            data, ip = await server.recvfrom()
+            assert data == 'hello'
+            assert accepted == [ip]
+            await client.quit()
+            await server.quit()
+        self.run_async(test())
+
+    def test_interop(self):
+        async def test():
+            server = pysocket.aio.AsyncServer(('127.0.0.1', 8001))
+            await server.start()
+            client = pysocket.Client(('127.0.0.1', 8002), ('127.0.0.1', 8001))
+            client.send('hello')
+            messages = []
+            async for data in server:
+                messages.append(data)
+                server.close()
+            assert messages == ['hello']
+            client.quit()
+        self.run_async(test())
+
+    def test_interop_opcodes(self):
+        async def test():
+            server = pysocket.aio.AsyncServer(('127.0.0.1', 8001))
+            await server.start()
+            client = pysocket.Client(('127.0.0.1', 8002), ('127.0.0.1', 8001))
+            client.send_obj({'a': 1})  # Objects aren't supported, so they're dropped
+            client._send_frames(pysocket.frame.HEARTBEAT, b'', 0, None)
+            client.set_reliable()
+            client.send('reliable')
+            client.set_reliable(False)
+            client.send('last')
+            client.recv(_isthread=True)  # Handles the ACK
+            messages = []
+            async for data in server:
+                messages.append(data)
+                if data == 'last':
+                    break
+            assert messages == ['reliable', 'last']
+            for i in range(100):
+                if not client._reliability.stats()[('127.0.0.1', 8001)]['in_flight']:
+                    break
+                await asyncio.sleep(0.01)
+            assert client._reliability.stats()[('127.0.0.1', 8001)]['in_flight'] == 0
+            client.quit()
+            await server.quit()
+        self.run_async(test())
+
 class Test_Server_Client(unittest.TestCase):
 
     def setUp(self):
@@ -172,5 +1350,146 @@ class Test_Server_Client(unittest.TestCase):
         assert self.client.send('hello') == 5
         assert self.client2.recv() == 'hello'  # Server should send data to client2
 
+    def test_proc_recv(self):
+        recived = []
+        done = threading.Event()
+        self.client2.proc_recv(lambda data: (recived.append(data), done.set()))
+        self.client.send('hello')
+        assert done.wait(1)
+        assert recived == ['hello']
+
+    def test_trace_dispatch(self):
+        done = threading.Event()
+        tracer = self.client2.set_tracer(pysocket.tracing.Tracer())
+        tracer.add_hook(lambda trace: done.set())
+        self.client2.proc_recv(lambda data: None)
+        self.client.send('hello')
+        assert done.wait(1)
+        assert [stage[0] for stage in tracer.recent[0].stages] == ['receive', 'decompress', 'deliver', 'dispatch']
+
+    def test_publish(self):
+        self.client.subscribe('scores.*.live')
+        self.client2.subscribe('scores.#')
+        deadline = time.time() + 1
+        while len(self.server.getsubscribers('scores.football.live')) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert sorted(self.server.getsubscribers('scores.football.live')) == [('127.0.0.1', 8002), ('127.0.0.1', 8003)]
+
+        self.server.publish('scores.football.live', b'1-0')
+        assert self.client.recv_published() == ('scores.football.live', b'1-0')
+        assert self.client2.recv_published() == ('scores.football.live', b'1-0')
+        self.server.publish('weather', b'rain')  # Nobody is subscribed
+        self.server.publish('scores.tennis', b'15-0')
+        assert self.client2.recv_published() == ('scores.tennis', b'15-0')
+        assert self.client.recv_bytes() == b''
+
+        # Published by a client, through the server
+        self.client.publish('scores.golf', 'par')
+        assert self.client2.recv_published() == ('scores.golf', b'par')
+
+        self.client2.quit()
+        deadline = time.time() + 1
+        while self.server.getsubscribers('scores.tennis') and time.time() < deadline:
+            time.sleep(0.01)
+        assert self.server.getsubscribers('scores.football.live') == [('127.0.0.1', 8002)]
+
+    def test_dispatcher(self):
+        recived = []
+        done = threading.Event()
+        dispatcher = self.client2.set_dispatcher(workers=2)
+        self.client2.proc_recv(lambda data: (recived.append(threading.current_thread().name), done.set()))
+        self.client.send('hello')
+        assert done.wait(1)
+        assert recived[0] != 'pysocket-reactor'
+        dispatcher.shutdown()
+
+class Test_Pool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = pysocket.Server(('127.0.0.1', 8050))
+        self.server.serve()
+
+    def tearDown(self):
+        self.server.quit()
+
+    def test_checkout_checkin(self):
+        pool = pysocket.pool.ClientPool(max_size=2)
+        first = pool.checkout(('127.0.0.1', 8050))
+        second = pool.checkout(('127.0.0.1', 8050))
+        self.assertRaises(pysocket.SocketError, pool.checkout, ('127.0.0.1', 8050), 0.05)  # Full
+        pool.checkin(first)
+        assert pool.checkout(('127.0.0.1', 8050)) is first  # Reused, not made again
+        pool.checkin(first)
+        pool.checkin(second)
+        assert (pool.created, len(pool)) == (2, 2)
+
+        try:
+            with pool.connection(('127.0.0.1', 8050)) as client:
+                raise ValueError
+        except ValueError:
+            pass
+        assert client._socket.fileno() == -1  # Evicted, in case the error left it broken
+        pool.close()
+        assert (pool.evicted, len(pool)) == (2, 0)
+
+    def test_eviction(self):
+        pool = pysocket.pool.ClientPool(idle_timeout=0.2, health_check=lambda client: client.send('ping'))
+        pool.warm(('127.0.0.1', 8050), 2)
+        time.sleep(0.05)
+        assert len(self.server.getclients()) == 2
+        for i in range(40):
+            if not len(pool):
+                break
+            time.sleep(0.05)
+        assert pool.evicted == 2
+        time.sleep(0.1)
+        assert self.server.getclients() == []  # They left the server
+
+        pool = pysocket.pool.ClientPool(health_check=lambda client: False)
+        with pool.connection(('127.0.0.1', 8050)) as client:
+            pass
+        with pool.connection(('127.0.0.1', 8050)) as other:
+            assert other is not client  # Failed the health check, so a new one was made
+        pool.close()
+
+@unittest.skipUnless(pysocket.workers.HAVE_REUSEPORT, 'needs SO_REUSEPORT')
+class Test_Workers(unittest.TestCase):
+
+    def setUp(self):
+        self.server = pysocket.Server(('127.0.0.1', 8010), workers=2)
+        self.server.serve()  # Returns once both workers are serving
+        self.clients = [pysocket.Client(('', 8011 + i), ('', 8010)) for i in range(3)]
+        time.sleep(0.1)
+
+    def tearDown(self):
+        self.server.quit()
+        for client in self.clients:
+            client.quit()
+
+    def test_broadcast(self):
+        # Whichever workers the clients landed on, everyone gets the broadcasts
+        self.clients[0].send('hello')
+        assert [client.recv() for client in self.clients[1:]] == ['hello', 'hello']
+        self.server.sendtoall('all')
+        assert [client.recv() for client in self.clients] == ['all', 'all', 'all']
+
+    def test_large_broadcast(self):
+        data = os.urandom(70000).decode('latin-1')  # Forwarded to the other worker in chunks
+        self.clients[0].send(data)
+        assert [client.recv() for client in self.clients[1:]] == [data, data]
+        self.server.sendtoall(data)
+        assert [client.recv() for client in self.clients] == [data, data, data]
+
+    def test_restart(self):
+        dead = self.server._workers.processes[0]
+        dead.kill()
+        for i in range(40):
+            if self.server._workers.restarts:
+                break
+            time.sleep(0.05)
+        assert self.server._workers.restarts == 1
+        assert self.server._workers.processes[0] is not dead
+        assert self.server._workers.processes[0].is_alive()
+
 if __name__ == '__main__':
     unittest.main()